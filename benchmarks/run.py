@@ -0,0 +1,266 @@
+""" Run the dufl scale benchmarks
+
+Generates a synthetic remote and dufl root of the requested size,
+times every dufl command against it and counts the git processes
+each invocation spawns (using `dufl --profile`). Results are compared
+against a stored baseline, and the run fails when a scenario is
+slower than the baseline by more than the regression threshold, or
+spawns more git processes.
+
+Example:
+    python benchmarks/run.py --files 10000 --commits 50000
+"""
+import click
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import synthetic
+
+
+class Bench(object):
+    """ A synthetic dufl environment
+
+    Args:
+        folder (str): Folder holding the environment. The fake
+            home folder, system folder, remote and dufl root
+            are created under it.
+        git (str): Path to the git executable
+    """
+    def __init__(self, folder, git):
+        self.folder = folder
+        self.git = git
+        self.home = os.path.join(folder, 'home')
+        self.system = os.path.join(folder, 'system')
+        self.remote = os.path.join(folder, 'remote.git')
+        self.dufl_root = os.path.join(self.home, '.dufl')
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(HERE)] +
+            [p for p in [os.environ.get('PYTHONPATH')] if p]
+        )
+        self.env.pop('DUFL_PROFILE', None)
+        for var in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+            self.env.setdefault(var, 'Bench')
+        for var in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+            self.env.setdefault(var, 'bench@example.com')
+        os.makedirs(self.home)
+        os.makedirs(self.system)
+
+    def file_system_path(self, path):
+        """ Return the file system path of a repository path
+
+        Args:
+            path (str): Repository path, eg. home/.vimrc
+        Returns:
+            str: File system path
+        """
+        if path.startswith('home/'):
+            return os.path.join(self.home, path[len('home/'):])
+        return path[len('root'):]
+
+    def deploy(self, path):
+        """ Copy a file from the dufl root to its file system location
+
+        Args:
+            path (str): Repository path
+        """
+        target = self.file_system_path(path)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.copyfile(os.path.join(self.dufl_root, path), target)
+
+    def dufl(self, *args):
+        """ Run a dufl command, and measure it
+
+        Args:
+            *args: dufl command and arguments
+        Returns:
+            tuple: (wall time in seconds, number of git processes)
+        Raises:
+            subprocess.CalledProcessError: If the command failed
+        """
+        profile = tempfile.mkdtemp(dir=self.folder)
+        command = [
+            sys.executable, '-c',
+            'from dufl.cli import cli; cli(prog_name="dufl")',
+            '-r', self.dufl_root, '--profile', profile
+        ] + list(args)
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            subprocess.check_call(
+                command, env=self.env, stdout=devnull, stderr=devnull
+            )
+            elapsed = time.time() - start
+        with open(glob.glob(os.path.join(profile, '*.trace.json'))[0]) as f:
+            events = json.load(f)['traceEvents']
+        shutil.rmtree(profile)
+        return elapsed, len([e for e in events if e['cat'] == 'git'])
+
+
+def _measure(bench, invocations):
+    """ Run a list of dufl invocations and average them
+
+    Args:
+        bench (Bench): The environment
+        invocations (list of tuple): Arguments of each invocation
+    Returns:
+        dict: Mean seconds and git processes per invocation
+    """
+    total_time = 0
+    total_git = 0
+    for args in invocations:
+        elapsed, git_count = bench.dufl(*args)
+        total_time += elapsed
+        total_git += git_count
+    count = max(len(invocations), 1)
+    return {
+        'seconds': total_time / count,
+        'git_processes': float(total_git) / count,
+        'invocations': len(invocations)
+    }
+
+
+def scenario_init(bench, sample):
+    return _measure(bench, [('init', bench.remote)])
+
+
+def scenario_checkout(bench, sample):
+    for path in sample:
+        bench.deploy(path)
+    return _measure(bench, [
+        ('checkout', bench.file_system_path(p)) for p in sample
+    ])
+
+
+def scenario_add(bench, sample):
+    for path in sample:
+        with open(bench.file_system_path(path), 'a') as f:
+            f.write('# benchmark change\n')
+    return _measure(bench, [
+        ('add', bench.file_system_path(p), '-m', 'Benchmark') for p in sample
+    ])
+
+
+def scenario_push(bench, sample):
+    return _measure(bench, [('push',)])
+
+
+def scenario_ls(bench, sample):
+    return _measure(bench, [('ls',)] + [
+        ('ls', os.path.dirname(bench.file_system_path(p))) for p in sample
+    ])
+
+
+# Scenarios are run in this order, each building on the previous ones.
+SCENARIOS = [
+    ('init', scenario_init),
+    ('checkout', scenario_checkout),
+    ('add', scenario_add),
+    ('push', scenario_push),
+    ('ls', scenario_ls)
+]
+
+
+def compare(results, baseline, threshold):
+    """ Compare results against a baseline
+
+    Args:
+        results (dict): Scenario name to measurement
+        baseline (dict): Scenario name to measurement
+        threshold (float): Allowed relative slowdown, eg. 0.2 for 20%
+    Returns:
+        list of str: Description of each regression
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['seconds'] > base['seconds'] * (1 + threshold):
+            regressions.append('%s: %.3fs per invocation, baseline %.3fs' % (
+                name, result['seconds'], base['seconds']
+            ))
+        if result['git_processes'] > base['git_processes']:
+            regressions.append(
+                '%s: %.1f git processes per invocation, baseline %.1f' % (
+                    name, result['git_processes'], base['git_processes']
+                )
+            )
+    return regressions
+
+
+@click.command()
+@click.option('--files', default=1000, help='Number of tracked files.')
+@click.option('--commits', default=5000, help='Depth of the history.')
+@click.option('--median-size', default=1024, help='Median file size, in bytes.')
+@click.option('--size-sigma', default=1.0, help='Shape of the log-normal file size distribution. 0 for fixed size files.')
+@click.option('--max-size', default=1024 * 1024, help='Largest file size, in bytes.')
+@click.option('--sample', default=20, help='Number of files used by per-file commands.')
+@click.option('--seed', default=0, help='Random seed.')
+@click.option('--git', default='/usr/bin/git', help='git binary.')
+@click.option('--baseline', default=os.path.join(HERE, 'baseline.json'), help='Baseline file.')
+@click.option('--threshold', default=0.25, help='Allowed slowdown before failing, eg. 0.25 for 25%.')
+@click.option('--update-baseline', is_flag=True, default=False, help='Store the results as the new baseline.')
+@click.option('--keep', is_flag=True, default=False, help='Keep the generated environment.')
+def run(files, commits, median_size, size_sigma, max_size, sample, seed,
+        git, baseline, threshold, update_baseline, keep):
+    """ Run the benchmark scenarios """
+    folder = os.path.realpath(tempfile.mkdtemp(prefix='dufl-bench-'))
+    key = 'files=%d,commits=%d,median_size=%d' % (files, commits, median_size)
+    try:
+        bench = Bench(folder, git)
+        paths = synthetic.synthetic_paths(files, bench.system)
+        start = time.time()
+        synthetic.create_remote(
+            bench.remote, paths, commits, median_size, size_sigma,
+            max_size, git=git, seed=seed
+        )
+        click.echo('Generated %s in %.1fs' % (key, time.time() - start))
+        sample_paths = random.Random(seed).sample(paths, min(sample, len(paths)))
+        results = {}
+        for name, scenario in SCENARIOS:
+            results[name] = scenario(bench, sample_paths)
+            click.echo('%-10s %8.3fs %6.1f git processes per invocation' % (
+                name, results[name]['seconds'], results[name]['git_processes']
+            ))
+    finally:
+        if keep:
+            click.echo('Environment kept in %s' % folder)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    baselines = {}
+    if os.path.isfile(baseline):
+        with open(baseline) as f:
+            baselines = json.load(f)
+    if update_baseline:
+        baselines[key] = results
+        with open(baseline, 'w') as f:
+            json.dump(
+                baselines, f, indent=2, sort_keys=True, separators=(',', ': ')
+            )
+        click.echo('Baseline updated.')
+        return
+    if key not in baselines:
+        click.echo('No baseline for %s, run with --update-baseline.' % key)
+        return
+    regressions = compare(results, baselines[key], threshold)
+    for regression in regressions:
+        click.echo('Regression! %s' % regression, err=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
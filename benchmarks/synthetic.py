@@ -0,0 +1,133 @@
+""" Generate synthetic dufl roots and remotes for benchmarking
+
+The remote history is written with a single `git fast-import`
+process, so generating tens of thousands of commits only takes
+a few seconds.
+"""
+import random
+import subprocess
+import time
+import yaml
+
+
+def file_size(rng, median, sigma, max_size):
+    """ Pick a file size from a log-normal distribution
+
+    Args:
+        rng (random.Random): Random generator
+        median (int): Median file size, in bytes
+        sigma (float): Shape of the distribution. 0 means all files
+            have the median size.
+        max_size (int): Largest allowed size
+    Returns:
+        int: File size in bytes
+    """
+    if sigma <= 0:
+        return min(median, max_size)
+    return max(1, min(max_size, int(median * rng.lognormvariate(0, sigma))))
+
+
+def file_content(rng, size):
+    """ Return random text content of the given size
+
+    Args:
+        rng (random.Random): Random generator
+        size (int): Size in bytes
+    Returns:
+        bytes: The content, made of 63 character lines
+    """
+    line_count = size // 64 + 1
+    content = ''.join(
+        '%063x\n' % rng.getrandbits(252) for i in range(line_count)
+    )
+    return content[:size].encode('ascii')
+
+
+def synthetic_paths(count, system_folder):
+    """ Return the repository paths of the synthetic files
+
+    Three quarters of the files live under the home subdir, the
+    rest under the slash subdir, within the given system folder
+    so that checking them out never touches the real system.
+
+    Args:
+        count (int): Number of files
+        system_folder (str): Absolute folder under which files
+            outside the home folder are stored.
+    Returns:
+        list of str: Repository paths
+    """
+    paths = []
+    for i in range(count):
+        if i % 4 == 3:
+            paths.append('root%s/etc/service%d/file%d.conf' % (
+                system_folder, i // 100, i
+            ))
+        else:
+            paths.append('home/.config/app%d/file%d.rc' % (i // 100, i))
+    return paths
+
+
+def _data(content):
+    return b'data ' + str(len(content)).encode('ascii') + b'\n' + content + b'\n'
+
+
+def create_remote(folder, paths, commits, median_size, size_sigma,
+                  max_size, git='/usr/bin/git', seed=0):
+    """ Create a bare remote repository with synthetic history
+
+    The first commit adds a settings file and all the given paths,
+    each following commit modifies one randomly chosen path (fast-import
+    parents each commit on the current tip of the branch). Commits
+    are dated one minute apart, ending now.
+
+    Args:
+        folder (str): Folder of the bare repository (must not exist)
+        paths (list of str): Repository paths to create
+        commits (int): Total number of commits
+        median_size (int): Median file size, in bytes
+        size_sigma (float): Shape of the file size distribution
+        max_size (int): Largest file size, in bytes
+        git (str): Path to the git executable
+        seed (int): Random seed, so runs are reproducible
+    Returns:
+        dict: Dictionary of repository path to file size at HEAD
+    """
+    rng = random.Random(seed)
+    subprocess.check_call([git, 'init', '-q', '--bare', folder])
+    importer = subprocess.Popen(
+        [git, '-C', folder, 'fast-import', '--quiet'],
+        stdin=subprocess.PIPE
+    )
+    stream = importer.stdin
+    sizes = {}
+    now = int(time.time())
+    first = now - 60 * max(commits, 1)
+    settings = yaml.dump({'git': git}).encode('ascii')
+    for number in range(max(commits, 1)):
+        if number == 0:
+            changed = paths
+        else:
+            changed = [rng.choice(paths)]
+        stream.write(
+            b'commit refs/heads/master\n' +
+            ('committer Bench <bench@example.com> %d +0000\n' % (
+                first + 60 * number
+            )).encode('ascii') +
+            _data(('Commit %d' % number).encode('ascii'))
+        )
+        if number == 0:
+            stream.write(b'M 100644 inline settings.yaml\n' + _data(settings))
+        for path in changed:
+            size = file_size(rng, median_size, size_sigma, max_size)
+            sizes[path] = size
+            stream.write(
+                ('M 100644 inline %s\n' % path).encode('ascii') +
+                _data(file_content(rng, size))
+            )
+        stream.write(b'\n')
+    stream.close()
+    if importer.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+    return sizes
+
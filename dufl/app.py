@@ -2,8 +2,12 @@ import os
 import re
 import yaml
 
+from datetime import datetime
+
 from yaml.scanner import ScannerError
 from . import defaults
+from .index import INDEX_FILE, load_index
+from .utils import CachedGit
 
 
 def get_dufl_file_path(file_path, settings):
@@ -37,6 +41,147 @@ def get_dufl_file_path(file_path, settings):
         )
 
 
+def get_file_system_path(repo_path, settings):
+    """ Return the file system path of a file within the dufl folder
+
+    This is the reverse of get_dufl_file_path.
+
+    Args:
+        repo_path (str): Path of the file relative to the dufl root,
+            eg. home/.vimrc
+        settings (dict): Settings dictionary. Expected keys
+            are home_subdir and slash_subdir.
+
+    Returns:
+        str: File system path, or None if the file is not under
+            the home or slash subdirs (eg. the settings file)
+    """
+    home = os.path.expanduser('~')
+    home = re.sub('/$', '', home)
+    for subdir, base in [
+        (re.sub('^/|/$', '', settings['home_subdir']), home),
+        (re.sub('^/|/$', '', settings['slash_subdir']), '/')
+    ]:
+        if repo_path.startswith(subdir + '/'):
+            return os.path.join(base, repo_path[len(subdir) + 1:])
+    return None
+
+
+def get_state_folder(context):
+    """ Return the folder where dufl keeps its own state files
+
+    This lives within the .git folder of the dufl root, so it is
+    never committed.
+
+    Args:
+        context (dict): The context. Expected key is dufl_root.
+    Returns:
+        str: The folder (which may not exist yet)
+    """
+    return os.path.join(context['dufl_root'], defaults.state_folder)
+
+
+def get_git(context):
+    """ Return a Git object working on the dufl root
+
+    The same object is returned for the lifetime of the context, so
+    the results of read-only queries are shared by the whole command.
+
+    Args:
+        context (dict): The context. Expected keys are dufl_root,
+            and optionally git and profiler.
+    Returns:
+        CachedGit: The Git object
+    """
+    if context.get('cached_git') is None:
+        context['cached_git'] = CachedGit(
+            context.get('git', '/usr/bin/git'),
+            context['dufl_root'],
+            profiler=context.get('profiler')
+        )
+    return context['cached_git']
+
+
+def get_tracked_index(context):
+    """ Return the index of the files tracked in the dufl root
+
+    The index is brought up to date with HEAD first.
+
+    Args:
+        context (dict): The context
+    Returns:
+        TrackedIndex: The index
+    """
+    return load_index(
+        get_git(context), os.path.join(get_state_folder(context), INDEX_FILE)
+    )
+
+
+def get_tracked_files(context):
+    """ Return the file system paths of all the files managed by dufl
+
+    Args:
+        context (dict): The context
+    Returns:
+        list of str: The file system paths
+    """
+    index = get_tracked_index(context)
+    try:
+        files = []
+        for subdir in [context['home_subdir'], context['slash_subdir']]:
+            for entry in index.lookup(re.sub('^/|/$', '', subdir) + '/'):
+                files.append(get_file_system_path(entry.path, context))
+        return files
+    finally:
+        index.close()
+
+
+def get_content_at_modification_time(git, context, file_path, dufl_file):
+    """ Return the stored content of a file as it was when last modified
+
+    This looks at the last commit before the modification time of the
+    local file. If the file did not exist in the repository at the time,
+    the first version of the file ever is used.
+
+    Args:
+        git (Git): Git object for the dufl root
+        context (dict): The context
+        file_path (str): File system path of the local file
+        dufl_file (str): Path of the file in the dufl root
+    Returns:
+        str: The content as stored in the dufl root, or None if
+            the file is not in the repository.
+    """
+    repo_path = os.path.relpath(dufl_file, context['dufl_root'])
+    last_modified = datetime.fromtimestamp(
+        os.path.getmtime(file_path)
+    ).strftime('%Y-%m-%d %H:%M:%S')
+    commit_at_date = re.sub('[^a-zA-Z0-9]', '', git.get_output(
+        'rev-list', '-1',
+        '--before=%s' % last_modified,
+        git.working_branch()
+    ))
+    content = None
+    if len(commit_at_date) > 0:
+        content = git.read_object('%s:%s' % (commit_at_date, repo_path))
+    # If there is no commit at date, or the file didnt' exist at the commit,
+    # assume first version of the file ever.
+    if content is None:
+        # Commits are listed newest first, and streamed: the history
+        # is walked once, without being held in memory.
+        commit_at_date = ''
+        for line in git.iter_lines(
+                'log', '--diff-filter=A', '--format=%H', '--', repo_path):
+            commit_at_date = re.sub('[^a-zA-Z0-9]', '', line)
+        if len(commit_at_date) == 0:
+            return None
+        content = git.read_object('%s:%s' % (commit_at_date, repo_path))
+
+    # Note: do not be tempted to use 'git show branch@{date}' syntax,
+    # as that relies on the reflog which does not contain all commits.
+    return content
+
+
 class SettingsBroken(Exception):
     """ Exception raised when the settings file can't be parsed"""
     pass
@@ -63,8 +208,9 @@ def create_initial_context(root):
     context = dict(defaults.settings.items() + {
         'dufl_root': root,
         'create_mode': 0766,
-        'home_subdir': 'home',
-        'slash_subdir': 'root',
+        'home_subdir': defaults.home_subdir,
+        'slash_subdir': defaults.slash_subdir,
+        'chunks_subdir': 'chunks',
         'settings_file': 'settings.yaml'
     }.items())
     settings_file = os.path.join(
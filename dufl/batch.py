@@ -0,0 +1,237 @@
+""" Run many dufl commands in a single process
+
+`dufl batch` reads one JSON request per line, and writes one JSON
+result per line. Requests look like:
+
+    {"id": 1, "command": "add", "path": "~/.vimrc", "message": "Vim"}
+    {"id": 2, "command": "add", "update": true}
+    {"id": 3, "command": "checkout", "files": ["~/.vimrc"]}
+    {"id": 4, "command": "checkout", "all": true, "transaction": true}
+    {"id": 5, "command": "status", "files": ["~/.vimrc"]}
+    {"id": 6, "command": "diff", "file": "~/.vimrc"}
+
+Results have the request's id and command, ok (whether the command
+succeeded), output and error (what the command printed), plus the
+fields specific to status (changed, missing, untracked) and diff
+(changed, diff).
+
+The settings, the git queries already answered and the git processes
+kept open (such as the cat-file process reading stored versions) are
+shared by all the requests, so each request costs little more than
+the work it does.
+"""
+import difflib
+import json
+import os
+import sys
+
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from .app import get_dufl_file_path, get_state_folder, get_tracked_index
+from .changes import STAT_CACHE_FILE, find_changed
+from .storage import write_file_content
+
+
+# Commands accepted in requests
+BATCH_COMMANDS = ('add', 'checkout', 'status', 'diff')
+
+
+class BatchRequestInvalid(Exception):
+    """ Exception raised when a request can't be parsed """
+    pass
+
+
+def parse_request(line):
+    """ Parse a request line
+
+    Args:
+        line (str): JSON request
+    Returns:
+        dict: The request. Strings are byte strings, and paths have
+            ~ expanded.
+    Raises:
+        BatchRequestInvalid
+    """
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        raise BatchRequestInvalid('Invalid JSON: %s' % str(e))
+    if not isinstance(request, dict):
+        raise BatchRequestInvalid('Requests must be JSON objects.')
+    request = _to_bytes(request)
+    if request.get('command') not in BATCH_COMMANDS:
+        raise BatchRequestInvalid('Unknown command %s. Use one of %s.' % (
+            request.get('command'), ', '.join(BATCH_COMMANDS)
+        ))
+    for key in ('path', 'file'):
+        if isinstance(request.get(key), str):
+            request[key] = os.path.expanduser(request[key])
+    if 'files' in request:
+        if not isinstance(request['files'], list):
+            raise BatchRequestInvalid('files must be a list.')
+        request['files'] = [os.path.expanduser(f) for f in request['files']]
+    return request
+
+
+def _to_bytes(value):
+    """ Convert the unicode strings of a parsed JSON value to utf-8 """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_bytes(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_to_bytes(k), _to_bytes(v)) for k, v in value.items())
+    return value
+
+
+def command_argv(request):
+    """ Return the command line equivalent to an add or checkout request
+
+    Args:
+        request (dict): The request
+    Returns:
+        list of str: The arguments of the dufl command
+    """
+    if request['command'] == 'add':
+        argv = ['add']
+        if request.get('path'):
+            argv.append(request['path'])
+        if request.get('update'):
+            argv.append('--update')
+        if request.get('message'):
+            argv += ['--message', request['message']]
+        if request.get('encrypt'):
+            argv.append('--encrypt')
+        return argv
+    argv = ['checkout'] + list(request.get('files', []))
+    if request.get('all'):
+        argv.append('--all')
+    if request.get('transaction'):
+        argv.append('--transaction')
+    return argv
+
+
+def status(context, files=None, selected=None):
+    """ Find which files differ from the dufl root
+
+    Args:
+        context (dict): The context
+        files (list of str): File system paths to check. Defaults to
+            all the tracked files.
+        selected (function): If not None, only the file system paths
+            for which this returns True are checked.
+    Returns:
+        dict: Lists of file system paths, with keys changed (tracked
+            files with local changes), missing (tracked files that
+            don't exist locally) and untracked (given files that are
+            not tracked).
+    """
+    untracked = []
+    if files is not None:
+        files = set(os.path.abspath(f) for f in files)
+        untracked = sorted(
+            f for f in files if not os.path.exists(get_dufl_file_path(f, context))
+        )
+        in_profiles = selected
+        selected = lambda path: path in files and (
+            in_profiles is None or in_profiles(path)
+        )
+    index = get_tracked_index(context)
+    try:
+        changed, missing = find_changed(
+            context, index,
+            os.path.join(get_state_folder(context), STAT_CACHE_FILE),
+            selected
+        )
+    finally:
+        index.close()
+    return {'changed': changed, 'missing': missing, 'untracked': untracked}
+
+
+def diff(context, path):
+    """ Return the changes made to a file, against its version in the dufl root
+
+    Args:
+        context (dict): The context
+        path (str): File system path of the file
+    Returns:
+        dict: Dictionary with keys changed (bool) and diff (unified diff,
+            or a message for binary files).
+    Raises:
+        IOError: If the file is not tracked
+    """
+    path = os.path.abspath(path)
+    dufl_file = get_dufl_file_path(path, context)
+    if not os.path.isfile(dufl_file):
+        raise IOError('%s is not tracked.' % path)
+    stored = StringIO()
+    write_file_content(dufl_file, stored, context)
+    stored = stored.getvalue()
+    local = ''
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            local = f.read()
+    if stored == local:
+        return {'changed': False, 'diff': ''}
+    if "\0" in stored or "\0" in local:
+        return {'changed': True, 'diff': 'Binary file %s differs\n' % path}
+    return {'changed': True, 'diff': ''.join(difflib.unified_diff(
+        stored.splitlines(True), local.splitlines(True),
+        'a' + path, 'b' + path
+    ))}
+
+
+@contextmanager
+def captured_output():
+    """ Capture what is printed while the block runs
+
+    Standard input is replaced too: commands exit with exit(), which
+    closes it.
+
+    Yields:
+        tuple: (stdout, stderr) StringIO objects
+    """
+    stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = StringIO(), StringIO(), StringIO()
+    try:
+        yield sys.stdout, sys.stderr
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+
+
+@contextmanager
+def results_stream():
+    """ Give the results a stream of their own
+
+    git processes write to the standard output (eg. the summary of
+    git commit). While the block runs, the standard output of the
+    process goes to the standard error, and results are written to a
+    copy of the original standard output.
+
+    Yields:
+        file: The stream to write the results to
+    """
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, ValueError):
+        # Not a real file, as when running tests
+        yield sys.stdout
+        return
+    sys.stdout.flush()
+    saved = os.dup(fd)
+    results = os.fdopen(os.dup(fd), 'w')
+    os.dup2(sys.stderr.fileno(), fd)
+    try:
+        yield results
+    finally:
+        results.flush()
+        os.dup2(saved, fd)
+        os.close(saved)
+        results.close()
+
+
+def write_result(out, result):
+    """ Write a result line, and flush it so the caller gets it right away """
+    out.write(json.dumps(result, sort_keys=True, encoding='utf-8') + "\n")
+    out.flush()
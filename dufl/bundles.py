@@ -0,0 +1,158 @@
+""" Sync hosts that can't reach the remote, through git bundles
+
+A bundle is a file containing commits, which can be carried to another
+host and fetched from there. To keep bundles small, the commits each
+target host has acknowledged are recorded (the target's watermark),
+and bundles only contain the commits made since. A bundle created for
+a target that never acknowledged a bundle contains the whole history.
+
+Watermarks only move when the target acknowledges a bundle, so a lost
+bundle is simply included in the next one.
+"""
+import json
+import os
+import tempfile
+
+from .utils import GitError
+
+
+# Name of the bundle watermarks file, within the dufl state folder
+BUNDLES_FILE = 'bundles.json'
+
+
+class BundleBroken(Exception):
+    """ Exception raised when a bundle can't be applied """
+    pass
+
+
+def load_watermarks(state_file):
+    """ Load the bundle watermarks
+
+    Args:
+        state_file (str): Path of the watermarks file
+    Returns:
+        dict: For each target, a dictionary with keys acknowledged
+            (last commit acknowledged by the target, or None) and
+            pending (head of the last bundle created for the target,
+            or None).
+    """
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_watermarks(state_file, watermarks):
+    """ Atomically write the bundle watermarks """
+    folder = os.path.dirname(state_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.bundles-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(watermarks, f, indent=2, sort_keys=True)
+    os.rename(temp_path, state_file)
+
+
+def create_bundle(git, state_file, target, bundle_file, full=False):
+    """ Write a bundle of the commits a target hasn't acknowledged
+
+    Args:
+        git (Git): Git object for the dufl root
+        state_file (str): Path of the watermarks file
+        target (str): Name of the target host
+        bundle_file (str): Path of the bundle to write
+        full (bool): If True, include the whole history regardless of
+            the target's watermark.
+    Returns:
+        tuple: (head commit, number of commits in the bundle, whether
+            the bundle is incremental). The number of commits is 0 if
+            the target is up to date, in which case no bundle is written.
+    """
+    branch = git.working_branch()
+    head = git.get_output('rev-parse', '--verify', branch).strip()
+    watermarks = load_watermarks(state_file)
+    basis = watermarks.get(target, {}).get('acknowledged')
+    # The watermark is useless if the history it is on was rewritten
+    if basis is not None and (full or not git.test(
+            'merge-base', '--is-ancestor', basis, head)):
+        basis = None
+    if basis == head:
+        return head, 0, True
+    revisions = '%s..%s' % (basis, branch) if basis else branch
+    count = int(git.get_output('rev-list', '--count', revisions).strip())
+    git.run('bundle', 'create', '-q', os.path.abspath(bundle_file), revisions)
+    watermarks.setdefault(target, {'acknowledged': None})['pending'] = head
+    save_watermarks(state_file, watermarks)
+    return head, count, basis is not None
+
+
+def acknowledge(state_file, target, commit=None):
+    """ Record that a target applied a bundle
+
+    Args:
+        state_file (str): Path of the watermarks file
+        target (str): Name of the target host
+        commit (str): Commit the target is now at. Defaults to the head
+            of the last bundle created for the target.
+    Returns:
+        str: The acknowledged commit, or None if there was nothing
+            to acknowledge.
+    """
+    watermarks = load_watermarks(state_file)
+    state = watermarks.get(target, {})
+    commit = commit or state.get('pending')
+    if commit is None:
+        return None
+    state['acknowledged'] = commit
+    if state.get('pending') == commit:
+        state['pending'] = None
+    watermarks[target] = state
+    save_watermarks(state_file, watermarks)
+    return commit
+
+
+def apply_bundle(git, bundle_file):
+    """ Verify a bundle, and fast-forward the working branch to it
+
+    Args:
+        git (Git): Git object for the dufl root
+        bundle_file (str): Path of the bundle
+    Returns:
+        tuple: (commit before, commit after), as found in HEAD. The
+            commit before is None if the repository had no commits.
+    Raises:
+        BundleBroken
+    """
+    bundle_file = os.path.abspath(bundle_file)
+    if not git.test('bundle', 'verify', '-q', bundle_file):
+        raise BundleBroken(
+            'The bundle is corrupted, or needs commits this dufl folder '
+            'does not have. Create a full bundle with --full.'
+        )
+    heads = [
+        line.split()[1]
+        for line in git.get_output('bundle', 'list-heads', bundle_file).splitlines()
+        if len(line.split()) == 2 and line.split()[1].startswith('refs/heads/')
+    ]
+    if len(heads) == 0:
+        raise BundleBroken('The bundle does not contain a branch.')
+    try:
+        before = git.get_output('rev-parse', '--verify', '-q', 'HEAD').strip()
+    except GitError:
+        before = None
+    try:
+        git.run('fetch', '-q', bundle_file, heads[0])
+        target = git.get_output('rev-parse', '--verify', 'FETCH_HEAD').strip()
+        if before is None:
+            git.run('reset', '-q', '--hard', target)
+        elif before != target:
+            git.run('merge', '-q', '--ff-only', target)
+        # An older bundle leaves HEAD where it was
+        after = git.get_output('rev-parse', '--verify', 'HEAD').strip()
+    except GitError:
+        raise BundleBroken(
+            'Could not fast-forward to the bundle. Does this dufl folder '
+            'have commits of its own?'
+        )
+    return before, after
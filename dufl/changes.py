@@ -0,0 +1,206 @@
+import errno
+import hashlib
+import json
+import os
+import re
+import stat
+import tempfile
+import time
+
+from . import chunks
+from . import encryption
+from . import throttle
+from .app import get_content_at_modification_time, get_dufl_file_path
+from .app import get_file_system_path, get_git
+from .storage import stored_content_matches
+
+
+# Name of the stat cache, within the dufl state folder
+STAT_CACHE_FILE = 'stat.cache'
+
+# Size of the blocks read when hashing files
+BLOCK_SIZE = 64 * 1024
+
+
+def blob_sha(path, size, context=None):
+    """ Return the git blob sha1 of a file, without running git
+
+    Args:
+        path (str): Path of the file
+        size (int): Size of the file
+        context (dict): The context. If given, reads are throttled
+            by the io_limit setting.
+    Returns:
+        str: Hex sha1, as git would compute it
+    """
+    sha = hashlib.sha1('blob %d\0' % size)
+    with open(path, 'rb') as f:
+        if context is not None:
+            f = throttle.throttled(f, context)
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _content_matches(entry, path, size, context):
+    """ Check whether a file has the content of a tracked entry
+
+    Args:
+        entry (IndexEntry): The tracked entry
+        path (str): File system path of the file
+        size (int): Size of the file
+        context (dict): The context
+    Returns:
+        bool: True if the file has the same content
+    """
+    if size == entry.size and blob_sha(path, size, context) == entry.sha:
+        return True
+    # Files stored as chunks are tracked as a manifest, and encrypted
+    # files record the tag of their content.
+    stored = _stored_head(entry, path, context)
+    if encryption.is_encrypted(stored):
+        cipher = encryption.get_cipher(context)
+        return cipher.content_tag(path) == encryption.header_tag(stored)
+    if not chunks.is_manifest(stored):
+        return False
+    manifest = chunks.parse_manifest(stored)
+    return (
+        size == manifest['size'] and
+        chunks.file_sha256(path) == manifest['sha256']
+    )
+
+
+def _stored_head(entry, path, context):
+    """ Return enough of the stored content of an entry to compare it
+
+    The stored content is read from the dufl working copy. If that is
+    missing (eg. the repository was checked out sparsely), the blob is
+    read from git instead.
+
+    Args:
+        entry (IndexEntry): The tracked entry
+        path (str): File system path of the file
+        context (dict): The context
+    Returns:
+        str: The whole manifest for chunked files, the header for
+            encrypted files, and the first bytes otherwise
+    """
+    try:
+        f = open(get_dufl_file_path(path, context), 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return get_git(context).read_object(entry.sha) or ''
+    with f:
+        stored = f.read(len(chunks.MANIFEST_MAGIC))
+        if encryption.is_encrypted(stored):
+            return stored + f.read(encryption.TAG_SIZE)
+        if chunks.is_manifest(stored):
+            return stored + f.read()
+        return stored
+
+
+def find_changed(context, index, cache_file, selected=None):
+    """ Find the tracked files whose local copy differs from the repository
+
+    Files whose stat data (size, times and inode) matches what was
+    recorded in the stat cache the last time they were found to be
+    unchanged are skipped. Only the other files are hashed. Files
+    modified in the second before the check are not recorded, as they
+    could still change without their modification time changing.
+
+    Args:
+        context (dict): The context
+        index (TrackedIndex): Index of the tracked files
+        cache_file (str): Path of the stat cache. It is updated with
+            the files found to be unchanged.
+        selected (function): If not None, only the file system paths
+            for which this returns True are checked.
+    Returns:
+        tuple: (list of changed file system paths, list of file system
+            paths of tracked files that don't exist locally)
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    new_cache = {}
+    changed = []
+    missing = []
+    racy_after = time.time() - 1
+    for subdir in [context['home_subdir'], context['slash_subdir']]:
+        for entry in index.lookup(re.sub('^/|/$', '', subdir) + '/'):
+            path = get_file_system_path(entry.path, context)
+            if selected is not None and not selected(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                missing.append(path)
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                missing.append(path)
+                continue
+            key = [st.st_size, st.st_mtime, st.st_ctime, st.st_ino, entry.sha]
+            if cache.get(path) == key:
+                new_cache[path] = key
+            elif _content_matches(entry, path, st.st_size, context):
+                if st.st_mtime < racy_after:
+                    new_cache[path] = key
+            else:
+                changed.append(path)
+    _write_cache(cache_file, new_cache)
+    return changed, missing
+
+
+def split_outdated(context, paths):
+    """ Separate local edits from local copies the repository moved past
+
+    A file that differs from HEAD may not have been edited: the
+    repository may have a newer version (eg. brought in by `dufl
+    fetch`) that was not checked out yet. As `dufl checkout` does, a
+    file is taken to be outdated if it was last modified before HEAD
+    was committed, and has the content stored at its modification time.
+
+    Args:
+        context (dict): The context
+        paths (list of str): File system paths of files that differ
+            from HEAD
+    Returns:
+        tuple: (list of paths edited locally, list of outdated paths)
+    Raises:
+        EncryptionKeyMissing
+    """
+    if not paths:
+        return [], []
+    git = get_git(context)
+    head_time = int(git.get_output('log', '-1', '--format=%ct', 'HEAD').strip())
+    edited = []
+    outdated = []
+    for path in paths:
+        if os.path.getmtime(path) >= head_time:
+            edited.append(path)
+            continue
+        stored = get_content_at_modification_time(
+            git, context, path, get_dufl_file_path(path, context)
+        )
+        if stored is not None and stored_content_matches(stored, path, context):
+            outdated.append(path)
+        else:
+            edited.append(path)
+    return edited, outdated
+
+
+def _write_cache(cache_file, cache):
+    """ Atomically write the stat cache """
+    folder = os.path.dirname(cache_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.stat-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.rename(temp_path, cache_file)
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import tempfile
+
+
+# First line of manifest files
+MANIFEST_MAGIC = 'dufl-chunked-v1\n'
+
+# Chunk size bounds. Boundaries are content defined between these,
+# giving chunks of about MIN_CHUNK + 64KB on average.
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+BOUNDARY_MASK = 0xffff0000
+
+# Random values used by the gear rolling hash. These must never change,
+# or existing files would be split differently.
+GEAR = [int(hashlib.md5(str(i)).hexdigest()[:8], 16) for i in range(256)]
+
+# Size of the blocks read from files
+READ_SIZE = 1024 * 1024
+
+
+class ManifestBroken(Exception):
+    """ Exception raised when a manifest can't be parsed """
+    pass
+
+
+def find_boundary(data, start):
+    """ Find the end of the chunk starting at the given position
+
+    Uses a gear rolling hash: a boundary is found when the top bits
+    of the hash are all zero. The hash only depends on the last 32
+    bytes, so boundaries re-synchronize shortly after a change.
+
+    Args:
+        data (bytearray): Data to split
+        start (int): Start of the chunk in data
+    Returns:
+        int: End of the chunk (exclusive), or None if data ends
+            before a boundary is found
+    """
+    end = min(len(data), start + MAX_CHUNK)
+    position = start + MIN_CHUNK - 32
+    if position >= end:
+        return end if end - start == MAX_CHUNK else None
+    h = 0
+    gear = GEAR
+    for c in data[position:end]:
+        position += 1
+        h = ((h << 1) + gear[c]) & 0xffffffff
+        if not h & BOUNDARY_MASK and position - start >= MIN_CHUNK:
+            return position
+    if end - start == MAX_CHUNK:
+        return end
+    return None
+
+
+def iter_chunks(f):
+    """ Split the content of a file into content defined chunks
+
+    Args:
+        f (file): File object opened for reading in binary mode
+    Yields:
+        str: The chunks, in order
+    """
+    data = bytearray()
+    eof = False
+    while True:
+        boundary = find_boundary(data, 0)
+        if boundary is None and not eof:
+            block = f.read(READ_SIZE)
+            if block:
+                data.extend(block)
+            else:
+                eof = True
+            continue
+        if boundary is None:
+            boundary = len(data)
+        if boundary == 0:
+            return
+        yield str(data[:boundary])
+        del data[:boundary]
+
+
+def chunk_path(chunk_root, chunk_id):
+    """ Return the path of a chunk in the chunk store
+
+    Args:
+        chunk_root (str): Folder of the chunk store
+        chunk_id (str): Chunk id (hex sha256 of the content)
+    Returns:
+        str: The path
+    """
+    return os.path.join(chunk_root, chunk_id[:2], chunk_id[2:])
+
+
+def store_chunked(source, dest, chunk_root):
+    """ Store a file as chunks, and write its manifest
+
+    Chunks that are already in the store are not written again. They
+    are still returned, as they may not be tracked yet (eg. when left
+    by an add that failed): git add skips those that are.
+
+    Args:
+        source (str): File to store
+        dest (str): Path of the manifest
+        chunk_root (str): Folder of the chunk store
+    Returns:
+        list of str: The manifest and the chunk files it references
+    """
+    referenced = []
+    seen = set()
+    chunk_lines = []
+    digest = hashlib.sha256()
+    size = 0
+    with open(source, 'rb') as f:
+        for chunk in iter_chunks(f):
+            digest.update(chunk)
+            size += len(chunk)
+            chunk_id = hashlib.sha256(chunk).hexdigest()
+            chunk_lines.append('chunk %s %d\n' % (chunk_id, len(chunk)))
+            path = chunk_path(chunk_root, chunk_id)
+            if path in seen:
+                continue
+            seen.add(path)
+            if not os.path.exists(path):
+                _write_atomic(path, chunk)
+            referenced.append(path)
+    _write_atomic(dest, ''.join(
+        [MANIFEST_MAGIC, 'size %d\n' % size, 'sha256 %s\n' % digest.hexdigest()] +
+        chunk_lines
+    ))
+    return [dest] + referenced
+
+
+def is_manifest(content):
+    """ Check whether some stored content is a manifest
+
+    Args:
+        content (str): The content, or at least its beginning
+    Returns:
+        bool: True if this is a manifest
+    """
+    return content.startswith(MANIFEST_MAGIC)
+
+
+def parse_manifest(content):
+    """ Parse a manifest
+
+    Args:
+        content (str): The manifest content
+    Returns:
+        dict: Dictionary with keys size (int), sha256 (str) and
+            chunks (list of (chunk id, size) tuples)
+    Raises:
+        ManifestBroken
+    """
+    if not is_manifest(content):
+        raise ManifestBroken('Not a manifest.')
+    manifest = {'chunks': []}
+    try:
+        for line in content[len(MANIFEST_MAGIC):].splitlines():
+            parts = line.split()
+            if parts[0] == 'size':
+                manifest['size'] = int(parts[1])
+            elif parts[0] == 'sha256':
+                manifest['sha256'] = parts[1]
+            elif parts[0] == 'chunk':
+                manifest['chunks'].append((parts[1], int(parts[2])))
+    except (IndexError, ValueError):
+        raise ManifestBroken('Could not parse manifest.')
+    if 'size' not in manifest or 'sha256' not in manifest:
+        raise ManifestBroken('Incomplete manifest.')
+    return manifest
+
+
+def assemble(manifest, chunk_root, out):
+    """ Write the content described by a manifest, one chunk at a time
+
+    Args:
+        manifest (dict): Parsed manifest
+        chunk_root (str): Folder of the chunk store
+        out (file): File object to write to
+    Raises:
+        ManifestBroken: If a chunk is missing or corrupted
+    """
+    for chunk_id, size in manifest['chunks']:
+        try:
+            with open(chunk_path(chunk_root, chunk_id), 'rb') as f:
+                chunk = f.read()
+        except IOError:
+            raise ManifestBroken('Missing chunk %s.' % chunk_id)
+        if len(chunk) != size or hashlib.sha256(chunk).hexdigest() != chunk_id:
+            raise ManifestBroken('Corrupted chunk %s.' % chunk_id)
+        out.write(chunk)
+
+
+def file_sha256(path):
+    """ Return the sha256 of a file's content
+
+    Args:
+        path (str): The file
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, content):
+    """ Write a file by renaming a temporary file into place """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.dufl-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, path)
@@ -1,38 +1,169 @@
 import click
+import cProfile
 import os
 import re
-import shutil
+import time
 import yaml
 
+from contextlib import contextmanager
 from datetime import datetime
 
 from . import defaults
-from .app import get_dufl_file_path, create_initial_context
+from . import metrics
+from .app import get_dufl_file_path, create_initial_context, get_git
+from .app import get_file_system_path, get_tracked_index, get_tracked_files
+from .app import get_state_folder, get_content_at_modification_time
 from .app import SettingsBroken
+from .batch import BatchRequestInvalid, captured_output, command_argv, diff
+from .batch import parse_request, results_stream, status, write_result
+from .bundles import BUNDLES_FILE, BundleBroken, acknowledge, apply_bundle
+from .bundles import create_bundle
+from .changes import STAT_CACHE_FILE, find_changed, split_outdated
+from .compact import BACKUP_REF, CompactFailed, compact, parse_policy
+from .complete import completion_script
+from .encryption import DecryptionFailed, EncryptionKeyMissing
+from .encryption import encryption_enabled, get_cipher
+from .ignore import walk
+from .importer import ImportFailed, import_files
+from .index import INDEX_FILE, head_commit
+from .lock import LOCK_FILE, QUEUE_FOLDER, LockTimeout, RootLock, group_commit
+from .maintenance import MAINTENANCE_FILE, maintain, needs_maintenance
+from .maintenance import record_commits, sample_path, time_history_probes
+from .mirror import MirrorsUnreachable, fast_forward, fetch_through_mirrors
+from .mirror import load_state, open_mirror, refresh, start_daemon
+from .plan import WRITE_ACTIONS, PlanBroken, copy_in_parallel, find_drift
+from .plan import load_plan, make_plan, save_plan
+from .privileged import PrivilegedWriter, PrivilegedWriteFailed, needs_privileges
+from .profiles import UnknownProfile, active_profiles, apply_sparse_checkout
+from .profiles import get_selector, profile_paths
+from .profiling import Profiler
+from .restore import RevisionNotFound, resolve_commit, iter_tree_files
+from .restore import compare_entry, entry_mode, restore_entry
+from .restore import write_entry_content
+from .throttle import get_throttle, job_limit, limit_jobs, lower_priority
+from .throttle import throttled
+from .storage import store_file, checkout_mode, copy_file_out
+from .storage import stored_content_matches, write_file_content
+from .transaction import JOURNAL_FILE, Transaction, recover
 from .utils import Git, GitError
 
 
-@click.group('cli', invoke_without_command=True)
+# Number of paths passed to each git add
+ADD_BATCH_SIZE = 500
+
+
+class DuflGroup(click.Group):
+    """ Group recording the outcome of each command in the metrics file """
+    def invoke(self, ctx):
+        start = time.time()
+        success = False
+        try:
+            rv = click.Group.invoke(self, ctx)
+            success = True
+            return rv
+        except SystemExit as e:
+            success = e.code in (0, None)
+            raise
+        finally:
+            if ctx.obj is not None and ctx.obj.get('cached_git') is not None:
+                ctx.obj['cached_git'].close()
+            if ctx.obj is not None and ctx.obj.get('metrics_file'):
+                try:
+                    metrics.write_textfile(
+                        ctx.obj['metrics_file'],
+                        ctx.obj.get('command_label') or ctx.invoked_subcommand or 'cli',
+                        time.time() - start,
+                        success,
+                        ctx.obj['profiler'].counters
+                    )
+                except (IOError, OSError) as e:
+                    # The command's outcome matters more than its metrics
+                    click.echo('Warning: could not update the metrics file %s: %s' % (
+                        ctx.obj['metrics_file'], str(e)
+                    ), err=True)
+
+
+@click.group('cli', cls=DuflGroup, invoke_without_command=True)
 @click.pass_context
 @click.version_option()
 @click.option('-r', '--root', default=None, help='dufl root folder. Defaults to ~/.dufl - Note that if you don\'t use the default, you\'ll need to specify it for every command.')
-def cli(ctx, root):
+@click.option('--profile', 'profile_folder', default=None, envvar='DUFL_PROFILE', help='Write a trace of git calls and time spent to the given folder.')
+@click.option('--profile-python', is_flag=True, default=False, envvar='DUFL_PROFILE_PYTHON', help='With --profile, also write cProfile output for the Python side.')
+@click.option('--metrics-file', default=None, envvar='DUFL_METRICS_FILE', help='Prometheus textfile collector file to update after the command. Overrides the metrics_file setting.')
+@click.option('--nice', is_flag=True, default=False, envvar='DUFL_NICE', help='Run with low CPU and I/O priority, one worker at a time. Same as the nice setting.')
+def cli(ctx, root, profile_folder, profile_python, metrics_file, nice):
     """ General group containing all commands """
+    profiler = Profiler(enabled=profile_folder is not None)
+    if profile_folder is not None:
+        _start_profiling(ctx, profiler, profile_folder, profile_python)
     try:
-        ctx.obj = create_initial_context(root)
+        with profiler.span('settings'):
+            ctx.obj = create_initial_context(root)
     except SettingsBroken as e:
         click.echo(
             'Failed to read the settings file: %s' % str(e),
             err=True
         )
         exit(1)
+    ctx.obj['profiler'] = profiler
+    journal_file = os.path.join(get_state_folder(ctx.obj), JOURNAL_FILE)
+    if os.path.exists(journal_file):
+        # A transactional checkout may still be running
+        with _locked(ctx.obj):
+            recovered = recover(journal_file)
+        if recovered is not None:
+            click.echo('An interrupted checkout was %s.' % recovered, err=True)
+    if metrics_file is not None:
+        ctx.obj['metrics_file'] = metrics_file
+    if nice:
+        ctx.obj['nice'] = True
+    if ctx.obj['nice'] and not lower_priority():
+        click.echo(
+            'Warning: could not lower the I/O priority, only the CPU priority was lowered. '
+            'Install ionice (util-linux) if the ioprio_set syscall is not supported here.',
+            err=True
+        )
+    # Created now, so the threads of worker pools share a single bucket
+    get_throttle(ctx.obj)
+
+
+def _start_profiling(ctx, profiler, folder, python):
+    """ Start profiling, and write the results when the command ends
+
+    Args:
+        ctx: Click context
+        profiler (Profiler): The profiler recording the events
+        folder (str): Folder where the results are written
+        python (bool): If True, also run cProfile
+    """
+    folder = os.path.abspath(folder)
+    python_profile = None
+    if python:
+        python_profile = cProfile.Profile()
+        python_profile.enable()
+
+    def finish():
+        prefix = 'dufl-%s-%s-%d' % (
+            ctx.invoked_subcommand or 'cli',
+            datetime.now().strftime('%Y%m%d%H%M%S'),
+            os.getpid()
+        )
+        files = profiler.write(folder, prefix)
+        if python_profile is not None:
+            python_profile.disable()
+            files.append(os.path.join(folder, prefix + '.prof'))
+            python_profile.dump_stats(files[-1])
+        click.echo('Profile written to %s' % ', '.join(files), err=True)
+
+    ctx.call_on_close(finish)
 
 
 @cli.command('init')
 @click.pass_context
 @click.argument('repository', default='')
 @click.option('--git', default='/usr/bin/git', help='git binary. This will be stored in the settings file.')
-def init(ctx, repository, git):
+@click.option('--mirror', 'mirrors', multiple=True, help='Mirror of the repository to pull from, rather than the repository itself. Can be given several times: mirrors are tried in order, then the repository.')
+def init(ctx, repository, git, mirrors):
     """ Initialize the dufl root folder (must not exist) - by default ~/.dufl """
     dufl_root = ctx.obj['dufl_root']
     if os.path.exists(dufl_root):
@@ -47,22 +178,33 @@ def init(ctx, repository, git):
         os.makedirs(dufl_root, ctx.obj['create_mode'])
 
         click.echo('Initializing git repository...')
-        giti = Git(git, dufl_root)
+        giti = Git(git, dufl_root, profiler=ctx.obj['profiler'])
         giti.run('init')
         if repository != '':
             giti.run('remote', 'add', 'origin', repository)
 
             click.echo('Looking for remote repository...')
-            repo_exists = False
+            source = None
             try:
-                giti.run('ls-remote', repository)
-                repo_exists = True
-            except GitError:
+                source = fetch_through_mirrors(giti, mirrors)
+            except MirrorsUnreachable:
                 pass
 
-            if repo_exists:
-                click.echo('Pulling master branch of %s' % repository)
-                giti.run('pull', 'origin', 'master')
+            if source is not None and giti.test(
+                    'rev-parse', '--verify', '-q', 'refs/remotes/origin/master'):
+                if source == 'origin':
+                    click.echo('Pulling master branch of %s' % repository)
+                else:
+                    click.echo('Pulling master branch of %s through mirror %s' % (repository, source))
+                fast_forward(giti, 'refs/remotes/origin/master')
+                # The settings may define profiles for this host
+                context = create_initial_context(dufl_root)
+                names = active_profiles(context)
+                if names:
+                    click.echo('Materializing profiles %s' % ', '.join(names))
+                    apply_sparse_checkout(giti, context, names)
+                # Build the index now, so shell completion works right away
+                get_tracked_index(context).close()
         else:
             click.echo('No remote specified. You will need to add it manually when you have one.')
 
@@ -96,112 +238,1117 @@ def init(ctx, repository, git):
 
 @cli.command('add')
 @click.pass_context
-@click.argument('file_name')
+@click.argument('file_name', required=False)
 @click.option('--message', '-m', default='Update.', help='Commit message')
-def add(ctx, file_name, message):
-    """ Add and commit a new file """
-    dufl_root = ctx.obj['dufl_root']
-    source = os.path.abspath(file_name)
-    # Security checks!
-    for expr, msg in ctx.obj['suspicious_names'].items():
-        if re.search(expr, source):
-            click.echo('Error! This file won\'t be added because %s' % msg, err=True)
+@click.option('--update', '-u', is_flag=True, default=False, help='Add all the tracked files that changed locally, instead of a given file.')
+@click.option('--encrypt', is_flag=True, default=False, help='Store the files encrypted. Requires the encryption_key_file setting.')
+def add(ctx, file_name, message, update, encrypt):
+    """ Add and commit a new file, or all the files in a folder.
+
+    Folders are walked recursively. Files matched by .duflignore files,
+    files that are not regular files and files larger than the
+    max_file_size setting are skipped. If any file fails the security
+    checks, nothing is added - unless the encryption_key_file setting
+    is set, in which case those files are stored encrypted.
+
+    With --update, all the tracked files whose local copy differs from
+    the repository are added instead. Local copies that were not edited,
+    but are older than the version in the repository, are reported as
+    outdated rather than added.
+    """
+    profiler = ctx.obj['profiler']
+    skipped = {}
+    if update:
+        if file_name is not None:
+            click.echo('Specify either a file name, or --update.', err=True)
             exit(1)
-    if len(ctx.obj['suspicious_content']) > 0:
-        with open(source) as f:
-            data = f.read()
-            for expr, msg in ctx.obj['suspicious_content'].items():
-                if re.search(expr, data):
-                    click.echo(
-                        'Error! This file won\'t be added because %s' % msg,
-                        err=True
-                    )
-                    exit(1)
-    # Go ahead
-    dest = get_dufl_file_path(source, ctx.obj)
-    if not os.path.isdir(os.path.dirname(dest)):
-        os.makedirs(os.path.dirname(dest))
-    shutil.copyfile(source, dest)
-    git = Git(ctx.obj.get('git', '/usr/bin/git'), dufl_root)
-    git.run('add', dest)
-    git.run('commit', '-m', message)
+        with profiler.span('find changes'), _encryption_errors():
+            index = get_tracked_index(ctx.obj)
+            try:
+                sources, missing = find_changed(
+                    ctx.obj, index,
+                    os.path.join(get_state_folder(ctx.obj), STAT_CACHE_FILE),
+                    selected=_get_selector(ctx.obj)
+                )
+            finally:
+                index.close()
+            sources, outdated = split_outdated(ctx.obj, sources)
+        if missing:
+            skipped['missing'] = len(missing)
+        for path in outdated:
+            click.echo('Outdated: %s has a newer version in the repository. Use dufl checkout to update it.' % path)
+        if outdated:
+            skipped['outdated'] = len(outdated)
+        if len(sources) == 0:
+            click.echo('Nothing changed.')
+            return
+        for path in sources:
+            click.echo('Changed: %s' % path)
+    elif file_name is None:
+        click.echo('Nothing to add. Specify a file, or use --update.', err=True)
+        exit(1)
+    else:
+        sources = _collect_sources(ctx.obj, file_name, skipped)
+    encrypted = _check_sources(ctx.obj, sources, encrypt)
+    # Go ahead: the files are committed by whichever dufl add process
+    # holds the lock, along with those of concurrent adds.
+    try:
+        result = group_commit(
+            _root_lock(ctx.obj),
+            os.path.join(get_state_folder(ctx.obj), QUEUE_FOLDER),
+            {'sources': sources, 'message': message, 'encrypt': encrypted},
+            lambda claimed: _process_add_requests(ctx.obj, claimed),
+            lambda results: _after_add_requests(ctx.obj, results)
+        )
+    except LockTimeout as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    if not result['ok']:
+        click.echo('Failed to add %s: %s' % (file_name or 'changed files', result['error']), err=True)
+        exit(1)
+    summary = _summary('Added', sources, result['size'], skipped)
+    if result['group'] > 1:
+        summary += ' in a group commit of %d adds' % result['group']
+    if not result['changed']:
+        click.echo(summary + '. Nothing changed.')
+        return
+    click.echo(summary + '.')
+
+
+def _process_add_requests(context, claimed):
+    """ Copy and commit the files of queued add requests, in a single commit
+
+    Args:
+        context (dict): The context
+        claimed (list of tuple): (request id, request) of the requests
+    Returns:
+        dict: Result of each request, by request id
+    """
+    profiler = context['profiler']
+    results = {}
+    stored = []
+    messages = []
+    for request_id, request in claimed:
+        try:
+            files = []
+            size = 0
+            encrypt = set(_native_path(p) for p in request.get('encrypt', []))
+            for path in request['sources']:
+                path = _native_path(path)
+                with profiler.span('path mapping'):
+                    dest = get_dufl_file_path(path, context)
+                with profiler.span('copy', file=path):
+                    files.extend(store_file(path, dest, context, path in encrypt))
+                    size += os.path.getsize(path)
+        except (IOError, OSError, EncryptionKeyMissing) as e:
+            results[request_id] = {'ok': False, 'error': str(e)}
+            continue
+        profiler.count('bytes_copied', size)
+        stored.extend(files)
+        if request['message'] not in messages:
+            messages.append(request['message'])
+        results[request_id] = {'ok': True, 'size': size}
+    done = [r for r in results.values() if r['ok']]
+    if len(done) == 0:
+        return results
+    message = '; '.join(messages)
+    if len(done) > 1:
+        message += '\n\nGroup commit of %d adds.' % len(done)
+    git = get_git(context)
+    try:
+        for i in range(0, len(stored), ADD_BATCH_SIZE):
+            git.run('add', *_add_options(context) + ['--'] + stored[i:i + ADD_BATCH_SIZE])
+        try:
+            git.run('commit', '-m', message)
+            changed = True
+        except GitError:
+            # Only check why the commit failed when it did, to save a
+            # git process in the common case.
+            if not git.test('diff', '--cached', '--quiet'):
+                raise GitError('git commit failed')
+            changed = False
+    except GitError as e:
+        for result in done:
+            result.update({'ok': False, 'error': str(e) or 'git failed'})
+        return results
+    for result in done:
+        result.update({'changed': changed, 'group': len(done)})
+    return results
+
+
+def _after_add_requests(context, results):
+    """ Run the follow up of a group commit, once its results are recorded """
+    if any(r['ok'] and r['changed'] for r in results.values()):
+        _after_commit(context, get_git(context), 1)
+
+
+def _native_path(path):
+    """ Return a path read from a queued request as a byte string """
+    if not isinstance(path, str):
+        return path.encode('utf-8')
+    return path
+
+
+@cli.command('import')
+@click.pass_context
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--message', '-m', default='Import.', help='Commit message')
+@click.option('--batch-size', default=0, help='Number of files per commit. Defaults to a single commit.')
+def import_files_command(ctx, paths, message, batch_size):
+    """ Add and commit many files or folders at once.
+
+    This is meant for importing an existing collection of files. The
+    same files are added, and the same checks run as for `dufl add`,
+    however the files are streamed to git fast-import rather than
+    copied and added one by one. The working tree of the dufl root is
+    updated at the end.
+    """
+    profiler = ctx.obj['profiler']
+    skipped = {}
+    sources = []
+    seen = set()
+    for file_name in paths:
+        for path in _collect_sources(ctx.obj, file_name, skipped):
+            if path not in seen:
+                seen.add(path)
+                sources.append(path)
+    if len(sources) == 0:
+        click.echo('Nothing to import.')
+        return
+    encrypted = _check_sources(ctx.obj, sources)
+    git = get_git(ctx.obj)
+    with _locked(ctx.obj):
+        try:
+            with profiler.span('import', files=len(sources)), _encryption_errors():
+                commits, size = import_files(
+                    git, ctx.obj, sources, message, batch_size, encrypted
+                )
+        except ImportFailed as e:
+            click.echo(str(e), err=True)
+            exit(1)
+        profiler.count('bytes_copied', size)
+        click.echo('%s in %d commit%s.' % (
+            _summary('Imported', sources, size, skipped),
+            commits, '' if commits == 1 else 's'
+        ))
+        _after_commit(ctx.obj, git, commits)
+
+
+@cli.command('profiles')
+@click.option('--apply', 'apply_profiles', is_flag=True, default=False, help='Materialize only the files of the active profiles in the dufl root.')
+@click.option('--host', default=None, help='Show the profiles of this host rather than the current one.')
+@click.pass_context
+def profiles(ctx, apply_profiles, host):
+    """ Show the profiles active on this host, and the paths they select.
+
+    Profiles are defined by the profiles and hosts settings. With
+    --apply, the dufl root is set up to only contain the files of the
+    active profiles (or all files, if there are none).
+    """
+    names = active_profiles(ctx.obj, host)
+    try:
+        paths = profile_paths(ctx.obj, names)
+    except UnknownProfile as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    if len(names) == 0:
+        click.echo('No active profiles: all files are deployed.')
+    else:
+        click.echo('Active profiles: %s' % ', '.join(names))
+        for path in paths:
+            click.echo('  %s' % path)
+    if apply_profiles:
+        with _locked(ctx.obj):
+            apply_sparse_checkout(get_git(ctx.obj), ctx.obj, names)
+        click.echo('Done.')
+
+
+def _get_selector(context):
+    """ Return the profile selector of this host, exiting on broken settings """
+    try:
+        return get_selector(context)
+    except UnknownProfile as e:
+        click.echo(str(e), err=True)
+        exit(1)
+
+
+def _add_options(context):
+    """ Return the options to pass to git add
+
+    With active profiles, the dufl root may be a sparse checkout, in
+    which case git refuses to add files outside of it unless told to.
+    """
+    if active_profiles(context):
+        return ['--sparse']
+    return []
+
+
+@cli.command('maintain')
+@click.pass_context
+def maintain_command(ctx):
+    """ Speed up the repository as its history grows.
+
+    This writes the commit-graph (with changed-path Bloom filters),
+    packs loose objects and enables the untracked cache. It also runs
+    automatically once the number of commits made by dufl or loose
+    objects crosses the maintain_commits or maintain_loose_objects
+    settings.
+    """
+    git = get_git(ctx.obj)
+    index = get_tracked_index(ctx.obj)
+    try:
+        repo_path = sample_path(index, ctx.obj)
+    finally:
+        index.close()
+    with _locked(ctx.obj):
+        before = time_history_probes(git, repo_path)
+        with ctx.obj['profiler'].span('maintain'):
+            maintain(
+                git, os.path.join(get_state_folder(ctx.obj), MAINTENANCE_FILE),
+                job_limit(ctx.obj)
+            )
+        after = time_history_probes(git, repo_path)
+    click.echo('Done. History probes took %.3fs before maintenance, %.3fs after.' % (
+        before, after
+    ))
+
+
+@cli.command('compact')
+@click.option('--keep', required=True, help='Retention policy: history to keep as it is, optionally followed by the period of the snapshots older commits are squashed into. Eg. 30d (daily snapshots), or 12w:1w. Units are h, d and w.')
+@click.option('--force', is_flag=True, default=False, help='Replace the history kept by a previous compaction.')
+@click.option('--rewrite-published', is_flag=True, default=False, help='Compact commits that are already on the remote. Other hosts must then clone the dufl folder again.')
+@click.pass_context
+def compact_command(ctx, keep, force, rewrite_published):
+    """ Squash old history into periodic snapshot commits.
+
+    Commits older than the retention window are replaced by one commit
+    per period, with the files as they were at the end of the period.
+    More recent commits are kept as they are. This rewrites history:
+    the previous history is kept in refs/dufl/before-compact. If that
+    ref exists from a previous compaction, --force is needed to replace
+    it. Commits that are already on the remote are only compacted with
+    --rewrite-published.
+    """
+    try:
+        retention, period = parse_policy(keep)
+    except ValueError as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    git = get_git(ctx.obj)
+    index = get_tracked_index(ctx.obj)
+    try:
+        repo_path = sample_path(index, ctx.obj)
+    finally:
+        index.close()
+    with _locked(ctx.obj):
+        before_time = time_history_probes(git, repo_path)
+        try:
+            with ctx.obj['profiler'].span('compact'):
+                before, after = compact(
+                    git, git.working_branch(), retention, period, force=force,
+                    rewrite_published=rewrite_published
+                )
+        except CompactFailed as e:
+            click.echo(str(e), err=True)
+            exit(1)
+        if before == after:
+            click.echo('Nothing to compact: %d commits.' % before)
+            return
+        _refresh_index(ctx.obj)
+        # Refresh the commit-graph, which describes the old history
+        with ctx.obj['profiler'].span('maintain'):
+            maintain(
+                git, os.path.join(get_state_folder(ctx.obj), MAINTENANCE_FILE),
+                job_limit(ctx.obj)
+            )
+        after_time = time_history_probes(git, repo_path)
+    click.echo('Compacted %d commits into %d. The previous history is in %s.' % (
+        before, after, BACKUP_REF
+    ))
+    if rewrite_published:
+        click.echo(
+            'Force push the new history with `git push --force origin %s` in '
+            'the dufl folder, and initialize the dufl folder of the other '
+            'hosts again.' % git.working_branch()
+        )
+    click.echo('History probes took %.3fs before compaction, %.3fs after.' % (
+        before_time, after_time
+    ))
+
+
+def _root_lock(context):
+    """ Return the lock of the dufl root """
+    return RootLock(
+        os.path.join(get_state_folder(context), LOCK_FILE),
+        context['lock_timeout']
+    )
+
+
+@contextmanager
+def _locked(context):
+    """ Hold the lock of the dufl root, exiting if it can't be acquired """
+    lock = _root_lock(context)
+    try:
+        lock.acquire()
+    except LockTimeout as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _after_commit(context, git, commits):
+    """ Record commits made by a command, and run maintenance if due
+
+    The commits are done by then, so failures only print a warning.
+    """
+    try:
+        state_file = os.path.join(get_state_folder(context), MAINTENANCE_FILE)
+        state = record_commits(state_file, commits)
+        if needs_maintenance(context, state):
+            click.echo('Running automatic maintenance...')
+            with context['profiler'].span('maintain'):
+                maintain(git, state_file, job_limit(context))
+        _refresh_index(context)
+    except (GitError, IOError, OSError) as e:
+        click.echo('Warning: the commit was made, but maintenance failed: %s' % (
+            str(e) or e.__class__.__name__
+        ), err=True)
+
+
+def _refresh_index(context):
+    """ Bring the tracked file index up to date after HEAD moved
+
+    Shell completion reads the index without running git, so it must
+    not be left describing an older commit. An index that was never
+    built is left for the next command that needs it.
+    """
+    if os.path.isfile(os.path.join(get_state_folder(context), INDEX_FILE)):
+        get_tracked_index(context).close()
+
+
+def _collect_sources(context, file_name, skipped):
+    """ Return the files to add for a file or folder name
+
+    Args:
+        context (dict): The context
+        file_name (str): Name of a file or folder
+        skipped (dict): Number of skipped files per reason, updated
+            with the files skipped in folders.
+    Returns:
+        list of str: Absolute paths of the files to add
+    """
+    source = os.path.abspath(file_name)
+    if not os.path.isdir(source):
+        return [source]
+    sources = []
+    with context['profiler'].span('walk', folder=source):
+        for path, reason in walk(source, context['max_file_size'] or 0,
+                                 exclude=[context['dufl_root']]):
+            if reason is None:
+                sources.append(path)
+            else:
+                skipped[reason] = skipped.get(reason, 0) + 1
+    return sources
+
+
+def _check_sources(context, sources, encrypt_all=False):
+    """ Run the security checks on files
+
+    Files failing the checks are encrypted if an encryption key is
+    configured. Otherwise, this exits.
+
+    Args:
+        context (dict): The context
+        sources (list of str): The files
+        encrypt_all (bool): If True, all the files are encrypted
+    Returns:
+        list of str: The files to store encrypted
+    """
+    rejected = False
+    encrypted = []
+    for path in sources:
+        if encrypt_all:
+            encrypted.append(path)
+            continue
+        msg = _scan_file(context, path)
+        if msg is None:
+            continue
+        if encryption_enabled(context):
+            click.echo('%s will be encrypted because %s' % (path, msg))
+            encrypted.append(path)
+        else:
+            rejected = True
+            if len(sources) == 1:
+                click.echo('Error! This file won\'t be added because %s' % msg, err=True)
+            else:
+                click.echo('Error! %s won\'t be added because %s' % (path, msg), err=True)
+    if rejected:
+        exit(1)
+    if encrypted:
+        # Check the key now, rather than once the lock is held
+        with _encryption_errors():
+            get_cipher(context)
+    return encrypted
+
+
+@contextmanager
+def _encryption_errors():
+    """ Exit when encrypted files can't be encrypted or decrypted """
+    try:
+        yield
+    except (EncryptionKeyMissing, DecryptionFailed) as e:
+        click.echo(str(e), err=True)
+        exit(1)
+
+
+def _summary(action, sources, size, skipped):
+    """ Describe the files added and skipped by a command """
+    summary = '%s %d file%s (%d bytes)' % (
+        action, len(sources), '' if len(sources) == 1 else 's', size
+    )
+    if skipped:
+        summary += ', skipped %d (%s)' % (sum(skipped.values()), ', '.join(
+            '%d %s' % (skipped[r], r) for r in sorted(skipped)
+        ))
+    return summary
+
+
+def _scan_file(context, path):
+    """ Run the security checks on a file
+
+    Args:
+        context (dict): The context
+        path (str): File system path of the file
+    Returns:
+        str: Message explaining why the file is refused, or None
+    """
+    profiler = context['profiler']
+    with profiler.span('scan', file=path):
+        profiler.count('files_scanned')
+        for expr, msg in context['suspicious_names'].items():
+            if re.search(expr, path):
+                profiler.count('rejections', rule=expr)
+                return msg
+        if len(context['suspicious_content']) > 0:
+            with open(path) as f:
+                data = throttled(f, context).read()
+                for expr, msg in context['suspicious_content'].items():
+                    if re.search(expr, data):
+                        profiler.count('rejections', rule=expr)
+                        return msg
+    return None
 
 
 @cli.command('push')
 @click.pass_context
 def push(ctx):
     """ Push the git repo """
-    dufl_root = ctx.obj['dufl_root']
-    git = Git(ctx.obj.get('git', '/usr/bin/git'), dufl_root)
-    git.run('push', 'origin', git.working_branch())
+    git = get_git(ctx.obj)
+    with _locked(ctx.obj):
+        git.run('push', 'origin', git.working_branch())
+
+
+@cli.command('fetch')
+@click.pass_context
+def fetch(ctx):
+    """ Fetch remote commits, and bring the dufl folder up to date.
+
+    The mirrors setting lists mirrors to fetch from, rather than the
+    remote repository. They are tried in order, then the remote. This
+    doesn't change the local file system: use checkout to deploy the
+    new files.
+    """
+    git = get_git(ctx.obj)
+    with _locked(ctx.obj):
+        try:
+            with ctx.obj['profiler'].span('fetch'):
+                source = fetch_through_mirrors(git, ctx.obj['mirrors'])
+        except MirrorsUnreachable as e:
+            click.echo(str(e), err=True)
+            exit(1)
+        branch = 'refs/remotes/origin/%s' % git.working_branch()
+        if not git.test('rev-parse', '--verify', '-q', branch):
+            click.echo('Fetched from %s, which does not have branch %s.' % (source, branch), err=True)
+            exit(1)
+        try:
+            before, after = fast_forward(git, branch)
+        except GitError:
+            click.echo('Could not fast-forward to %s. Does this dufl folder have commits of its own? Push them first.' % branch, err=True)
+            exit(1)
+        if before != after:
+            _refresh_index(ctx.obj)
+    if before == after:
+        click.echo('Fetched from %s. Already up to date.' % source)
+        return
+    click.echo('Fetched from %s. Updated to %s.' % (source, after))
+
+
+def _label_subcommand(ctx):
+    """ Record the full path of a nested command, eg. bundle_create
+
+    This is the command label of the metrics file, so the commands of
+    a group can be told apart.
+    """
+    if ctx.invoked_subcommand is not None:
+        ctx.obj['command_label'] = '%s_%s' % (
+            ctx.info_name, ctx.invoked_subcommand
+        )
+
+
+@cli.group('mirror')
+@click.pass_context
+def mirror(ctx):
+    """ Run a mirror of the remote repository, for hosts to pull from. """
+    _label_subcommand(ctx)
+
+
+@mirror.command('serve')
+@click.argument('path')
+@click.option('--origin', default=None, help='URL of the repository to mirror. Required the first time.')
+@click.option('--interval', default=300, help='Seconds between refreshes from the repository.')
+@click.option('--daemon/--no-daemon', default=True, help='Serve the mirror with git daemon. Use --no-daemon to serve it over ssh or the file system only.')
+@click.option('--port', default=None, type=int, help='Port git daemon listens to. Defaults to 9418.')
+@click.option('--listen', default=None, help='Address git daemon listens to. Defaults to all addresses.')
+@click.option('--once', is_flag=True, default=False, help='Refresh the mirror if it is due, then exit, eg. to refresh from cron.')
+@click.pass_context
+def mirror_serve(ctx, path, origin, interval, daemon, port, listen, once):
+    """ Keep a bare mirror in PATH up to date, and serve it.
+
+    The mirror fetches from the repository every --interval seconds.
+    Hosts use it with the mirrors setting, or the --mirror option of
+    init.
+    """
+    git = Git(ctx.obj['git'], os.path.abspath(path), profiler=ctx.obj['profiler'])
+    try:
+        origin = open_mirror(git, origin)
+    except ValueError as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    if once:
+        try:
+            refreshed = refresh(git, interval)
+        except GitError:
+            click.echo(load_state(git)['last_error'], err=True)
+            exit(1)
+        click.echo('Refreshed %s from %s.' % (path, origin) if refreshed else '%s is up to date.' % path)
+        return
+    process = None
+    if daemon:
+        process = start_daemon(git, port, listen)
+        click.echo('Serving git://<host>%s/%s' % (
+            ':%d' % port if port is not None else '', os.path.basename(git.root)
+        ))
+    try:
+        while True:
+            try:
+                if refresh(git, interval):
+                    click.echo('Refreshed from %s.' % origin)
+            except GitError:
+                click.echo('%s. Serving what the mirror has.' % load_state(git)['last_error'], err=True)
+            if process is not None and process.poll() is not None:
+                click.echo('git daemon exited.', err=True)
+                exit(1)
+            time.sleep(min(interval, 10) or 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process is not None and process.poll() is None:
+            process.terminate()
+            process.wait()
+
+
+@cli.group('bundle')
+@click.pass_context
+def bundle(ctx):
+    """ Sync hosts that can't reach the remote, through bundle files.
+
+    Bundles created for a target host only contain the commits the
+    target hasn't acknowledged.
+    """
+    _label_subcommand(ctx)
+
+
+@bundle.command('create')
+@click.argument('target')
+@click.option('--output', '-o', default=None, help='Bundle file to write. Defaults to <target>.bundle')
+@click.option('--full', is_flag=True, default=False, help='Include the whole history, even if the target acknowledged earlier bundles.')
+@click.pass_context
+def bundle_create(ctx, target, output, full):
+    """ Write a bundle of the commits the target host doesn't have. """
+    output = output or '%s.bundle' % target
+    with _locked(ctx.obj):
+        head, count, incremental = create_bundle(
+            get_git(ctx.obj),
+            os.path.join(get_state_folder(ctx.obj), BUNDLES_FILE),
+            target, output, full
+        )
+    if count == 0:
+        click.echo('%s is up to date, no bundle written.' % target)
+        return
+    click.echo('Wrote %s bundle %s with %d commit%s, up to %s.' % (
+        'incremental' if incremental else 'full', output, count,
+        '' if count == 1 else 's', head
+    ))
+    click.echo('Once applied on %s, run: dufl bundle ack %s' % (target, target))
+
+
+@bundle.command('apply')
+@click.argument('bundle_file')
+@click.pass_context
+def bundle_apply(ctx, bundle_file):
+    """ Verify a bundle, and bring the dufl folder up to date with it.
+
+    This doesn't change the local file system: use checkout to deploy
+    the new files.
+    """
+    with _locked(ctx.obj):
+        try:
+            with ctx.obj['profiler'].span('apply bundle'):
+                before, after = apply_bundle(get_git(ctx.obj), bundle_file)
+        except BundleBroken as e:
+            click.echo(str(e), err=True)
+            exit(1)
+        if before != after:
+            _refresh_index(ctx.obj)
+    if before == after:
+        click.echo('Already up to date.')
+        return
+    click.echo('Updated to %s.' % after)
+    click.echo('To acknowledge, run on the source host: dufl bundle ack <target> %s' % after)
+
+
+@bundle.command('ack')
+@click.argument('target')
+@click.argument('commit', required=False)
+@click.pass_context
+def bundle_ack(ctx, target, commit):
+    """ Record that the target host applied a bundle.
+
+    COMMIT is the commit the target is now at, as output by bundle
+    apply. It defaults to the head of the last bundle created for the
+    target. Next bundles only contain the commits after it.
+    """
+    git = get_git(ctx.obj)
+    if commit is not None:
+        try:
+            commit = git.get_output('rev-parse', '--verify', '%s^{commit}' % commit).strip()
+        except GitError:
+            click.echo('Unknown commit %s.' % commit, err=True)
+            exit(1)
+    with _locked(ctx.obj):
+        commit = acknowledge(
+            os.path.join(get_state_folder(ctx.obj), BUNDLES_FILE), target, commit
+        )
+    if commit is None:
+        click.echo('No bundle was created for %s.' % target, err=True)
+        exit(1)
+    click.echo('%s acknowledged %s.' % (target, commit))
 
 
 @cli.command('checkout')
-@click.argument('file_name')
+@click.argument('file_names', nargs=-1)
+@click.option('--all', 'all_files', is_flag=True, default=False, help='Checkout all the files managed by dufl.')
+@click.option('--transaction', is_flag=True, default=False, help='Write either all the files, or none of them. An interrupted checkout is completed or rolled back on the next dufl invocation. Files needing sudo can not be part of a transaction.')
 @click.pass_context
-def checkout(ctx, file_name):
-    """ Copy the given file from the repository to the local file system.
+def checkout(ctx, file_names, all_files, transaction):
+    """ Copy the given files from the repository to the local file system.
 
     This will attempt to identify local changes, but it's not foolproof,
-    so make sure you know what you are doing.
+    so make sure you know what you are doing. If any of the files looks
+    like it has local changes, none of the files are copied.
     """
-    dufl_root = ctx.obj['dufl_root']
+    profiler = ctx.obj['profiler']
+    if all_files:
+        selected = _get_selector(ctx.obj)
+        file_names = list(file_names) + [
+            f for f in get_tracked_files(ctx.obj) if selected(f)
+        ]
+    if len(file_names) == 0:
+        click.echo('Nothing to checkout. Specify files, or use --all.', err=True)
+        exit(1)
 
-    checked_out_file = os.path.abspath(file_name)
-    dufl_file = get_dufl_file_path(checked_out_file, ctx.obj)
+    git = get_git(ctx.obj)
+    files = []
+    privileged_files = []
+    for file_name in file_names:
+        checked_out_file = os.path.abspath(file_name)
+        with profiler.span('path mapping'):
+            dufl_file = get_dufl_file_path(checked_out_file, ctx.obj)
 
-    if not os.path.exists(dufl_file):
-        click.echo('The file you want to checkout does not exist. Maybe run dufl fetch first?', err=True)
-        exit(1)
+        if not os.path.exists(dufl_file):
+            if not _get_selector(ctx.obj)(checked_out_file):
+                click.echo('The file you want to checkout is not in the active profiles (%s).' % ', '.join(
+                    active_profiles(ctx.obj)
+                ), err=True)
+                exit(1)
+            click.echo('The file you want to checkout does not exist. Maybe run dufl fetch first?', err=True)
+            exit(1)
 
-    if os.path.exists(checked_out_file):
-        # Try our best to see if it's been modified
-        git = Git(ctx.obj.get('git', '/usr/bin/git'), dufl_root)
-        last_modified_ts = os.path.getmtime(checked_out_file)
-        last_modified = datetime.fromtimestamp(
-            last_modified_ts
-        ).strftime('%Y-%m-%d %H:%M:%S')
-        commit_at_date = re.sub('[^a-zA-Z0-9]', '', git.get_output(
-            'rev-list', '-1',
-            '--before=%s' % last_modified,
-            git.working_branch()
-        ))
-        file_exists_at_commit = False
-        if len(commit_at_date) > 0:
-            file_exists_at_commit = git.test(
-                'rev-parse', '--verify',
-                '%s:%s' % (
-                    commit_at_date,
-                    os.path.relpath(dufl_file, dufl_root)
-                )
+        if os.path.exists(checked_out_file):
+            # Try our best to see if it's been modified
+            content_at_date = get_content_at_modification_time(
+                git, ctx.obj, checked_out_file, dufl_file
             )
-        # If there is no commit at date, or the file didnt' exist at the commit,
-        # assume first version of the file ever.
-        if not file_exists_at_commit:
-            commit_at_date = re.sub('[^a-zA-Z0-9]', '', git.get_output(
-                'log', '--diff-filter=A', '--pretty=format:\'%H\'',
-                '--', os.path.relpath(dufl_file, dufl_root)
-            ))
-            if len(commit_at_date) == 0:
+            if content_at_date is None:
                 click.echo('File %s exists, but does not seem to be in the git repository?' % dufl_file, err=True)
                 exit(1)
+            with _encryption_errors():
+                matches = stored_content_matches(content_at_date, checked_out_file, ctx.obj)
+            if not matches:
+                click.echo('It looks like you have local modifications to %s. Will exit for now.' % checked_out_file, err=True)
+                exit(1)
+        if needs_privileges(checked_out_file):
+            privileged_files.append((dufl_file, checked_out_file))
+        else:
+            files.append((dufl_file, checked_out_file))
+    if transaction and privileged_files:
+        click.echo('--transaction can not cover files written with sudo: %s' % ', '.join(
+            f for d, f in privileged_files
+        ), err=True)
+        exit(1)
 
-        # Note: do not be tempted to use 'git show branch@{date}' syntax,
-        # as that relies on the reflog which does not contain all commits.
-        content_at_date = git.get_output(
-            'show',
-            '%s:%s' % (
-                commit_at_date,
-                os.path.relpath(dufl_file, dufl_root)
+    # Files stored encrypted are decrypted as they are copied
+    with _encryption_errors():
+        if transaction:
+            journal = Transaction(
+                os.path.join(get_state_folder(ctx.obj), JOURNAL_FILE)
             )
-        )
-        with open(checked_out_file, 'r') as f:
-            content_now = f.read()
-        if content_at_date != content_now:
-            click.echo('It looks like you have local modifications. Will exit for now.', err=True)
-            exit(1)
+            for dufl_file, checked_out_file in files:
+                click.echo('Copying %s to %s...' % (dufl_file, checked_out_file))
+                journal.add(
+                    checked_out_file,
+                    lambda staged, dufl_file=dufl_file, target=checked_out_file: copy_file_out(
+                        dufl_file, staged, ctx.obj, replaces=target
+                    )
+                )
+            with profiler.span('copy', files=len(files)), _locked(ctx.obj):
+                journal.run()
+        else:
+            for dufl_file, checked_out_file in files:
+                click.echo('Copying %s to %s...' % (dufl_file, checked_out_file))
+                with profiler.span('copy', file=checked_out_file):
+                    if not os.path.exists(os.path.dirname(checked_out_file)):
+                        os.makedirs(os.path.dirname(checked_out_file))
+                    copy_file_out(dufl_file, checked_out_file, ctx.obj)
+        if privileged_files:
+            with _privileged_writer(ctx.obj) as writer:
+                for dufl_file, checked_out_file in privileged_files:
+                    click.echo('Copying %s to %s (with sudo)...' % (dufl_file, checked_out_file))
+                    with profiler.span('copy', file=checked_out_file, sudo=True):
+                        writer.write(
+                            checked_out_file,
+                            lambda out, dufl_file=dufl_file: write_file_content(
+                                dufl_file, out, ctx.obj
+                            ),
+                            mode=_new_file_mode(
+                                checked_out_file, checkout_mode(dufl_file, checked_out_file)
+                            )
+                        )
+    for dufl_file, checked_out_file in files + privileged_files:
+        profiler.count('bytes_copied', os.path.getsize(checked_out_file))
+
+
+def _new_file_mode(path, mode):
+    """ Return the mode to give a file written with sudo
+
+    Existing files keep their mode (system files such as sudoers
+    depend on it), so this is None for them.
+    """
+    if os.path.lexists(path):
+        return None
+    return mode & 0o7777
+
+
+@contextmanager
+def _privileged_writer(context):
+    """ Yield a writer for files needing sudo, and wait for its files
+
+    If the command fails before all the files are sent, none of them
+    are written. Exits if the files can't be written.
+    """
+    writer = PrivilegedWriter(profiler=context['profiler'])
+    try:
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+    except PrivilegedWriteFailed as e:
+        click.echo('Could not write some files with sudo: %s' % str(e), err=True)
+        exit(1)
+
+
+@cli.command('restore')
+@click.option('--at', required=True, help='Revision (commit, tag, etc.) or date to restore, eg. "2016-01-31 10:00" or "3 days ago".')
+@click.option('--dry-run', is_flag=True, default=False, help='Only list the files that would change.')
+@click.pass_context
+def restore(ctx, at, dry_run):
+    """ Restore all the files as they were at a given revision or date.
+
+    This overwrites local modifications, so use --dry-run first to see
+    what would change.
+    """
+    profiler = ctx.obj['profiler']
+    git = get_git(ctx.obj)
+    try:
+        commit = resolve_commit(git, at)
+    except RevisionNotFound as e:
+        click.echo(str(e), err=True)
+        exit(1)
+
+    totals = {}
+    with _privileged_writer(ctx.obj) as writer:
+        with profiler.span('restore', commit=commit), _encryption_errors():
+            selected = _get_selector(ctx.obj)
+            for path, member, source in iter_tree_files(git, commit, ctx.obj):
+                if not selected(path):
+                    continue
+                if source is None:
+                    action = 'skip'
+                elif dry_run:
+                    action = compare_entry(path, member, source, ctx.obj)
+                else:
+                    action = 'update' if os.path.lexists(path) else 'create'
+                    if needs_privileges(path):
+                        mode, source = entry_mode(path, member, source)
+                        writer.write(
+                            path,
+                            lambda out: write_entry_content(source, out, ctx.obj),
+                            mode=_new_file_mode(path, mode)
+                        )
+                    else:
+                        restore_entry(path, member, source, ctx.obj)
+                        profiler.count('bytes_copied', os.path.getsize(path))
+                totals[action] = totals.get(action, 0) + 1
+                if action != 'unchanged':
+                    click.echo('%-9s %s' % (action, path))
+    click.echo('%s files as of commit %s: %s' % (
+        'Would restore' if dry_run else 'Restored',
+        commit,
+        ', '.join('%d %s' % (totals[a], a) for a in sorted(totals)) or 'none'
+    ))
+
+
+@cli.command('plan')
+@click.option('--output', '-o', default='dufl-plan.json', help='Plan file to write.')
+@click.pass_context
+def plan_command(ctx, output):
+    """ Work out what checking out all the files would do.
+
+    For each tracked file, the plan records whether it would be
+    created, updated, left unchanged, or blocked because of local
+    modifications. Use dufl apply to execute the plan.
+    """
+    profiler = ctx.obj['profiler']
+    with profiler.span('plan'), _encryption_errors():
+        index = get_tracked_index(ctx.obj)
+        try:
+            plan = make_plan(
+                ctx.obj, get_git(ctx.obj), index,
+                os.path.join(get_state_folder(ctx.obj), STAT_CACHE_FILE),
+                _get_selector(ctx.obj)
+            )
+        finally:
+            index.close()
+    save_plan(output, plan)
+    totals = {}
+    for f in plan['files']:
+        totals[f['action']] = totals.get(f['action'], 0) + 1
+        if f['action'] != 'unchanged':
+            click.echo('%-9s %s' % (f['action'], f['path']))
+    click.echo('Wrote plan %s at commit %s: %s' % (
+        output, plan['head'],
+        ', '.join('%d %s' % (totals[a], a) for a in sorted(totals)) or 'no files'
+    ))
+
 
-    click.echo('Copying %s to %s...' % (dufl_file, checked_out_file))
-    if not os.path.exists(os.path.dirname(checked_out_file)):
-        os.makedirs(os.path.dirname(checked_out_file))
-    shutil.copy(dufl_file, checked_out_file)
+@cli.command('apply')
+@click.argument('plan_file')
+@click.option('--jobs', '-j', default=4, help='Number of files copied at the same time. Capped by the max_jobs setting.')
+@click.pass_context
+def apply_command(ctx, plan_file, jobs):
+    """ Execute a plan made by dufl plan.
+
+    Only the files the plan creates or updates are written. If any of
+    them changed since the plan was made, or if the repository moved
+    to another commit, nothing is written.
+    """
+    profiler = ctx.obj['profiler']
+    try:
+        plan = load_plan(plan_file)
+    except PlanBroken as e:
+        click.echo(str(e), err=True)
+        exit(1)
+    if plan['head'] != head_commit(get_git(ctx.obj)):
+        click.echo('The repository changed since the plan was made. Make a new plan.', err=True)
+        exit(1)
+    with profiler.span('check drift'):
+        drift = find_drift(plan)
+    if drift:
+        for path in drift:
+            click.echo('Changed since the plan was made: %s' % path, err=True)
+        click.echo('Make a new plan.', err=True)
+        exit(1)
+
+    jobs = limit_jobs(ctx.obj, jobs)
+    paths = [f['path'] for f in plan['files'] if f['action'] in WRITE_ACTIONS]
+    privileged_paths = [p for p in paths if needs_privileges(p)]
+    if privileged_paths:
+        privileged = set(privileged_paths)
+        paths = [p for p in paths if p not in privileged]
+    with _encryption_errors():
+        with profiler.span('copy', files=len(paths), jobs=jobs):
+            errors = copy_in_parallel(ctx.obj, paths, jobs)
+        if privileged_paths:
+            with _privileged_writer(ctx.obj) as writer:
+                for path in privileged_paths:
+                    dufl_file = get_dufl_file_path(path, ctx.obj)
+                    with profiler.span('copy', file=path, sudo=True):
+                        writer.write(
+                            path,
+                            lambda out, dufl_file=dufl_file: write_file_content(
+                                dufl_file, out, ctx.obj
+                            ),
+                            mode=_new_file_mode(path, checkout_mode(dufl_file, path))
+                        )
+    failed = set(path for path, error in errors)
+    for path in paths + privileged_paths:
+        if path not in failed:
+            profiler.count('bytes_copied', os.path.getsize(path))
+    for path, error in errors:
+        click.echo('Could not write %s: %s' % (path, error), err=True)
+    blocked = len([f for f in plan['files'] if f['action'] == 'blocked'])
+    click.echo('Wrote %d of %d files%s.' % (
+        len(paths) + len(privileged_paths) - len(errors),
+        len(paths) + len(privileged_paths),
+        ', skipped %d with local modifications' % blocked if blocked else ''
+    ))
+    if errors:
+        exit(1)
+
+
+@cli.command('batch')
+@click.pass_context
+def batch_command(ctx):
+    """ Run many commands, reading JSON requests from stdin.
+
+    Each line of the input is a request for an add, checkout, status
+    or diff. A JSON result is written on a line of its own as soon as
+    each request is done. The settings and git processes are shared by
+    all the requests.
+    """
+    group = ctx.parent.command
+    git = get_git(ctx.obj)
+    requests = click.get_binary_stream('stdin')
+    with results_stream() as results:
+        # readline doesn't wait for more input than a line, unlike
+        # iterating over the file.
+        for line in iter(requests.readline, ''):
+            if line.strip():
+                git.forget_refs()
+                write_result(results, _run_batch_request(ctx, group, line))
+
+
+def _run_batch_request(ctx, group, line):
+    """ Run a batch request, and return its result """
+    result = {'ok': False, 'output': '', 'error': ''}
+    try:
+        request = parse_request(line)
+    except BatchRequestInvalid as e:
+        result['error'] = str(e)
+        return result
+    result.update(id=request.get('id'), command=request['command'])
+    with captured_output() as (out, err):
+        try:
+            if request['command'] == 'status':
+                with _encryption_errors():
+                    result.update(status(
+                        ctx.obj, request.get('files'), _get_selector(ctx.obj)
+                    ))
+            elif request['command'] == 'diff':
+                with _encryption_errors():
+                    result.update(diff(ctx.obj, request.get('file') or ''))
+            else:
+                argv = command_argv(request)
+                command = group.get_command(ctx, argv[0])
+                with command.make_context(argv[0], argv[1:], parent=ctx) as sub_ctx:
+                    command.invoke(sub_ctx)
+            result['ok'] = True
+        except SystemExit as e:
+            result['ok'] = e.code in (0, None)
+        except click.ClickException as e:
+            err.write(e.format_message())
+        except Exception as e:
+            # A failed request must not stop the others
+            err.write(str(e) or e.__class__.__name__)
+    result['output'] = out.getvalue().decode('utf-8', 'replace')
+    result['error'] = err.getvalue().decode('utf-8', 'replace')
+    return result
+
+
+@cli.command('completion')
+@click.argument('shell', type=click.Choice(['bash', 'zsh']))
+@click.pass_context
+def completion(ctx, shell):
+    """ Output the shell completion script for bash or zsh.
+
+    Completion of tracked paths (for checkout and ls) uses the list of
+    tracked files as of the last dufl command, so it stays fast.
+    """
+    click.echo(completion_script(shell, cli.commands.keys()), nl=False)
+
+
+@cli.command('ls')
+@click.argument('prefix', default='')
+@click.option('--long', '-l', 'long_format', is_flag=True, default=False, help='Also show the mode, size and blob of each file.')
+@click.pass_context
+def ls(ctx, prefix, long_format):
+    """ List the files managed by dufl, optionally only those under the given path """
+    if prefix == '':
+        prefixes = [
+            re.sub('^/|/$', '', ctx.obj['home_subdir']) + '/',
+            re.sub('^/|/$', '', ctx.obj['slash_subdir']) + '/'
+        ]
+    else:
+        prefixes = [_repo_prefix(prefix, ctx.obj)]
+    index = get_tracked_index(ctx.obj)
+    try:
+        for repo_prefix in prefixes:
+            for entry in index.lookup(repo_prefix):
+                path = get_file_system_path(entry.path, ctx.obj)
+                if path is None:
+                    continue
+                if long_format:
+                    click.echo('%06o %10d %s %s' % (
+                        entry.mode, entry.size, entry.sha, path
+                    ))
+                else:
+                    click.echo(path)
+    finally:
+        index.close()
+
+
+def _repo_prefix(prefix, context):
+    """ Return the repository path prefix matching a file system path prefix
+
+    Args:
+        prefix (str): File system path prefix. If this is a folder, or
+            ends with a slash, only files within that folder match.
+        context (dict): The context
+    Returns:
+        str: Repository path prefix
+    """
+    path = os.path.abspath(prefix)
+    if prefix.endswith('/') or os.path.isdir(path):
+        # Map a file within the folder, so the home folder itself
+        # maps to the home subdir.
+        return os.path.relpath(get_dufl_file_path(
+            os.path.join(path, 'x'), context
+        ), context['dufl_root'])[:-1]
+    return os.path.relpath(
+        get_dufl_file_path(path, context), context['dufl_root']
+    )
@@ -0,0 +1,256 @@
+""" Squash old history into periodic snapshots
+
+Every `dufl add` is a commit, so dufl folders updated by cron jobs
+accumulate many small commits, which every history walk pays for.
+Compaction rewrites the history of the working branch: commits older
+than a retention window are replaced by one snapshot commit per period
+(eg. one per day), with the files as they were at the end of the
+period and the dates of the last commit of the period. Recent commits
+are kept as they are, with the same trees, so blobs, paths and dates -
+and the lookups by modification time done by `dufl checkout` - are
+unchanged for recent history.
+
+The whole history is read from a single `git log` and written back
+through a single `git fast-import`. The previous head is kept in
+BACKUP_REF, so nothing is lost until that ref is deleted. An existing
+backup is only replaced when asked to, as is history that was already
+pushed to (or fetched from) the remote: other hosts would have to
+clone the dufl folder again.
+"""
+import re
+import time
+
+from .importer import quote_path
+
+
+# Ref pointing to the head of the branch before the last compaction
+BACKUP_REF = 'refs/dufl/before-compact'
+
+# Ref the compacted history is written to, before replacing the branch
+WORK_REF = 'refs/dufl/compact'
+
+# Seconds per unit of the retention policy
+POLICY_UNITS = {'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+# Empty file mode, as found in raw diffs for deleted files
+NO_MODE = '000000'
+
+
+class CompactFailed(Exception):
+    """ Exception raised when the compacted history can't be written """
+    pass
+
+
+class BackupExists(CompactFailed):
+    """ Exception raised when the backup of a previous compaction exists """
+    pass
+
+
+class HistoryPublished(CompactFailed):
+    """ Exception raised when the commits to compact are on the remote """
+    pass
+
+
+def parse_policy(policy):
+    """ Parse a retention policy
+
+    The policy is a retention window, optionally followed by the period
+    of the snapshots older commits are squashed into, eg. '30d' (keep 30
+    days, then one snapshot per day) or '12w:1w' (keep 12 weeks, then
+    one snapshot per week). Units are h (hours), d (days), w (weeks).
+
+    Args:
+        policy (str): The policy
+    Returns:
+        tuple: (retention, period) in seconds
+    Raises:
+        ValueError: If the policy can't be parsed
+    """
+    match = re.match('^(\d+)([hdw])(?::(\d+)([hdw]))?$', policy.strip())
+    if not match:
+        raise ValueError(
+            'Invalid retention policy %s. Use eg. 30d, or 12w:1w for '
+            'weekly snapshots.' % policy
+        )
+    retention = int(match.group(1)) * POLICY_UNITS[match.group(2)]
+    period = 86400
+    if match.group(3) is not None:
+        period = int(match.group(3)) * POLICY_UNITS[match.group(4)]
+    if period <= 0:
+        raise ValueError('The snapshot period of %s must not be empty.' % policy)
+    return retention, period
+
+
+def iter_commits(git, branch):
+    """ Yield the commits of a branch, oldest first, with their changes
+
+    Only first parents are followed, and merges are shown as their
+    changes against their first parent.
+
+    Args:
+        git (Git): Git object for the dufl root
+        branch (str): The branch
+    Yields:
+        dict: Dictionary with keys sha, author and committer (as found in
+            commit objects), time (committer timestamp), message, and
+            changes (list of (mode, sha, path), with mode NO_MODE for
+            deleted paths).
+    """
+    records = git.iter_records(
+        'log', '--first-parent', '-m', '--reverse', '--no-renames', '--raw',
+        '--root', '--no-abbrev', '-z', '--date=raw',
+        '--format=commit %H%n%an <%ae> %ad%n%cn <%ce> %cd%n%B', branch,
+        separator="\0"
+    )
+    commit = None
+    change = None
+    for record in records:
+        if change is not None:
+            commit['changes'].append(change + (record,))
+            change = None
+            continue
+        record = record.lstrip("\n")
+        if record.startswith(':'):
+            # :<old mode> <new mode> <old sha> <new sha> <status>
+            fields = record[1:].split(' ')
+            change = (fields[1], fields[3])
+            continue
+        if not record.startswith('commit '):
+            continue
+        if commit is not None:
+            yield commit
+        header, author, committer, message = record.split("\n", 3)
+        commit = {
+            'author': author,
+            'committer': committer,
+            'time': int(committer.rsplit(' ', 2)[1]),
+            'message': message,
+            'sha': header[len('commit '):],
+            'changes': []
+        }
+    if commit is not None:
+        yield commit
+
+
+def _write_commit(out, author, committer, message, changes):
+    """ Write a fast-import commit, with the changes from the previous one """
+    out.write('commit %s\n' % WORK_REF)
+    out.write('author %s\n' % author)
+    out.write('committer %s\n' % committer)
+    out.write('data %d\n%s\n' % (len(message), message))
+    for path, (mode, sha) in sorted(changes.items()):
+        if mode == NO_MODE:
+            out.write('D %s\n' % quote_path(path))
+        else:
+            out.write('M %s %s %s\n' % (mode, sha, quote_path(path)))
+    out.write("\n")
+
+
+def compact(git, branch, retention, period, now=None, force=False,
+            rewrite_published=False, remote='origin'):
+    """ Squash the commits older than the retention window into snapshots
+
+    Args:
+        git (Git): Git object for the dufl root
+        branch (str): The branch to compact
+        retention (int): Seconds of history to keep as it is
+        period (int): Seconds covered by each snapshot
+        now (float): Current timestamp. Defaults to the current time.
+        force (bool): If True, replace the backup of a previous
+            compaction. Otherwise, refuse to run if there is one.
+        rewrite_published (bool): If True, compact commits that are on
+            the remote's tracking branch. Otherwise, refuse to.
+        remote (str): Name of the remote
+    Returns:
+        tuple: (number of commits before, number of commits after). The
+            history is left as it is if the numbers are equal.
+    Raises:
+        BackupExists: If BACKUP_REF exists, and force is False
+        HistoryPublished: If commits that would be rewritten are on the
+            remote's tracking branch, and rewrite_published is False.
+            The branch is left as it is.
+        CompactFailed: If the compacted history doesn't end with the
+            same files as the branch. The branch is left as it is.
+    """
+    if not force and git.test('rev-parse', '--verify', '--quiet', BACKUP_REF):
+        raise BackupExists(
+            'The history before the previous compaction is still in %s. '
+            'Delete it with `git update-ref -d %s` in the dufl folder, or '
+            'use --force to replace it.' % (BACKUP_REF, BACKUP_REF)
+        )
+    cutoff = (now or time.time()) - retention
+    head = git.get_output('rev-parse', '--verify', branch).strip()
+    before = 0
+    after = 0
+    pending = None
+    # Oldest commit that gets squashed. It and all the commits after it
+    # get new ids.
+    rewritten = None
+    git.run('update-ref', '-d', WORK_REF)
+    with git.feed('fast-import', '--quiet', '--done', '--force') as out:
+        recent = False
+        for commit in iter_commits(git, branch):
+            before += 1
+            # Once a recent commit is found, all the following ones are
+            # kept, even if their dates go back in time.
+            recent = recent or commit['time'] >= cutoff
+            window = None if recent else commit['time'] // period
+            if pending is not None and pending['window'] != window:
+                _flush(out, pending)
+                after += 1
+                pending = None
+            if pending is None:
+                pending = {'window': window, 'commits': [], 'changes': {}}
+            if rewritten is None and pending['commits']:
+                rewritten = pending['commits'][0]['sha']
+            pending['commits'].append(commit)
+            for mode, sha, path in commit['changes']:
+                pending['changes'][path] = (mode, sha)
+            if recent:
+                _flush(out, pending)
+                after += 1
+                pending = None
+        if pending is not None:
+            _flush(out, pending)
+            after += 1
+        out.write("done\n")
+    if before == after:
+        git.run('update-ref', '-d', WORK_REF)
+        return before, after
+    tracking = 'refs/remotes/%s/%s' % (remote, branch)
+    if (not rewrite_published and
+            git.test('rev-parse', '--verify', '--quiet', tracking) and
+            git.test('merge-base', '--is-ancestor', rewritten, tracking)):
+        git.run('update-ref', '-d', WORK_REF)
+        raise HistoryPublished(
+            'The commits to compact are already on %s/%s. Compacting them '
+            'means force pushing, and cloning the dufl folder again on the '
+            'other hosts: use --rewrite-published to do it anyway (see the '
+            'README).' % (remote, branch)
+        )
+    compacted = git.get_output('rev-parse', '--verify', WORK_REF).strip()
+    if (git.get_output('rev-parse', compacted + '^{tree}') !=
+            git.get_output('rev-parse', head + '^{tree}')):
+        git.run('update-ref', '-d', WORK_REF)
+        raise CompactFailed('The compacted history does not have the same files as %s.' % branch)
+    git.run('update-ref', BACKUP_REF, head)
+    git.run(
+        'update-ref', '-m', 'dufl compact',
+        'refs/heads/%s' % branch, compacted, head
+    )
+    git.run('update-ref', '-d', WORK_REF)
+    return before, after
+
+
+def _flush(out, pending):
+    """ Write the commit, or the snapshot, for a group of commits """
+    commits = pending['commits']
+    last = commits[-1]
+    message = last['message']
+    if len(commits) > 1:
+        message = 'Snapshot of %d commits, from %s to %s.\n' % (
+            len(commits),
+            time.strftime('%Y-%m-%d %H:%M', time.gmtime(commits[0]['time'])),
+            time.strftime('%Y-%m-%d %H:%M', time.gmtime(last['time']))
+        )
+    _write_commit(out, last['author'], last['committer'], message, pending['changes'])
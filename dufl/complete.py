@@ -0,0 +1,164 @@
+""" Fast shell completion of tracked paths
+
+Completion must answer in a few tens of milliseconds, so this is run
+as `python -m dufl.complete` rather than through the dufl command: it
+doesn't import click or yaml, doesn't read the settings and doesn't
+run git. Paths are read from the tracked file index of the dufl root,
+which dufl commands refresh whenever they move HEAD.
+
+Like file name completion, only the next path component is completed:
+completing ~/.con lists ~/.config/ rather than every file under it.
+"""
+import os
+import sys
+
+from . import defaults
+from .index import INDEX_FILE, IndexBroken, TrackedIndex
+
+
+BASH_SCRIPT = r'''# bash completion for dufl. Generated by `dufl completion bash`.
+_dufl() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" command= root= i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -r|--root) root="${COMP_WORDS[i+1]}"; i=$((i + 1));;
+            -*) ;;
+            *) [ -z "$command" ] && command="${COMP_WORDS[i]}";;
+        esac
+    done
+    case "$command" in
+        '')
+            COMPREPLY=($(compgen -W "%(commands)s" -- "$cur"));;
+        %(path_commands)s)
+            local IFS=$'\n'
+            COMPREPLY=($(%(python)s -m dufl.complete ${root:+--root "$root"} -- "$cur"))
+            if [ ${#COMPREPLY[@]} -eq 1 ] && [ "${COMPREPLY[0]%%/}" != "${COMPREPLY[0]}" ]; then
+                compopt -o nospace
+            fi;;
+        *)
+            COMPREPLY=($(compgen -f -- "$cur"));;
+    esac
+}
+complete -F _dufl dufl
+'''
+
+ZSH_SCRIPT = r'''#compdef dufl
+# zsh completion for dufl. Generated by `dufl completion zsh`.
+_dufl() {
+    local command root i
+    local -a paths
+    for ((i = 2; i < CURRENT; i++)); do
+        case "${words[i]}" in
+            -r|--root) root="${words[i+1]}"; ((i++));;
+            -*) ;;
+            *) [[ -z "$command" ]] && command="${words[i]}";;
+        esac
+    done
+    case "$command" in
+        '')
+            compadd -- %(commands)s;;
+        %(path_commands)s)
+            paths=("${(@f)$(%(python)s -m dufl.complete ${root:+--root "$root"} -- "${words[CURRENT]}")}")
+            compadd -U -Q -S '' -- ${(M)paths:#*/}
+            compadd -U -Q -- ${paths:#*/};;
+        *)
+            _files;;
+    esac
+}
+compdef _dufl dufl
+'''
+
+# Commands whose arguments are tracked paths
+PATH_COMMANDS = ['checkout', 'ls']
+
+
+def completion_script(shell, commands, python=None):
+    """ Return the completion script for a shell
+
+    Args:
+        shell (str): 'bash' or 'zsh'
+        commands (list of str): Names of the dufl commands
+        python (str): Python interpreter able to import dufl. Defaults
+            to the current one.
+    Returns:
+        str: The script
+    """
+    template = {'bash': BASH_SCRIPT, 'zsh': ZSH_SCRIPT}[shell]
+    return template % {
+        'commands': ' '.join(sorted(commands)),
+        'path_commands': '|'.join(PATH_COMMANDS),
+        'python': python or sys.executable
+    }
+
+
+def complete(index, prefix, home=None, cwd=None):
+    """ Return the completions of a partial file system path
+
+    Args:
+        index (TrackedIndex): Index of the tracked files
+        prefix (str): What was typed so far. May be relative, or start
+            with ~.
+        home (str): Home folder. Defaults to the current user's.
+        cwd (str): Current folder. Defaults to the current folder.
+    Returns:
+        list of str: Completions, in the form they were typed in. Folders
+            end with a /.
+    """
+    home = (home or os.path.expanduser('~')).rstrip('/')
+    expanded = prefix
+    if prefix == '~' or prefix.startswith('~/'):
+        expanded = home + prefix[1:]
+    absolute = os.path.join(cwd or os.getcwd(), expanded)
+    if absolute.endswith('/'):
+        absolute = os.path.normpath(absolute).rstrip('/') + '/'
+    else:
+        absolute = os.path.normpath(absolute)
+    if absolute == home or absolute.startswith(home + '/'):
+        repo_prefix = defaults.home_subdir + absolute[len(home):]
+    else:
+        repo_prefix = defaults.slash_subdir + absolute
+    completions = []
+    i = index.bisect(repo_prefix)
+    while i < len(index):
+        path = index.path(i)
+        if not path.startswith(repo_prefix):
+            break
+        rest = path[len(repo_prefix):]
+        slash = rest.find('/')
+        if slash == -1:
+            completions.append(prefix + rest)
+            i += 1
+        else:
+            completions.append(prefix + rest[:slash + 1])
+            # Skip the rest of the folder: '0' sorts right after '/'
+            i = index.bisect(repo_prefix + rest[:slash] + '0')
+    return completions
+
+
+def main(argv=None):
+    """ Print the completions of a partial path, one per line
+
+    Usage: python -m dufl.complete [--root ROOT] [--] PREFIX
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    root = os.path.expanduser('~/.dufl')
+    if len(argv) >= 2 and argv[0] in ('-r', '--root'):
+        root = os.path.expanduser(argv[1])
+        argv = argv[2:]
+    if len(argv) > 0 and argv[0] == '--':
+        argv = argv[1:]
+    prefix = argv[0] if argv else ''
+    try:
+        index = TrackedIndex(os.path.join(root, defaults.state_folder, INDEX_FILE))
+    except IndexBroken:
+        return
+    try:
+        completions = complete(index, prefix)
+    finally:
+        index.close()
+    if completions:
+        sys.stdout.write("\n".join(completions) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
+import os
+
+
+# Layout of the dufl root. These are not settings, but live here so the
+# modules that can't import yaml (see complete) share them with app.
+home_subdir = 'home'
+slash_subdir = 'root'
+state_folder = os.path.join('.git', 'dufl')
+
 # Default values for settings.yaml. This also defines the keys allowed in the settings file.
 settings = {
     'git': '/usr/bin/git',
@@ -6,5 +15,18 @@ settings = {
     },
     'suspicious_content': {
         '-BEGIN .+ PRIVATE KEY-': 'this looks like a private key'
-    }
+    },
+    'metrics_file': None,
+    'chunk_threshold': 0,
+    'max_file_size': 0,
+    'maintain_commits': 500,
+    'maintain_loose_objects': 2000,
+    'lock_timeout': 60,
+    'encryption_key_file': None,
+    'nice': False,
+    'io_limit': 0,
+    'max_jobs': 0,
+    'mirrors': [],
+    'profiles': {},
+    'hosts': {}
 }
@@ -0,0 +1,321 @@
+""" Deterministic encryption of sensitive files
+
+Files are encrypted so that the same content always gives the same
+encrypted file: re-adding an unchanged file stores nothing new, and
+git can still deduplicate and delta compress encrypted files.
+
+Content is split into content defined chunks (see `chunks`), and each
+chunk is encrypted on its own with AES-SIV (RFC 5297), a deterministic
+authenticated encryption mode. Keys are derived from the configured
+key with `derive_key`: HMAC-SHA256(key, 'dufl ' + purpose):
+
+- The AES-SIV key (512 bits) is the 'chunk authentication' derived key
+  followed by the 'encryption' derived key;
+- The mac key, used for the tag of the whole content, is the
+  'authentication' derived key. That tag is HMAC-SHA256(mac key,
+  content).
+
+The encrypted file starts with ENCRYPTED_MAGIC and the tag of the whole
+content, followed by one frame per chunk: the chunk's synthetic IV
+(which authenticates it), its size as a 4 byte big endian integer, and
+the encrypted chunk. The whole content tag is checked once all the
+chunks are decrypted, which detects removed or re-ordered chunks. It
+also tells whether a local file has the content of an encrypted file
+without decrypting it. The test suite pins the format with known
+answers, so it can't change by accident.
+
+AES-SIV is provided by pycryptodome, which is an optional dependency:
+install dufl with the `encryption` extra to use encrypted files.
+
+What it doesn't protect, by design:
+
+- As with any deterministic encryption, anyone can tell that two
+  encrypted files (or chunks) have the same content;
+- Chunk boundaries are not keyed, so the number and sizes of the chunks
+  of a file are visible, as is the size of the file;
+- There is no key rotation: changing the key means adding all the
+  encrypted files again.
+
+Use a dedicated tool to encrypt your files instead if this doesn't fit
+your threat model.
+"""
+import hashlib
+import hmac
+import os
+import stat
+import struct
+import tempfile
+
+from . import chunks
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+
+# First line of encrypted files. This has the length of
+# chunks.MANIFEST_MAGIC, so a single read tells them apart.
+ENCRYPTED_MAGIC = 'dufl-encrypt-v1\n'
+
+# Size of content tags
+TAG_SIZE = 32
+
+# Size of the synthetic IV of each chunk
+SIV_SIZE = 16
+
+# Header of each encrypted chunk: its synthetic IV and size
+FRAME_HEADER = struct.Struct('>%dsI' % SIV_SIZE)
+
+# Size of the blocks read when computing the tag of a file
+READ_SIZE = 1024 * 1024
+
+# Mode of decrypted files that don't replace an existing file
+DECRYPTED_FILE_MODE = 0o600
+
+
+class EncryptionKeyMissing(Exception):
+    """ Exception raised when encryption is needed but not available: the
+        key is not configured or can't be read, or pycryptodome is not
+        installed.
+    """
+    pass
+
+
+class DecryptionFailed(Exception):
+    """ Exception raised when encrypted content is corrupted, or was
+        encrypted with a different key.
+    """
+    pass
+
+
+def derive_key(key, purpose):
+    """ Derive the key used for a given purpose from the configured key
+
+    Args:
+        key (str): The configured key
+        purpose (str): What the derived key is used for, eg. 'encryption'
+    Returns:
+        str: The derived key (32 raw bytes)
+    """
+    return hmac.new(key, 'dufl ' + purpose, hashlib.sha256).digest()
+
+
+class Cipher(object):
+    """ Deterministic encryption with a given key
+
+    Args:
+        key (str): The key. Separate keys for authentication and
+            encryption are derived from it.
+    """
+    def __init__(self, key):
+        self.mac_key = derive_key(key, 'authentication')
+        self.siv_key = (
+            derive_key(key, 'chunk authentication') + derive_key(key, 'encryption')
+        )
+
+    def content_tag(self, path):
+        """ Return the tag of a file's whole content
+
+        Args:
+            path (str): Path of the file
+        Returns:
+            str: The tag (raw bytes)
+        """
+        mac = hmac.new(self.mac_key, '', hashlib.sha256)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), ''):
+                mac.update(block)
+        return mac.digest()
+
+    def encrypt(self, source, out, content_tag=None):
+        """ Encrypt a file, one chunk at a time
+
+        Args:
+            source (str): Path of the file to encrypt
+            out (file): File object to write the encrypted file to
+            content_tag (str): Tag of the file's content, if already known
+        """
+        if content_tag is None:
+            content_tag = self.content_tag(source)
+        out.write(ENCRYPTED_MAGIC + content_tag)
+        with open(source, 'rb') as f:
+            for chunk in chunks.iter_chunks(f):
+                siv_cipher = AES.new(self.siv_key, AES.MODE_SIV)
+                encrypted, siv = siv_cipher.encrypt_and_digest(chunk)
+                out.write(FRAME_HEADER.pack(siv, len(chunk)))
+                out.write(encrypted)
+
+    def decrypt(self, f, out):
+        """ Decrypt an encrypted file, one chunk at a time
+
+        Args:
+            f (file): The encrypted file, positioned after ENCRYPTED_MAGIC
+            out (file): File object to write the decrypted content to
+        Raises:
+            DecryptionFailed
+        """
+        content_tag = f.read(TAG_SIZE)
+        if len(content_tag) != TAG_SIZE:
+            raise DecryptionFailed('Truncated encrypted file.')
+        mac = hmac.new(self.mac_key, '', hashlib.sha256)
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if not header:
+                break
+            if len(header) != FRAME_HEADER.size:
+                raise DecryptionFailed('Truncated encrypted file.')
+            siv, size = FRAME_HEADER.unpack(header)
+            encrypted = f.read(size)
+            if len(encrypted) != size:
+                raise DecryptionFailed('Truncated encrypted file.')
+            try:
+                chunk = AES.new(self.siv_key, AES.MODE_SIV).decrypt_and_verify(
+                    encrypted, siv
+                )
+            except ValueError:
+                raise DecryptionFailed(
+                    'Encrypted file is corrupted, or the key is wrong.'
+                )
+            mac.update(chunk)
+            out.write(chunk)
+        if not hmac.compare_digest(mac.digest(), content_tag):
+            raise DecryptionFailed('Encrypted file is corrupted, or the key is wrong.')
+
+
+def is_encrypted(content):
+    """ Check whether some stored content is encrypted
+
+    Args:
+        content (str): The content, or at least its beginning
+    Returns:
+        bool: True if the content is encrypted
+    """
+    return content.startswith(ENCRYPTED_MAGIC)
+
+
+def header_tag(content):
+    """ Return the content tag recorded in encrypted content
+
+    Args:
+        content (str): The encrypted content, or at least its beginning
+    Returns:
+        str: The tag, or None if the content isn't encrypted
+    """
+    end = len(ENCRYPTED_MAGIC) + TAG_SIZE
+    if not is_encrypted(content) or len(content) < end:
+        return None
+    return content[len(ENCRYPTED_MAGIC):end]
+
+
+def stored_tag(path):
+    """ Return the content tag of an encrypted file in the dufl root
+
+    Args:
+        path (str): Path of the file in the dufl root
+    Returns:
+        str: The tag, or None if the file doesn't exist or isn't encrypted
+    """
+    try:
+        with open(path, 'rb') as f:
+            return header_tag(f.read(len(ENCRYPTED_MAGIC) + TAG_SIZE))
+    except IOError:
+        return None
+
+
+def decrypted_file_mode(path):
+    """ Return the mode to give a file decrypted from the dufl root
+
+    Encrypted files don't record the mode of the original file, and
+    usually hold secrets: decrypted files keep the mode of the file
+    they replace, and new files are only readable by their owner.
+
+    Args:
+        path (str): File system path of the decrypted file
+    Returns:
+        int: The mode
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return DECRYPTED_FILE_MODE
+
+
+def encryption_enabled(context):
+    """ Check whether an encryption key is configured
+
+    Args:
+        context (dict): The context
+    Returns:
+        bool: True if the encryption_key_file setting is set
+    """
+    return bool(context.get('encryption_key_file'))
+
+
+def get_cipher(context):
+    """ Return the cipher using the configured key
+
+    The key is read once, and the cipher kept in the context.
+
+    Args:
+        context (dict): The context
+    Returns:
+        Cipher: The cipher
+    Raises:
+        EncryptionKeyMissing
+    """
+    if context.get('cipher') is None:
+        if not encryption_enabled(context):
+            raise EncryptionKeyMissing(
+                'This file is encrypted, but the encryption_key_file setting is not set.'
+            )
+        if AES is None:
+            raise EncryptionKeyMissing(
+                'Encrypted files need pycryptodome. Install it with: pip install pycryptodome'
+            )
+        key_file = os.path.expanduser(context['encryption_key_file'])
+        try:
+            with open(key_file, 'rb') as f:
+                key = f.read()
+        except IOError as e:
+            raise EncryptionKeyMissing('Could not read the encryption key: %s' % str(e))
+        if len(key) < 32:
+            raise EncryptionKeyMissing(
+                'The encryption key in %s is too short: it needs at least 32 bytes.' % key_file
+            )
+        context['cipher'] = Cipher(key)
+    return context['cipher']
+
+
+def store_encrypted(source, dest, cipher):
+    """ Store a file encrypted
+
+    If the stored file already has the content of the source, it is
+    left as it is: the tag recorded in its header maps the content
+    to its existing encryption, so unchanged files are not encrypted
+    again.
+
+    Args:
+        source (str): File to store
+        dest (str): Path of the encrypted file
+        cipher (Cipher): The cipher
+    Returns:
+        list of str: Files written, which should be added to git
+    """
+    content_tag = cipher.content_tag(source)
+    if stored_tag(dest) == content_tag:
+        return [dest]
+    folder = os.path.dirname(dest)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.dufl-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            cipher.encrypt(source, out, content_tag)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, dest)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return [dest]
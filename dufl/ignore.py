@@ -0,0 +1,198 @@
+""" Walk folders for `dufl add`, honouring .duflignore files
+
+.duflignore files follow gitignore semantics: each folder may contain
+one, and its patterns apply to the files below that folder. Within a
+file, blank lines and lines starting with # are ignored, a leading !
+re-includes files excluded by an earlier pattern, a trailing / only
+matches folders, and a pattern containing a / (other than a trailing
+one) is relative to the folder of the .duflignore file. Other patterns
+match a name at any depth. * and ? don't match /, ** matches any number
+of folders. .duflignore files are themselves added, unless one of their
+patterns matches them.
+"""
+import os
+import re
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+IGNORE_FILE = '.duflignore'
+
+
+def _translate(pattern):
+    """ Translate a gitignore glob to a regular expression """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex += '[%s]' % body.replace('\\', '\\\\')
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+class IgnoreRules(object):
+    """ Ordered list of ignore patterns, from one or more .duflignore files
+
+    Args:
+        rules (list): Rules to start with (used to inherit the rules
+            of parent folders)
+    """
+    def __init__(self, rules=None):
+        self.rules = list(rules or [])
+
+    def add_patterns(self, base, lines):
+        """ Add the patterns of a .duflignore file
+
+        Args:
+            base (str): Path of the folder containing the file, relative
+                to the walked folder ('' for the walked folder itself)
+            lines (iterable of str): Lines of the file
+        Returns:
+            IgnoreRules: New rules, with the patterns added
+        """
+        rules = list(self.rules)
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.endswith('\\ '):
+                line = line.rstrip()
+            if line == '' or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            elif line.startswith('\\!') or line.startswith('\\#'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if '/' in line:
+                regex = _translate(line.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + _translate(line)
+            prefix = re.escape(base + '/') if base else ''
+            rules.append((re.compile('^%s%s$' % (prefix, regex)), negate, dir_only))
+        return IgnoreRules(rules)
+
+    def is_ignored(self, path, is_dir):
+        """ Check whether a path is ignored
+
+        Args:
+            path (str): Path relative to the walked folder
+            is_dir (bool): Whether the path is a folder
+        Returns:
+            bool: True if the path is ignored. The last matching
+                pattern wins.
+        """
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+
+def _list_folder(folder):
+    """ List a folder
+
+    scandir gets the type of entries without a stat call on most file
+    systems. Without it, each entry is stat'ed.
+
+    Yields:
+        tuple: (name, path, is_dir). Symbolic links are not folders.
+    """
+    if scandir is not None:
+        for entry in scandir(folder):
+            yield entry.name, entry.path, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            yield name, path, stat.S_ISDIR(os.lstat(path).st_mode)
+
+
+def walk(folder, max_file_size=0, exclude=()):
+    """ Walk a folder for files to add
+
+    Folders that are ignored are not descended into, and symbolic
+    links to folders are not followed. .duflignore files are added like
+    other files (unless they ignore themselves), so the folder keeps its
+    exclusions when checked out on other hosts.
+
+    Args:
+        folder (str): The folder to walk
+        max_file_size (int): Files larger than this many bytes are
+            skipped. 0 for no limit.
+        exclude (list of str): Absolute paths of folders never to
+            descend into (eg. the dufl root)
+    Yields:
+        tuple: (path, reason), where reason is None for files to add,
+            or a string explaining why the file is skipped
+    """
+    folder = os.path.abspath(folder)
+    exclude = set(os.path.abspath(e) for e in exclude)
+    stack = [('', IgnoreRules())]
+    while stack:
+        relative, rules = stack.pop()
+        current = os.path.join(folder, relative) if relative else folder
+        if os.path.isfile(os.path.join(current, IGNORE_FILE)):
+            with open(os.path.join(current, IGNORE_FILE)) as f:
+                rules = rules.add_patterns(relative, f)
+        entries = sorted(_list_folder(current))
+        subfolders = []
+        for name, path, is_dir in entries:
+            relative_path = relative + '/' + name if relative else name
+            if is_dir:
+                if path not in exclude and not rules.is_ignored(relative_path, True):
+                    subfolders.append((relative_path, rules))
+                continue
+            if rules.is_ignored(relative_path, False):
+                yield path, 'ignored'
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                yield path, 'broken link'
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                yield path, 'not a regular file'
+            elif max_file_size > 0 and st.st_size > max_file_size:
+                yield path, 'larger than max_file_size'
+            else:
+                yield path, None
+        stack.extend(reversed(subfolders))
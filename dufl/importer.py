@@ -0,0 +1,203 @@
+""" Import many files at once, by streaming them to git fast-import
+
+Adding files one at a time costs a copy, a git add and a commit per
+file. Here the content of all the files is streamed to a single
+git fast-import process, which writes the objects straight to the
+repository, and the working tree is updated once at the end.
+"""
+import os
+import shutil
+import tempfile
+
+from . import chunks
+from . import encryption
+from . import throttle
+from .app import get_dufl_file_path, get_tracked_index
+from .index import head_commit
+from .storage import get_chunk_root, is_stored_encrypted, needs_chunks
+from .utils import GitError
+
+
+# Hash of the empty tree, used to check out the first commit
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# Size of the blocks copied to git fast-import
+BLOCK_SIZE = 64 * 1024
+
+
+class ImportFailed(Exception):
+    """ Exception raised when the imported files can't be checked out """
+    pass
+
+
+def quote_path(path):
+    """ Quote a path for git fast-import, if needed
+
+    Args:
+        path (str): Repository path
+    Returns:
+        str: The path, quoted C-style if it starts with a double quote
+            or contains a new line.
+    """
+    if not path.startswith('"') and "\n" not in path:
+        return path
+    return '"%s"' % (
+        path.replace('\\', '\\\\').replace('"', '\\"').replace("\n", '\\n')
+    )
+
+
+def _write_data(out, source):
+    """ Write a file as a fast-import data command
+
+    Args:
+        out (file): Input of git fast-import
+        source (str): Path of the file
+    Returns:
+        int: Number of bytes written
+    """
+    with open(source, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        out.write('data %d\n' % size)
+        remaining = size
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise IOError('%s changed while it was being imported' % source)
+            out.write(block)
+            remaining -= len(block)
+    out.write("\n")
+    return size
+
+
+def _write_file(out, context, source, chunk_folder, is_tracked, encrypt=False):
+    """ Write the modify commands needed to store a file
+
+    Files to encrypt (or already stored encrypted) and files needing
+    chunks are stored as `store_file` would. These are produced in
+    chunk_folder, as writing them to the dufl root would prevent the
+    working tree from being updated. Chunks for which is_tracked
+    returns True are not written again.
+
+    Returns:
+        int: Size of the file
+    """
+    dufl_root = context['dufl_root']
+    dest = get_dufl_file_path(source, context)
+    repo_path = os.path.relpath(dest, dufl_root)
+    size = os.path.getsize(source)
+    if encrypt or is_stored_encrypted(dest):
+        encrypted = os.path.join(chunk_folder, 'encrypted')
+        with open(encrypted, 'wb') as f:
+            encryption.get_cipher(context).encrypt(source, f)
+        out.write('M 100644 inline %s\n' % quote_path(repo_path))
+        _write_data(out, encrypted)
+        return size
+    if not needs_chunks(source, context):
+        out.write('M 100644 inline %s\n' % quote_path(repo_path))
+        _write_data(out, source)
+        return size
+    manifest = os.path.join(chunk_folder, 'manifest')
+    stored = chunks.store_chunked(source, manifest, os.path.join(chunk_folder, 'chunks'))
+    out.write('M 100644 inline %s\n' % quote_path(repo_path))
+    _write_data(out, stored[0])
+    chunk_root = get_chunk_root(context)
+    for chunk in stored[1:]:
+        path = os.path.join(
+            chunk_root, os.path.relpath(chunk, os.path.join(chunk_folder, 'chunks'))
+        )
+        chunk_repo_path = os.path.relpath(path, dufl_root)
+        if is_tracked(chunk_repo_path):
+            continue
+        out.write('M 100644 inline %s\n' % quote_path(chunk_repo_path))
+        _write_data(out, chunk)
+    return size
+
+
+def import_files(git, context, sources, message, batch_size=0, encrypt=()):
+    """ Commit files to the dufl root through git fast-import
+
+    The files must have been checked already. The commits are made on
+    the branch of HEAD, and the working tree is then updated to match.
+    Content is fed to git within the io_limit setting.
+
+    Args:
+        git (Git): Git object for the dufl root
+        context (dict): The context
+        sources (list of str): File system paths of the files to import
+        message (str): Commit message
+        batch_size (int): Number of files per commit. 0 to import all
+            the files in a single commit.
+        encrypt (list of str): File system paths of the files to store
+            encrypted.
+    Returns:
+        tuple: (number of commits, number of bytes imported)
+    Raises:
+        ImportFailed: If the working tree can't be updated (eg. an
+            untracked file is in the way). The branch is moved back to
+            where it was.
+    """
+    old_head = head_commit(git)
+    ref = git.get_output('symbolic-ref', '-q', 'HEAD').strip()
+    committer = git.get_output('var', 'GIT_COMMITTER_IDENT').strip()
+    if batch_size <= 0:
+        batch_size = max(len(sources), 1)
+    batches = [
+        sources[i:i + batch_size] for i in range(0, len(sources), batch_size)
+    ]
+    encrypt = set(encrypt)
+    size = 0
+    indexes = []
+    untracked_chunks = []
+
+    def is_tracked(repo_path):
+        # The index is only loaded if there are chunked files
+        if not indexes:
+            indexes.append(get_tracked_index(context))
+        if indexes[0].get(repo_path) is not None:
+            return True
+        path = os.path.join(context['dufl_root'], repo_path)
+        if os.path.exists(path):
+            # Left by a failed add. It is imported, and must make way
+            # for the imported version when the working tree is updated.
+            untracked_chunks.append(path)
+        return False
+
+    chunk_folder = tempfile.mkdtemp(prefix='dufl-import-')
+    try:
+        with git.feed('fast-import', '--quiet', '--done') as feed:
+            out = throttle.throttled(feed, context)
+            for number, batch in enumerate(batches):
+                batch_message = message
+                if len(batches) > 1:
+                    batch_message = '%s (%d/%d)' % (message, number + 1, len(batches))
+                out.write('commit %s\n' % ref)
+                out.write('committer %s\n' % committer)
+                out.write('data %d\n%s\n' % (len(batch_message), batch_message))
+                if number == 0 and old_head is not None:
+                    out.write('from %s\n' % old_head)
+                for source in batch:
+                    size += _write_file(
+                        out, context, source, chunk_folder, is_tracked,
+                        source in encrypt
+                    )
+                out.write("\n")
+            out.write("done\n")
+    finally:
+        for index in indexes:
+            index.close()
+        shutil.rmtree(chunk_folder)
+    for path in set(untracked_chunks):
+        os.unlink(path)
+    try:
+        git.run('read-tree', '-m', '-u', old_head or EMPTY_TREE, 'HEAD')
+    except GitError:
+        # fast-import already moved the branch
+        if old_head is None:
+            git.run('update-ref', '-d', ref)
+        else:
+            git.run('update-ref', '-m', 'dufl import failed', ref, old_head)
+        raise ImportFailed(
+            'Could not update the working tree of the dufl root. Are there '
+            'untracked files in the way? Nothing was imported.'
+        )
+    return len(batches), size
@@ -0,0 +1,303 @@
+import mmap
+import os
+import struct
+import tempfile
+
+from collections import namedtuple
+
+from .utils import GitError
+
+
+# File layout (all integers big endian):
+#
+# - Header: magic, commit the index was built from (raw sha1, zeroes
+#   when the repository has no commit) and number of entries;
+# - Entries, sorted by path: offset and length of the path in the
+#   path table, raw blob sha1, mode and size;
+# - Path table: the concatenated paths.
+#
+# Entries have a fixed size, so the index can be binary searched
+# directly from the mmap'ed file without loading it.
+MAGIC = 'DUFLIDX\x01'
+HEADER = struct.Struct('>8s20sI')
+ENTRY = struct.Struct('>II20sIQ')
+NO_COMMIT = '\x00' * 20
+
+# Name of the index file, within the dufl state folder
+INDEX_FILE = 'tracked.idx'
+
+IndexEntry = namedtuple('IndexEntry', ['path', 'sha', 'mode', 'size'])
+
+
+class IndexBroken(Exception):
+    """ Exception raised when the index file can't be read """
+    pass
+
+
+class TrackedIndex(object):
+    """ Read only access to a tracked file index
+
+    Args:
+        file_name (str): Path to the index file
+    Raises:
+        IndexBroken
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        try:
+            with open(file_name, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            raise IndexBroken('Could not open index file.')
+        if len(self.data) < HEADER.size:
+            raise IndexBroken('Index file is truncated.')
+        magic, head, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise IndexBroken('Not an index file.')
+        if len(self.data) < HEADER.size + self.count * ENTRY.size:
+            raise IndexBroken('Index file is truncated.')
+        self.head = None
+        if head != NO_COMMIT:
+            self.head = head.encode('hex')
+
+    def close(self):
+        """ Release the mmap'ed file """
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def path(self, i):
+        """ Return the path of the i-th entry
+
+        Args:
+            i (int): Entry number
+        Returns:
+            str: Repository path
+        """
+        offset, length = struct.unpack_from(
+            '>II', self.data, HEADER.size + i * ENTRY.size
+        )
+        return self.data[offset:offset + length]
+
+    def entry(self, i):
+        """ Return the i-th entry
+
+        Args:
+            i (int): Entry number
+        Returns:
+            IndexEntry: The entry
+        """
+        offset, length, sha, mode, size = ENTRY.unpack_from(
+            self.data, HEADER.size + i * ENTRY.size
+        )
+        return IndexEntry(
+            self.data[offset:offset + length], sha.encode('hex'), mode, size
+        )
+
+    def bisect(self, path):
+        """ Return the position of the first entry not lower than path
+
+        Args:
+            path (str): Repository path
+        Returns:
+            int: Entry number, or the number of entries if all entries
+                are lower than path.
+        """
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.path(middle) < path:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, path):
+        """ Return the entry for the given path
+
+        Args:
+            path (str): Repository path
+        Returns:
+            IndexEntry: The entry, or None if the path is not tracked
+        """
+        i = self.bisect(path)
+        if i < self.count and self.path(i) == path:
+            return self.entry(i)
+        return None
+
+    def lookup(self, prefix):
+        """ Iterate over the entries whose path starts with prefix
+
+        Args:
+            prefix (str): Path prefix
+        Yields:
+            IndexEntry: Matching entries, in path order
+        """
+        i = self.bisect(prefix)
+        while i < self.count and self.path(i).startswith(prefix):
+            yield self.entry(i)
+            i += 1
+
+
+def write_index(file_name, head, entries):
+    """ Write an index file atomically
+
+    Args:
+        file_name (str): Path to the index file
+        head (str): Hex sha of the commit the entries describe, or None
+        entries (list of IndexEntry): The entries, in any order
+    """
+    entries = sorted(entries, key=lambda e: e.path)
+    paths_offset = HEADER.size + len(entries) * ENTRY.size
+    folder = os.path.dirname(file_name)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_name = tempfile.mkstemp(dir=folder, prefix='.tracked-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(
+                MAGIC, head.decode('hex') if head else NO_COMMIT, len(entries)
+            ))
+            offset = paths_offset
+            for entry in entries:
+                f.write(ENTRY.pack(
+                    offset, len(entry.path), entry.sha.decode('hex'),
+                    entry.mode, entry.size
+                ))
+                offset += len(entry.path)
+            for entry in entries:
+                f.write(entry.path)
+        os.rename(temp_name, file_name)
+    except (OSError, IOError):
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+        raise
+
+
+def _ls_tree(git, *command):
+    """ Run git ls-tree -l -z, and parse its output as it arrives
+
+    Args:
+        git (Git): Git object
+        *command (array of str): Parameters to pass to git ls-tree,
+            after -l -z
+    Returns:
+        list of IndexEntry: The blob entries
+    """
+    entries = []
+    for record in git.iter_records('ls-tree', '-l', '-z', *command, separator='\0'):
+        if not record:
+            continue
+        info, path = record.split('\t', 1)
+        mode, object_type, sha, size = info.split()
+        if object_type != 'blob':
+            continue
+        entries.append(IndexEntry(path, sha, int(mode, 8), int(size)))
+    return entries
+
+
+def _changed_paths(git, old, new):
+    """ Return the paths that differ between two commits
+
+    Args:
+        git (Git): Git object
+        old (str): Hex sha of the old commit
+        new (str): Hex sha of the new commit
+    Returns:
+        tuple: (list of deleted paths, list of added or modified paths)
+    """
+    records = git.iter_records(
+        'diff-tree', '-r', '-z', '--no-renames', '--no-commit-id', old, new,
+        separator='\0'
+    )
+    deleted = []
+    changed = []
+    # Records alternate between the change (ending with its status)
+    # and the path
+    for info in records:
+        path = next(records, None)
+        if path is None:
+            break
+        if info.split()[-1] == 'D':
+            deleted.append(path)
+        else:
+            changed.append(path)
+    return deleted, changed
+
+
+def head_commit(git):
+    """ Return the commit of HEAD
+
+    Args:
+        git (Git): Git object
+    Returns:
+        str: Hex sha of HEAD, or None if there is no commit yet
+    """
+    try:
+        return git.get_output('rev-parse', '--verify', '-q', 'HEAD').strip()
+    except GitError:
+        return None
+
+
+def update_index(git, file_name, head):
+    """ Bring the index file up to date with the given commit
+
+    When the index describes an ancestor (or any other existing commit),
+    only the paths that differ between both trees are queried from git.
+    Otherwise the index is rebuilt from the full tree.
+
+    Args:
+        git (Git): Git object
+        file_name (str): Path to the index file
+        head (str): Hex sha of the commit to index, or None
+    """
+    current = None
+    if os.path.isfile(file_name):
+        try:
+            current = TrackedIndex(file_name)
+        except IndexBroken:
+            current = None
+    if current is not None and current.head == head:
+        current.close()
+        return
+    if head is None:
+        entries = []
+    elif current is None or current.head is None:
+        entries = _ls_tree(git, '-r', head)
+    else:
+        try:
+            deleted, changed = _changed_paths(git, current.head, head)
+        except GitError:
+            deleted, changed = None, None
+        if deleted is None:
+            entries = _ls_tree(git, '-r', head)
+        else:
+            removed = set(deleted + changed)
+            entries = [e for e in current if e.path not in removed]
+            # Keep the command lines at a reasonable length
+            for i in range(0, len(changed), 500):
+                entries += _ls_tree(git, head, '--', *changed[i:i + 500])
+    if current is not None:
+        current.close()
+    write_index(file_name, head, entries)
+
+
+def load_index(git, file_name):
+    """ Return the index of HEAD, updating it if needed
+
+    Args:
+        git (Git): Git object
+        file_name (str): Path to the index file
+    Returns:
+        TrackedIndex: The index
+    """
+    update_index(git, file_name, head_commit(git))
+    return TrackedIndex(file_name)
@@ -0,0 +1,313 @@
+""" Lock the dufl root, and group concurrent adds into a single commit
+
+Commands that modify the dufl root hold an exclusive lock on a file in
+the state folder while they do. `dufl add` doesn't simply wait for the
+lock: it queues its request in a folder next to it. Whichever process
+gets the lock processes all the queued requests at once - in a single
+commit - and writes a result for each. The other processes see their
+result appear, and exit with it.
+
+Queued requests go through three files, named after the request id:
+`<id>.request` while waiting, `<id>.claimed` once a lock holder started
+processing it, and `<id>.result` once done. Claimed requests without a
+result, left by a lock holder that died, are processed again by the
+next one. Results whose process is gone (eg. it timed out waiting for
+them) are removed by the next lock holder.
+"""
+import errno
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+# Name of the lock file, within the dufl state folder
+LOCK_FILE = 'root.lock'
+
+# Name of the add queue folder, within the dufl state folder
+QUEUE_FOLDER = 'add-queue'
+
+# Seconds between checks while waiting for the lock or a result
+POLL_INTERVAL = 0.05
+
+# Once a lock holder claimed a request, the request is waited for up to
+# this many lock timeouts in total
+CLAIMED_TIMEOUT_FACTOR = 4
+
+
+class LockTimeout(Exception):
+    """ Exception raised when the lock could not be acquired in time """
+    pass
+
+
+class RootLock(object):
+    """ Exclusive lock on the dufl root
+
+    Args:
+        lock_file (str): Path of the lock file
+        timeout (float): Seconds to wait for the lock in `acquire`
+    """
+    def __init__(self, lock_file, timeout):
+        self.lock_file = lock_file
+        self.timeout = timeout
+        self.fd = None
+
+    def try_acquire(self):
+        """ Acquire the lock if it is free
+
+        Returns:
+            bool: True if the lock was acquired
+        """
+        folder = os.path.dirname(self.lock_file)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        # Record the holder, to help with diagnostics
+        os.ftruncate(fd, 0)
+        os.write(fd, '%d\n' % os.getpid())
+        self.fd = fd
+        return True
+
+    def acquire(self):
+        """ Acquire the lock, waiting for it for up to timeout seconds
+
+        Raises:
+            LockTimeout
+        """
+        deadline = time.time() + self.timeout
+        while not self.try_acquire():
+            if time.time() >= deadline:
+                raise LockTimeout(self.timeout_message())
+            time.sleep(POLL_INTERVAL)
+
+    def release(self):
+        """ Release the lock """
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def timeout_message(self):
+        """ Describe a timeout waiting for this lock """
+        try:
+            with open(self.lock_file) as f:
+                holder = f.read().strip()
+        except IOError:
+            holder = ''
+        return 'Timed out after %ss waiting for the lock on the dufl root%s.' % (
+            self.timeout, ' (held by process %s)' % holder if holder else ''
+        )
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _write_json(path, data):
+    """ Atomically write a JSON file """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.queue-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_path, path)
+
+
+def enqueue(queue_folder, request):
+    """ Queue a request
+
+    Args:
+        queue_folder (str): The queue folder
+        request (dict): The request
+    Returns:
+        str: The request id. Ids sort in queuing order.
+    """
+    if not os.path.isdir(queue_folder):
+        os.makedirs(queue_folder)
+    request_id = '%017.6f-%d' % (time.time(), os.getpid())
+    _write_json(os.path.join(queue_folder, request_id + '.request'), request)
+    return request_id
+
+
+def claim_pending(queue_folder):
+    """ Claim all the requests waiting to be processed
+
+    This must only be called by the lock holder.
+
+    Results left by processes that are gone are removed.
+
+    Args:
+        queue_folder (str): The queue folder
+    Returns:
+        list of tuple: (request id, request), in queuing order
+    """
+    if not os.path.isdir(queue_folder):
+        return []
+    names = set(os.listdir(queue_folder))
+    claimed = []
+    for name in sorted(names):
+        request_id, extension = os.path.splitext(name)
+        if extension == '.result':
+            if not _is_running(request_id):
+                try:
+                    os.unlink(os.path.join(queue_folder, name))
+                except OSError:
+                    pass
+            continue
+        if extension == '.request':
+            path = os.path.join(queue_folder, name)
+            try:
+                os.rename(path, os.path.join(queue_folder, request_id + '.claimed'))
+            except OSError:
+                # Withdrawn by its process after a timeout
+                continue
+        elif extension != '.claimed' or request_id + '.result' in names:
+            continue
+        try:
+            with open(os.path.join(queue_folder, request_id + '.claimed')) as f:
+                claimed.append((request_id, json.load(f)))
+        except (IOError, ValueError):
+            continue
+    return claimed
+
+
+def _is_running(request_id):
+    """ Check whether the process that queued a request is running """
+    try:
+        os.kill(int(request_id.rsplit('-', 1)[1]), 0)
+    except (IndexError, ValueError):
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def complete(queue_folder, request_id, result):
+    """ Record the result of a claimed request
+
+    Args:
+        queue_folder (str): The queue folder
+        request_id (str): The request id
+        result (dict): The result
+    """
+    _write_json(os.path.join(queue_folder, request_id + '.result'), result)
+    os.unlink(os.path.join(queue_folder, request_id + '.claimed'))
+
+
+def take_result(queue_folder, request_id):
+    """ Return the result of a request, if it is available, and remove it
+
+    Returns:
+        dict: The result, or None
+    """
+    path = os.path.join(queue_folder, request_id + '.result')
+    try:
+        with open(path) as f:
+            result = json.load(f)
+    except IOError:
+        return None
+    os.unlink(path)
+    return result
+
+
+def group_commit(lock, queue_folder, request, process, after=None):
+    """ Queue a request, and wait for it to be processed
+
+    The request is processed either by the process holding the lock,
+    or by this process if it gets the lock first - along with all the
+    other queued requests.
+
+    Args:
+        lock (RootLock): The root lock. Its timeout bounds the time
+            waited for the request to be picked up, and once picked up
+            CLAIMED_TIMEOUT_FACTOR times its timeout bounds the time
+            waited for the result.
+        queue_folder (str): The queue folder
+        request (dict): The request
+        process (function): Function processing requests, invoked with
+            a list of (request id, request) while holding the lock. It
+            must return a dictionary of request id to result. Results
+            are dictionaries with keys ok (bool) and error (message,
+            when not ok), plus anything the caller needs.
+        after (function): Optional function invoked with the results
+            once they are recorded, still holding the lock. Work that
+            must not change the outcome of the requests (eg. maintenance)
+            goes there.
+    Returns:
+        dict: The result of the request
+    Raises:
+        LockTimeout
+    """
+    request_id = enqueue(queue_folder, request)
+    start = time.time()
+    deadline = start + lock.timeout
+    while True:
+        result = take_result(queue_folder, request_id)
+        if result is not None:
+            return result
+        if lock.try_acquire():
+            try:
+                claimed = claim_pending(queue_folder)
+                if claimed:
+                    results = _process_claimed(queue_folder, claimed, process)
+                    if after is not None:
+                        after(results)
+            finally:
+                lock.release()
+            continue
+        if time.time() >= deadline:
+            if deadline > start + lock.timeout:
+                raise LockTimeout(
+                    'Timed out after %ss waiting for the queued add to be committed.' % (
+                        CLAIMED_TIMEOUT_FACTOR * lock.timeout
+                    )
+                )
+            try:
+                os.unlink(os.path.join(queue_folder, request_id + '.request'))
+            except OSError:
+                # Already claimed: the lock holder is committing it now
+                deadline = start + CLAIMED_TIMEOUT_FACTOR * lock.timeout
+                continue
+            raise LockTimeout(lock.timeout_message())
+        time.sleep(POLL_INTERVAL)
+
+
+def _process_claimed(queue_folder, claimed, process):
+    """ Process claimed requests, and record a result for each of them
+
+    Every claimed request gets a result, even if processing fails or
+    is interrupted, so the processes waiting for them don't wait in
+    vain. Interruptions (eg. SystemExit) are raised again once the
+    results are recorded.
+
+    Returns:
+        dict: The recorded results, by request id
+    """
+    interrupted = None
+    try:
+        results = process(claimed)
+        error = 'No result was recorded'
+    except BaseException as e:
+        results = {}
+        error = '%s: %s' % (e.__class__.__name__, e)
+        if not isinstance(e, Exception):
+            interrupted = sys.exc_info()
+    recorded = {}
+    for claimed_id, _ in claimed:
+        recorded[claimed_id] = results.get(
+            claimed_id, {'ok': False, 'error': error}
+        )
+        complete(queue_folder, claimed_id, recorded[claimed_id])
+    if interrupted is not None:
+        raise interrupted[0], interrupted[1], interrupted[2]
+    return recorded
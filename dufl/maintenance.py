@@ -0,0 +1,167 @@
+""" Keep the dufl repository fast as its history grows
+
+Every `dufl add` creates a commit and loose objects. Over time, the
+history walks done by `dufl checkout` (`rev-list --before`, and
+`log --diff-filter=A` on a path) get slower. Maintenance writes the
+commit-graph, with changed-path Bloom filters so path limited walks
+can skip most commits, packs loose objects, and enables the untracked
+cache.
+"""
+import json
+import os
+import re
+import tempfile
+import time
+
+
+# Name of the maintenance state file, within the dufl state folder
+MAINTENANCE_FILE = 'maintenance.json'
+
+
+def estimate_loose_objects(dufl_root):
+    """ Estimate the number of loose objects, without running git
+
+    As `git gc --auto` does, this counts the objects in one of the 256
+    object folders.
+
+    Args:
+        dufl_root (str): The dufl root
+    Returns:
+        int: Estimated number of loose objects
+    """
+    folder = os.path.join(dufl_root, '.git', 'objects', '17')
+    try:
+        return len(os.listdir(folder)) * 256
+    except OSError:
+        return 0
+
+
+def load_state(state_file):
+    """ Load the maintenance state
+
+    Args:
+        state_file (str): Path of the state file
+    Returns:
+        dict: The state. commits is the number of commits made by
+            dufl since the last maintenance, last_run the time of the
+            last maintenance (or None).
+    """
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    return {
+        'commits': state.get('commits', 0),
+        'last_run': state.get('last_run')
+    }
+
+
+def save_state(state_file, state):
+    """ Atomically write the maintenance state """
+    folder = os.path.dirname(state_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.maintenance-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(temp_path, state_file)
+
+
+def record_commits(state_file, count):
+    """ Record commits made by dufl, and return the updated state
+
+    Args:
+        state_file (str): Path of the state file
+        count (int): Number of commits made
+    Returns:
+        dict: The state
+    """
+    state = load_state(state_file)
+    state['commits'] += count
+    save_state(state_file, state)
+    return state
+
+
+def needs_maintenance(context, state):
+    """ Check whether automatic maintenance is due
+
+    Args:
+        context (dict): The context. Uses the maintain_loose_objects
+            and maintain_commits settings (0 to disable each threshold).
+        state (dict): The maintenance state
+    Returns:
+        bool: True if a threshold was crossed
+    """
+    max_commits = context.get('maintain_commits') or 0
+    if max_commits > 0 and state['commits'] >= max_commits:
+        return True
+    max_loose = context.get('maintain_loose_objects') or 0
+    return (
+        max_loose > 0 and
+        estimate_loose_objects(context['dufl_root']) >= max_loose
+    )
+
+
+def maintain(git, state_file, threads=0):
+    """ Run the maintenance tasks
+
+    Args:
+        git (Git): Git object for the dufl root
+        state_file (str): Path of the state file, reset once done
+        threads (int): Number of threads git may use to pack objects.
+            0 lets git decide.
+    """
+    git.run('config', 'core.commitGraph', 'true')
+    git.run('config', 'core.untrackedCache', 'true')
+    git.run('update-index', '--untracked-cache')
+    # Only loose objects are packed (no -a), so this stays cheap
+    if threads > 0:
+        git.run('-c', 'pack.threads=%d' % threads, 'repack', '-d', '-q')
+    else:
+        git.run('repack', '-d', '-q')
+    git.run(
+        'commit-graph', 'write', '--reachable', '--changed-paths',
+        '--split', '--no-progress'
+    )
+    save_state(state_file, {'commits': 0, 'last_run': time.time()})
+
+
+def time_history_probes(git, repo_path=None):
+    """ Time the history walks done by `dufl checkout`
+
+    Args:
+        git (Git): Git object for the dufl root
+        repo_path (str): Path of a tracked file, relative to the dufl
+            root, used for the path limited walk. If None, only the
+            date walk is timed.
+    Returns:
+        float: Seconds spent running the probes
+    """
+    branch = git.working_branch()
+    start = time.time()
+    # These are streamed rather than read with get_output, so they are
+    # never answered from a CachedGit's cache.
+    for line in git.iter_lines('rev-list', '-1', '--before=%s' % time.strftime(
+            '%Y-%m-%d %H:%M:%S'), branch):
+        pass
+    if repo_path is not None:
+        for line in git.iter_lines(
+                'log', '--diff-filter=A', '--format=%H', branch, '--', repo_path):
+            pass
+    return time.time() - start
+
+
+def sample_path(index, context):
+    """ Return a tracked file, to time history probes with
+
+    Args:
+        index (TrackedIndex): Index of the tracked files
+        context (dict): The context
+    Returns:
+        str: Repository path, or None if no file is tracked
+    """
+    for subdir in [context['home_subdir'], context['slash_subdir']]:
+        for entry in index.lookup(re.sub('^/|/$', '', subdir) + '/'):
+            return entry.path
+    return None
@@ -0,0 +1,217 @@
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+
+# Upper bounds of the command duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Metric families written to the textfile: name => (type, help)
+FAMILIES = {
+    'dufl_command_duration_seconds': (
+        'histogram', 'Duration of dufl commands.'
+    ),
+    'dufl_commands_total': (
+        'counter', 'Number of dufl commands run, by result.'
+    ),
+    'dufl_git_processes_total': (
+        'counter', 'Number of git processes spawned by dufl commands.'
+    ),
+    'dufl_bytes_copied_total': (
+        'counter', 'Number of bytes copied by dufl commands.'
+    ),
+    'dufl_files_scanned_total': (
+        'counter', 'Number of files checked by the security rules.'
+    ),
+    'dufl_rejections_total': (
+        'counter', 'Number of files rejected by the security rules, by rule.'
+    ),
+    'dufl_git_cache_hits_total': (
+        'counter', 'Number of git queries answered from the cache, by git command.'
+    ),
+    'dufl_git_cache_misses_total': (
+        'counter', 'Number of cacheable git queries that ran git, by git command.'
+    ),
+    'dufl_last_success_timestamp_seconds': (
+        'gauge', 'Time of the last successful run of dufl commands.'
+    )
+}
+
+# Profiler counters exported to the textfile, and the matching metric
+PROFILER_COUNTERS = {
+    'git_processes': 'dufl_git_processes_total',
+    'bytes_copied': 'dufl_bytes_copied_total',
+    'files_scanned': 'dufl_files_scanned_total',
+    'rejections': 'dufl_rejections_total',
+    'git_cache_hits': 'dufl_git_cache_hits_total',
+    'git_cache_misses': 'dufl_git_cache_misses_total'
+}
+
+SAMPLE_LINE = re.compile(
+    '^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{.*\})?\s+(?P<value>\S+)$'
+)
+
+
+def format_labels(labels):
+    """ Format labels as expected in the Prometheus text format
+
+    Args:
+        labels (list of tuple): List of (name, value) tuples
+    Returns:
+        str: The formatted labels, eg. '{command="add"}', or ''
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"'
+        ).replace("\n", '\\n'))
+        for name, value in labels
+    )
+
+
+def parse_textfile(content):
+    """ Parse the samples of a textfile previously written by dufl
+
+    Args:
+        content (str): The textfile content
+    Returns:
+        dict: Dictionary of (name, labels) to value, where labels is the
+            label string as formatted by format_labels.
+    """
+    samples = {}
+    for line in content.split("\n"):
+        match = SAMPLE_LINE.search(line.strip())
+        if line.startswith('#') or not match:
+            continue
+        try:
+            value = float(match.group('value'))
+        except ValueError:
+            continue
+        samples[(match.group('name'), match.group('labels') or '')] = value
+    return samples
+
+
+def format_textfile(samples):
+    """ Format samples as a textfile
+
+    Args:
+        samples (dict): Dictionary of (name, labels) to value
+    Returns:
+        str: The textfile content
+    """
+    lines = []
+    families = {}
+    for (name, labels), value in samples.items():
+        family = re.sub('_(bucket|sum|count)$', '', name)
+        if family not in FAMILIES:
+            family = name
+        families.setdefault(family, []).append((name, labels, value))
+    for family in sorted(families):
+        if family in FAMILIES:
+            lines.append('# HELP %s %s' % (family, FAMILIES[family][1]))
+            lines.append('# TYPE %s %s' % (family, FAMILIES[family][0]))
+        for name, labels, value in sorted(families[family], key=_sample_order):
+            lines.append('%s%s %s' % (name, labels, repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+
+def _sample_order(sample):
+    """ Sort key keeping histogram buckets in increasing order """
+    name, labels, value = sample
+    le = re.search('[{,]le="([^"]+)"', labels)
+    bound = float('inf')
+    if le:
+        bound = float(le.group(1))
+    return (re.sub('[{,]le="[^"]+"', '', labels), name, bound)
+
+
+def update_samples(samples, command, duration, success, counters, now=None):
+    """ Add the results of one command to a set of samples
+
+    Args:
+        samples (dict): Dictionary of (name, labels) to value. This is
+            modified in place.
+        command (str): Name of the command
+        duration (float): Duration of the command, in seconds
+        success (bool): Whether the command succeeded
+        counters (dict): The profiler counters, as a dictionary of
+            (name, labels) to value.
+        now (float): Current timestamp. Defaults to time.time()
+    """
+    def add(name, labels, value):
+        key = (name, format_labels(labels))
+        samples[key] = samples.get(key, 0) + value
+
+    command_label = [('command', command)]
+    for bound in DURATION_BUCKETS:
+        add(
+            'dufl_command_duration_seconds_bucket',
+            command_label + [('le', repr(float(bound)))],
+            1 if duration <= bound else 0
+        )
+    add(
+        'dufl_command_duration_seconds_bucket',
+        command_label + [('le', '+Inf')], 1
+    )
+    add('dufl_command_duration_seconds_sum', command_label, duration)
+    add('dufl_command_duration_seconds_count', command_label, 1)
+    add('dufl_commands_total', command_label + [
+        ('result', 'success' if success else 'failure')
+    ], 1)
+    for (name, labels), value in counters.items():
+        if name in PROFILER_COUNTERS:
+            add(PROFILER_COUNTERS[name], command_label + list(labels), value)
+    if success:
+        samples[(
+            'dufl_last_success_timestamp_seconds', format_labels(command_label)
+        )] = now or time.time()
+
+
+def write_textfile(path, command, duration, success, counters):
+    """ Update a node_exporter textfile collector file with a command's results
+
+    Previous values are read back from the file, so counters and
+    histograms accumulate across runs. The file is replaced atomically,
+    and updates hold an exclusive lock on `<path>.lock`, so concurrent
+    commands don't lose each other's updates.
+
+    Args:
+        path (str): Path of the .prom file
+        command (str): Name of the command
+        duration (float): Duration of the command, in seconds
+        success (bool): Whether the command succeeded
+        counters (dict): The profiler counters
+    Raises:
+        IOError, OSError: If the file can't be updated
+    """
+    lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        samples = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                samples = parse_textfile(f.read())
+        update_samples(samples, command, duration, success, counters)
+        _write_atomic(path, format_textfile(samples))
+    finally:
+        os.close(lock_fd)
+
+
+def _write_atomic(path, content):
+    """ Replace a file by renaming a temporary file into place """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.dufl-metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except (OSError, IOError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,205 @@
+""" Pull-through mirrors of the remote repository
+
+When many hosts pull from the same remote at once, the remote becomes
+the bottleneck. A mirror is a bare repository, close to the hosts,
+which fetches from the remote at regular intervals. Hosts fetch from
+the first mirror that answers, and fall back to the remote itself.
+
+A mirror can be served with `git daemon`, or over ssh or the file
+system like any other bare repository. It may lag behind the remote
+by up to its refresh interval. A mirror that is behind what a host
+already fetched is skipped, as its branches can't be fast-forwarded.
+"""
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from .lock import RootLock
+from .utils import GitError
+
+
+# Name of the mirror state file, within the mirror
+MIRROR_STATE_FILE = 'dufl-mirror.json'
+
+# Name of the lock held while refreshing, within the mirror
+MIRROR_LOCK_FILE = 'dufl-mirror.lock'
+
+# Refspec of the remote tracking branches, which mirrors fetch into
+TRACKING_REFSPEC = 'refs/heads/*:refs/remotes/%s/*'
+
+
+class MirrorsUnreachable(Exception):
+    """ Exception raised when neither the mirrors nor the remote answer """
+    pass
+
+
+def open_mirror(git, origin=None):
+    """ Create the mirror if it doesn't exist, and return its origin
+
+    Args:
+        git (Git): Git object for the mirror folder
+        origin (str): URL of the repository to mirror. Required when
+            the mirror doesn't exist yet, and replaces the origin of
+            an existing mirror if given.
+    Returns:
+        str: The URL of the mirrored repository
+    Raises:
+        ValueError: If the mirror doesn't exist, and no origin is given.
+    """
+    if not os.path.isfile(os.path.join(git.root, 'HEAD')):
+        if origin is None:
+            raise ValueError('%s is not a mirror yet. Specify the repository to mirror.' % git.root)
+        if not os.path.isdir(git.root):
+            os.makedirs(git.root)
+        git.run('init', '-q', '--bare')
+        git.run('remote', 'add', '--mirror=fetch', 'origin', origin)
+        # Let hosts fetch over git daemon
+        with open(os.path.join(git.root, 'git-daemon-export-ok'), 'w'):
+            pass
+    elif origin is not None:
+        git.run('remote', 'set-url', 'origin', origin)
+    return git.get_output('config', 'remote.origin.url').strip()
+
+
+def load_state(git):
+    """ Return the state of the mirror
+
+    Args:
+        git (Git): Git object for the mirror folder
+    Returns:
+        dict: Dictionary with keys last_refresh (timestamp of the last
+            successful refresh, or None) and last_error (message of the
+            last failed refresh, or None).
+    """
+    try:
+        with open(os.path.join(git.root, MIRROR_STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'last_refresh': None, 'last_error': None}
+
+
+def _save_state(git, state):
+    """ Atomically write the state of the mirror """
+    fd, temp_path = tempfile.mkstemp(dir=git.root, prefix='.dufl-mirror-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(temp_path, os.path.join(git.root, MIRROR_STATE_FILE))
+
+
+def refresh(git, interval=0):
+    """ Fetch from the mirrored repository, if the mirror is due a refresh
+
+    The mirror is not refreshed if it was refreshed less than interval
+    seconds ago, or if another process is refreshing it.
+
+    Args:
+        git (Git): Git object for the mirror folder
+        interval (float): Minimum number of seconds between refreshes
+    Returns:
+        bool: True if the mirror was refreshed
+    Raises:
+        GitError: If the mirrored repository couldn't be fetched. The
+            mirror keeps serving what it has.
+    """
+    state = load_state(git)
+    if state['last_refresh'] is not None and time.time() - state['last_refresh'] < interval:
+        return False
+    lock = RootLock(os.path.join(git.root, MIRROR_LOCK_FILE), 0)
+    if not lock.try_acquire():
+        return False
+    try:
+        try:
+            git.run('fetch', '-q', '--prune', 'origin')
+        except GitError:
+            state['last_error'] = 'Could not fetch %s' % git.get_output(
+                'config', 'remote.origin.url'
+            ).strip()
+            _save_state(git, state)
+            raise
+        _save_state(git, {'last_refresh': time.time(), 'last_error': None})
+        return True
+    finally:
+        lock.release()
+
+
+def start_daemon(git, port=None, listen=None):
+    """ Serve the mirror with git daemon
+
+    The mirror is exported under its folder name, eg. the mirror in
+    /srv/dotfiles.git is served as git://<host>/dotfiles.git
+
+    Args:
+        git (Git): Git object for the mirror folder
+        port (int): Port to listen to. Defaults to git's port (9418).
+        listen (str): Address to listen to. Defaults to all addresses.
+    Returns:
+        subprocess.Popen: The daemon process
+    """
+    root = os.path.abspath(git.root)
+    argv = [
+        git.git, 'daemon', '--reuseaddr',
+        '--base-path=%s' % os.path.dirname(root)
+    ]
+    if port is not None:
+        argv.append('--port=%d' % port)
+    if listen is not None:
+        argv.append('--listen=%s' % listen)
+    return subprocess.Popen(argv + [root])
+
+
+def fetch_through_mirrors(git, mirrors, remote='origin'):
+    """ Fetch the branches of the remote, from the first source that answers
+
+    The mirrors are tried in order, then the remote itself. Whichever
+    answers, the branches end up in the remote tracking branches.
+    Branches fetched from mirrors must fast-forward the remote tracking
+    branches, so mirrors behind them are skipped.
+
+    Args:
+        git (Git): Git object for the dufl root
+        mirrors (list of str): URLs of the mirrors
+        remote (str): Name of the remote
+    Returns:
+        str: The URL of the mirror used, or the name of the remote
+    Raises:
+        MirrorsUnreachable
+    """
+    refspec = TRACKING_REFSPEC % remote
+    for mirror in mirrors or []:
+        if git.test('fetch', '-q', mirror, refspec):
+            return mirror
+    if git.test('fetch', '-q', remote, '+' + refspec):
+        return remote
+    raise MirrorsUnreachable(
+        'Could not fetch from %s.' % ', '.join(list(mirrors or []) + [remote])
+    )
+
+
+def fast_forward(git, commit):
+    """ Fast-forward the working branch to a commit
+
+    Args:
+        git (Git): Git object for the dufl root
+        commit (str): The commit
+    Returns:
+        tuple: (commit before, commit after), as found in HEAD. The
+            commit before is None if the repository had no commits. The
+            commits are the same if the working branch already had the
+            commit, including when it is ahead of it.
+    Raises:
+        GitError: If the working branch has diverged from the commit
+    """
+    try:
+        before = git.get_output('rev-parse', '--verify', '-q', 'HEAD').strip()
+    except GitError:
+        before = None
+    target = git.get_output('rev-parse', '--verify', commit).strip()
+    if before is None:
+        git.run('reset', '-q', '--hard', target)
+    elif before != target:
+        git.run('merge', '-q', '--ff-only', target)
+    else:
+        return before, before
+    return before, git.get_output('rev-parse', '--verify', 'HEAD').strip()
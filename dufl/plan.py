@@ -0,0 +1,198 @@
+""" Plan a checkout of all the tracked files, and apply the plan later
+
+A plan records, for every tracked file, what checking it out would do:
+
+- 'create': the file doesn't exist locally;
+- 'update': the local file is an unmodified older version;
+- 'unchanged': the local file already has the repository content;
+- 'blocked': the local file has local modifications (or isn't a
+  regular file), so it won't be overwritten.
+
+It also records the commit it was made at, and the git blob sha of each
+local file it will overwrite. Applying the plan only checks those
+hashes again, rather than the history of each file, to detect files
+that changed since the plan was made.
+"""
+import json
+import os
+import re
+import stat
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+from .app import get_dufl_file_path, get_file_system_path
+from .app import get_content_at_modification_time
+from .changes import blob_sha, find_changed
+from .storage import copy_file_out, stored_content_matches
+
+
+# Version of the plan file format
+PLAN_VERSION = 1
+
+# Actions that write files
+WRITE_ACTIONS = ('create', 'update')
+
+
+class PlanBroken(Exception):
+    """ Exception raised when a plan file can't be read """
+    pass
+
+
+def local_hash(path):
+    """ Return the git blob sha of a local file
+
+    Args:
+        path (str): File system path
+    Returns:
+        str: Hex sha1, or None if the file doesn't exist. Anything that
+            isn't a regular file is hashed as an empty string.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return ''
+    return blob_sha(path, st.st_size)
+
+
+def make_plan(context, git, index, cache_file, selected=None):
+    """ Find what checking out each tracked file would do
+
+    Tracked files are compared with the repository in a single pass
+    over the index, skipping the files the stat cache knows are
+    unchanged. Only the files that differ are looked up in the history,
+    to tell older versions from local modifications.
+
+    Args:
+        context (dict): The context
+        git (Git): Git object for the dufl root
+        index (TrackedIndex): Index of the tracked files
+        cache_file (str): Path of the stat cache
+        selected (function): If not None, only the file system paths
+            for which this returns True are planned.
+    Returns:
+        dict: The plan, with keys version, head, and files (list of
+            dictionaries with keys path, action, blob - the sha of the
+            tracked content - and local - the blob sha of the local
+            file, None if it doesn't exist or is unchanged).
+    """
+    changed, missing = find_changed(context, index, cache_file, selected)
+    changed = set(changed)
+    missing = set(missing)
+    files = []
+    for subdir in [context['home_subdir'], context['slash_subdir']]:
+        for entry in index.lookup(re.sub('^/|/$', '', subdir) + '/'):
+            path = get_file_system_path(entry.path, context)
+            if path is None or (selected is not None and not selected(path)):
+                continue
+            if path in missing:
+                local = local_hash(path)
+                action = 'create' if local is None else 'blocked'
+            elif path in changed:
+                local = local_hash(path)
+                action = 'update' if _is_older_version(
+                    git, context, path, entry.path
+                ) else 'blocked'
+            else:
+                local = None
+                action = 'unchanged'
+            files.append({
+                'path': path, 'action': action, 'blob': entry.sha, 'local': local
+            })
+    return {'version': PLAN_VERSION, 'head': index.head, 'files': files}
+
+
+def _is_older_version(git, context, path, repo_path):
+    """ Check whether a local file is an unmodified version from the history """
+    content = get_content_at_modification_time(
+        git, context, path, os.path.join(context['dufl_root'], repo_path)
+    )
+    return content is not None and stored_content_matches(content, path, context)
+
+
+def save_plan(plan_file, plan):
+    """ Write a plan file
+
+    Args:
+        plan_file (str): Path of the plan file
+        plan (dict): The plan
+    """
+    folder = os.path.dirname(os.path.abspath(plan_file))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.plan-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+    os.rename(temp_path, plan_file)
+
+
+def load_plan(plan_file):
+    """ Read a plan file
+
+    Args:
+        plan_file (str): Path of the plan file
+    Returns:
+        dict: The plan. Paths are byte strings.
+    Raises:
+        PlanBroken
+    """
+    try:
+        with open(plan_file) as f:
+            plan = json.load(f)
+    except (IOError, ValueError) as e:
+        raise PlanBroken('Could not read plan %s: %s' % (plan_file, str(e)))
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+        raise PlanBroken('%s is not a plan made by this version of dufl.' % plan_file)
+    for f in plan['files']:
+        if not isinstance(f['path'], str):
+            f['path'] = f['path'].encode('utf-8')
+    return plan
+
+
+def find_drift(plan):
+    """ Return the files to write that changed since the plan was made
+
+    Args:
+        plan (dict): The plan
+    Returns:
+        list of str: File system paths
+    """
+    return [
+        f['path'] for f in plan['files']
+        if f['action'] in WRITE_ACTIONS and local_hash(f['path']) != f['local']
+    ]
+
+
+def copy_in_parallel(context, paths, jobs):
+    """ Copy files from the dufl root to the file system, in parallel
+
+    Args:
+        context (dict): The context
+        paths (list of str): File system paths of the files to copy
+        jobs (int): Number of files copied at the same time
+    Returns:
+        list of tuple: (path, error message) of the files that could
+            not be copied.
+    """
+    def copy(path):
+        try:
+            folder = os.path.dirname(path)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # Created by another thread in the meantime
+                    if not os.path.isdir(folder):
+                        raise
+            copy_file_out(get_dufl_file_path(path, context), path, context)
+            return None
+        except Exception as e:
+            return (path, str(e))
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        results = pool.map(copy, paths)
+    finally:
+        pool.close()
+        pool.join()
+    return [r for r in results if r is not None]
@@ -0,0 +1,382 @@
+""" Write files that need elevated privileges through a single sudo'd helper
+
+The helper is this module's `main`, run through sudo. It reads write
+requests from its standard input:
+
+- A JSON header line: {"path": ..., "mode": ..., "uid": ..., "gid": ...};
+- The content, as frames: a line with the frame size, followed by
+  that many bytes. A frame of size 0 ends the content.
+
+Once all requests are sent, the client sends COMMIT_LINE and closes
+the helper's input. Each file is written to a temporary file next to
+the target, and the files are only renamed into place once the commit
+line is read: if the input ends without it, nothing is written.
+Existing files keep their mode and ownership unless the request
+specifies them. The helper then writes one JSON result line per
+request to its standard output.
+
+The helper runs dufl's own code as root, so that code must not be
+writable by anyone but root: the helper is only started if the python
+interpreter, the dufl package and the folders above them are owned by
+root, and not writable by group or others. Install dufl system wide
+(eg. with `sudo pip install`) to write files needing elevated
+privileges.
+"""
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+
+
+# Largest frame sent to the helper
+FRAME_SIZE = 64 * 1024
+
+# Line sent to the helper once all the requests are sent
+COMMIT_LINE = "commit\n"
+
+# The sudo executable. This is not a setting: the settings file is
+# shared through the dufl repository, and must not choose what runs
+# as root.
+SUDO = '/usr/bin/sudo'
+
+
+class PrivilegedWriteFailed(Exception):
+    """ Exception raised when the helper failed to write some files
+
+    Args:
+        failures (list of dict): Result of each failed write, with
+            keys path and error.
+    """
+    def __init__(self, failures):
+        Exception.__init__(self, ', '.join(
+            '%s (%s)' % (f['path'], f.get('error', 'unknown error'))
+            for f in failures
+        ))
+        self.failures = failures
+
+
+class HelperUnsafe(PrivilegedWriteFailed):
+    """ Exception raised when the helper's code is writable by non-root users
+
+    Args:
+        paths (list of str): The paths writable by non-root users
+    """
+    def __init__(self, paths):
+        Exception.__init__(
+            self,
+            'dufl will not run code as root from files non-root users can '
+            'modify: %s. Install dufl system wide to write files needing '
+            'elevated privileges.' % ', '.join(paths)
+        )
+        self.failures = [
+            {'path': path, 'error': 'writable by non-root users'} for path in paths
+        ]
+
+
+def unsafe_paths(package_folder, executable):
+    """ Return the paths that make running the helper as root unsafe
+
+    The helper runs the interpreter, and imports the standard library
+    and the dufl package, as root. These files and the folders above
+    them must be owned by root, and not writable by group or others -
+    other than folders with the sticky bit such as /tmp, where users
+    can't replace entries they don't own.
+
+    Args:
+        package_folder (str): Folder of the dufl package
+        executable (str): Path of the python interpreter
+    Returns:
+        list of str: The unsafe paths
+    """
+    package_folder = os.path.realpath(package_folder)
+    paths = [os.path.realpath(executable), package_folder]
+    paths.extend(
+        os.path.join(package_folder, name)
+        for name in sorted(os.listdir(package_folder))
+        if name.endswith(('.py', '.pyc'))
+    )
+    paths.append(os.path.dirname(os.path.realpath(os.__file__)))
+    for path in list(paths):
+        folder = os.path.dirname(path)
+        while folder not in paths:
+            paths.append(folder)
+            folder = os.path.dirname(folder)
+    unsafe = []
+    for path in paths:
+        st = os.stat(path)
+        writable = st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        if stat.S_ISDIR(st.st_mode) and st.st_mode & stat.S_ISVTX:
+            writable = False
+        if st.st_uid != 0 or writable:
+            unsafe.append(path)
+    return unsafe
+
+
+def needs_privileges(path):
+    """ Check whether writing a file requires elevated privileges
+
+    Files are written by renaming a temporary file into place, so
+    the closest existing folder must be writable. Existing files must
+    also be writable, so we don't replace files we don't own.
+
+    Args:
+        path (str): Path of the file to write
+    Returns:
+        bool: True if elevated privileges are needed
+    """
+    if os.path.lexists(path) and not os.access(path, os.W_OK):
+        return True
+    folder = os.path.dirname(os.path.abspath(path))
+    while not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    return not os.access(folder, os.W_OK | os.X_OK)
+
+
+class _FrameWriter(object):
+    """ File-like object sending what is written as frames to the helper """
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def write(self, data):
+        for i in range(0, len(data), FRAME_SIZE):
+            frame = data[i:i + FRAME_SIZE]
+            self.pipe.write('%d\n' % len(frame))
+            self.pipe.write(frame)
+
+
+class PrivilegedWriter(object):
+    """ Client side of the privileged helper
+
+    The helper is started on the first write, so commands that don't
+    need elevated privileges never invoke sudo. If sudo has cached
+    credentials, the helper is started without prompting.
+
+    Files are only written by `close`. If the command fails before,
+    `abort` must be called so none of the files sent so far are written.
+
+    Args:
+        sudo (str): Path to the sudo executable. Defaults to SUDO.
+        profiler (Profiler): Optional profiler
+    """
+    def __init__(self, sudo=None, profiler=None):
+        self.sudo = sudo or SUDO
+        self.profiler = profiler
+        self.process = None
+        self.count = 0
+
+    def start(self):
+        """ Start the helper
+
+        Raises:
+            HelperUnsafe: If the helper's code is writable by non-root users
+        """
+        package_folder = os.path.dirname(os.path.abspath(__file__))
+        unsafe = unsafe_paths(package_folder, sys.executable)
+        if unsafe:
+            raise HelperUnsafe(unsafe)
+        with open(os.devnull, 'w') as devnull:
+            cached = subprocess.call(
+                [self.sudo, '-n', 'true'], stdout=devnull, stderr=devnull
+            ) == 0
+        # -E and -s ignore the environment and the user's site packages,
+        # and running from / keeps the current folder out of sys.path.
+        self.process = subprocess.Popen(
+            [self.sudo] + (['-n'] if cached else []) + [
+                sys.executable, '-E', '-s', '-c',
+                'import sys; sys.path.insert(0, sys.argv[1]); '
+                'from dufl.privileged import main; main()',
+                os.path.dirname(package_folder)
+            ],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd='/'
+        )
+        if self.profiler is not None:
+            self.profiler.count('sudo_helpers')
+
+    def write(self, path, write_content, mode=None, uid=None, gid=None):
+        """ Send a file to write to the helper
+
+        Args:
+            path (str): Path of the file to write
+            write_content (function): Function invoked with a file-like
+                object, that must write the content of the file to it.
+            mode (int): Mode of the file. Existing files keep their
+                mode if this is None.
+            uid (int): Owner of the file. Existing files keep their
+                owner if this is None.
+            gid (int): Group of the file. Existing files keep their
+                group if this is None.
+        """
+        if self.process is None:
+            self.start()
+        pipe = self.process.stdin
+        pipe.write(json.dumps({
+            'path': os.path.abspath(path),
+            'mode': mode,
+            'uid': uid,
+            'gid': gid
+        }) + "\n")
+        write_content(_FrameWriter(pipe))
+        pipe.write("0\n")
+        self.count += 1
+
+    def close(self):
+        """ Wait for the helper to write all files
+
+        Raises:
+            PrivilegedWriteFailed: If some files could not be written
+        """
+        if self.process is None:
+            return
+        self.process.stdin.write(COMMIT_LINE)
+        self.process.stdin.close()
+        results = [json.loads(l) for l in self.process.stdout if l.strip()]
+        exit_code = self.process.wait()
+        self.process = None
+        failures = [r for r in results if not r.get('ok')]
+        if exit_code != 0 and len(results) < self.count:
+            failures.append({'path': 'sudo', 'error': 'helper exited with %d' % exit_code})
+        if failures:
+            raise PrivilegedWriteFailed(failures)
+
+    def abort(self):
+        """ Stop the helper without writing any of the files sent to it """
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            # The helper already exited
+            pass
+        self.process.stdout.read()
+        self.process.wait()
+        self.process = None
+
+
+def _read_frame(stream):
+    """ Read a content frame
+
+    Returns:
+        str: The frame, or '' for the frame ending the content
+    Raises:
+        _Aborted: If the input ends within the content
+    """
+    line = stream.readline()
+    if not line:
+        raise _Aborted()
+    size = int(line)
+    data = stream.read(size)
+    if len(data) < size:
+        raise _Aborted()
+    return data
+
+
+def _stage_request(request, stream):
+    """ Write the content of a request next to its target
+
+    The content frames are always consumed, even on failure, so the
+    next request can be read.
+
+    Returns:
+        str: Path of the staged file, with the requested mode and
+            ownership. Existing files keep theirs if not given.
+    Raises:
+        IOError, OSError: If the file can't be staged
+        _Aborted: If the input ends within the content
+    """
+    path = request['path']
+    folder = os.path.dirname(path)
+    out = None
+    temp_path = None
+    error = None
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.dufl-sudo-')
+        out = os.fdopen(fd, 'wb')
+    except (IOError, OSError) as e:
+        error = e
+    try:
+        while True:
+            data = _read_frame(stream)
+            if not data:
+                break
+            if out is not None and error is None:
+                try:
+                    out.write(data)
+                except (IOError, OSError) as e:
+                    error = e
+        if out is not None:
+            out.close()
+        if error is None:
+            try:
+                mode, uid, gid = request['mode'], request['uid'], request['gid']
+                if os.path.exists(path):
+                    current = os.stat(path)
+                    mode = current.st_mode & 0o7777 if mode is None else mode
+                    uid = current.st_uid if uid is None else uid
+                    gid = current.st_gid if gid is None else gid
+                if mode is not None:
+                    os.chmod(temp_path, mode)
+                if uid is not None or gid is not None:
+                    os.chown(temp_path, -1 if uid is None else uid, -1 if gid is None else gid)
+            except (IOError, OSError) as e:
+                error = e
+    except _Aborted:
+        _discard([temp_path])
+        raise
+    if error is not None:
+        _discard([temp_path])
+        raise error
+    return temp_path
+
+
+def _discard(paths):
+    """ Remove staged files """
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
+
+
+class _Aborted(Exception):
+    """ Exception raised when the input ends before the commit line """
+    pass
+
+
+def main():
+    """ Entry point of the privileged helper
+
+    Files are staged as their requests arrive, and only renamed into
+    place once the commit line is read. If the input ends before it
+    (the client failed or aborted), the staged files are removed and
+    nothing is written.
+    """
+    stream = sys.stdin
+    results = []
+    staged = []
+    try:
+        while True:
+            line = stream.readline()
+            if not line:
+                raise _Aborted()
+            if line == COMMIT_LINE:
+                break
+            request = json.loads(line)
+            try:
+                staged.append((request['path'], _stage_request(request, stream)))
+            except (IOError, OSError) as e:
+                results.append({'path': request['path'], 'ok': False, 'error': str(e)})
+    except _Aborted:
+        _discard([temp_path for path, temp_path in staged])
+        sys.exit(1)
+    for path, temp_path in staged:
+        try:
+            os.rename(temp_path, path)
+            results.append({'path': path, 'ok': True})
+        except (IOError, OSError) as e:
+            _discard([temp_path])
+            results.append({'path': path, 'ok': False, 'error': str(e)})
+    for result in results:
+        sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
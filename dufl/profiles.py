@@ -0,0 +1,149 @@
+""" Host profiles: select the files a host deploys
+
+The `profiles` setting associates profile names with lists of file
+system paths (files, or folders ending with a /, ~ being the home
+folder). The `hosts` setting associates host name patterns (as for
+fnmatch, eg. db-*) with lists of profile names. A host with active
+profiles only deploys the files in those profiles, and the dufl root
+only materializes them, through git's sparse checkout.
+"""
+import fnmatch
+import os
+import re
+import socket
+
+from .app import get_dufl_file_path
+
+
+def active_profiles(context, hostname=None):
+    """ Return the profiles active on a host
+
+    Args:
+        context (dict): The context
+        hostname (str): Host name. Defaults to the current host.
+    Returns:
+        list of str: Names of the active profiles, without duplicates.
+            Empty if no host pattern matches, in which case all files
+            are deployed.
+    """
+    if hostname is None:
+        hostname = socket.gethostname()
+    names = []
+    for pattern in sorted(context.get('hosts') or {}):
+        if fnmatch.fnmatch(hostname, pattern):
+            for name in context['hosts'][pattern] or []:
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+class UnknownProfile(Exception):
+    """ Exception raised when a host uses a profile that isn't defined """
+    pass
+
+
+def profile_paths(context, names):
+    """ Return the file system paths selected by profiles
+
+    Args:
+        context (dict): The context
+        names (list of str): Profile names
+    Returns:
+        list of str: Absolute paths. Folders end with a /.
+    Raises:
+        UnknownProfile
+    """
+    profiles = context.get('profiles') or {}
+    paths = []
+    for name in names:
+        if name not in profiles:
+            raise UnknownProfile('Profile %s is not defined in the settings' % name)
+        for path in profiles[name] or []:
+            expanded = os.path.abspath(os.path.expanduser(path))
+            if path.endswith('/'):
+                expanded += '/'
+            if expanded not in paths:
+                paths.append(expanded)
+    return paths
+
+
+def get_selector(context, hostname=None):
+    """ Return a function telling whether a file is deployed on this host
+
+    Args:
+        context (dict): The context
+        hostname (str): Host name. Defaults to the current host.
+    Returns:
+        function: Function taking a file system path, and returning
+            True if the file is selected by the active profiles (always
+            True if there are no active profiles).
+    Raises:
+        UnknownProfile
+    """
+    names = active_profiles(context, hostname)
+    if len(names) == 0:
+        return lambda path: True
+    files = set()
+    folders = []
+    for path in profile_paths(context, names):
+        if path.endswith('/'):
+            folders.append(path)
+        else:
+            files.add(path)
+    folders = tuple(folders)
+
+    def selected(path):
+        path = os.path.abspath(path)
+        return path in files or (path + '/').startswith(folders)
+    return selected
+
+
+def _escape_pattern(path):
+    """ Escape the characters that have a meaning in sparse checkout patterns """
+    return re.sub(r'([*?\[\]\\!#])', r'\\\1', path)
+
+
+def sparse_patterns(context, paths):
+    """ Return the sparse checkout patterns materializing profile paths
+
+    The settings file and the chunk store are always included, as
+    dufl needs them.
+
+    Args:
+        context (dict): The context
+        paths (list of str): File system paths, as returned by
+            profile_paths
+    Returns:
+        list of str: Patterns for `git sparse-checkout set --no-cone`
+    """
+    patterns = [
+        '/' + _escape_pattern(context['settings_file']),
+        '/' + _escape_pattern(re.sub('^/|/$', '', context['chunks_subdir'])) + '/'
+    ]
+    for path in paths:
+        repo_path = os.path.relpath(
+            get_dufl_file_path(path, context), context['dufl_root']
+        )
+        pattern = '/' + _escape_pattern(repo_path)
+        if path.endswith('/'):
+            pattern += '/'
+        patterns.append(pattern)
+    return patterns
+
+
+def apply_sparse_checkout(git, context, names):
+    """ Materialize only the files of the given profiles in the dufl root
+
+    Args:
+        git (Git): Git object for the dufl root
+        context (dict): The context
+        names (list of str): Profile names. If empty, sparse checkout
+            is disabled, so all files are materialized.
+    Raises:
+        UnknownProfile
+    """
+    if len(names) == 0:
+        git.run('sparse-checkout', 'disable')
+        return
+    patterns = sparse_patterns(context, profile_paths(context, names))
+    git.run('sparse-checkout', 'set', '--no-cone', *patterns)
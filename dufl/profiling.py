@@ -0,0 +1,166 @@
+import json
+import os
+import time
+
+from contextlib import contextmanager
+
+from .utils import git_subcommand
+
+
+class Profiler(object):
+    """ Class used to record where a dufl invocation spends its time
+
+    When the profiler is not enabled, spans and git calls are not
+    recorded, so it is safe to use one unconditionally. Counters
+    (see `count`) are always maintained, as they are cheap.
+
+    Args:
+        enabled (bool): True to record events
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.time()
+        self.events = []
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name, category='dufl', **args):
+        """ Context manager recording the time spent in a block of code
+
+        Args:
+            name (str): Name of the span, eg. 'copy'
+            category (str): Category of the span
+            **args: Extra values stored with the event
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add_event(name, category, start, time.time() - start, args)
+
+    def count(self, name, value=1, **labels):
+        """ Increment a counter
+
+        Args:
+            name (str): Name of the counter, eg. 'bytes_copied'
+            value (int): Value to add to the counter
+            **labels: Labels distinguishing counters of the same name
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def total(self, name):
+        """ Return the sum of the counters of a given name, across labels
+
+        Args:
+            name (str): Name of the counter
+        Returns:
+            int: The total
+        """
+        return sum(
+            value for (key, labels), value in self.counters.items() if key == name
+        )
+
+    def record_git(self, command, start, duration, exit_code, output_bytes):
+        """ Record a git subprocess
+
+        Args:
+            command (list of str): Full argv of the git process
+            start (float): Start timestamp
+            duration (float): Wall time, in seconds
+            exit_code (int): Exit code of the process
+            output_bytes (int): Number of bytes read from the process
+                output, or None if the output was not captured
+        """
+        self.count('git_processes')
+        if not self.enabled:
+            return
+        self._add_event(
+            'git %s' % git_subcommand(command), 'git', start, duration, {
+                'argv': list(command),
+                'exit_code': exit_code,
+                'output_bytes': output_bytes
+            }
+        )
+
+    def trace(self):
+        """ Return the recorded events in Chrome trace-event format
+
+        Returns:
+            dict: Trace, ready to be serialized as JSON
+        """
+        pid = os.getpid()
+        return {
+            'traceEvents': [{
+                'name': event['name'],
+                'cat': event['category'],
+                'ph': 'X',
+                'ts': int((event['start'] - self.started) * 1000000),
+                'dur': int(event['duration'] * 1000000),
+                'pid': pid,
+                'tid': 0,
+                'args': event['args']
+            } for event in self.events],
+            'displayTimeUnit': 'ms'
+        }
+
+    def summary(self):
+        """ Return a text summary of the recorded events
+
+        Events are grouped by name, and sorted by total time.
+
+        Returns:
+            str: The summary
+        """
+        totals = {}
+        for event in self.events:
+            count, duration = totals.get(event['name'], (0, 0.0))
+            totals[event['name']] = (count + 1, duration + event['duration'])
+        git_events = [e for e in self.events if e['category'] == 'git']
+        lines = [
+            'Total time: %.3fs' % (time.time() - self.started),
+            'Git processes: %d (%.3fs)' % (
+                len(git_events), sum(e['duration'] for e in git_events)
+            ),
+            'Git cache: %d hits, %d misses' % (
+                self.total('git_cache_hits'), self.total('git_cache_misses')
+            ),
+            '',
+            '%-40s %8s %10s' % ('name', 'count', 'seconds')
+        ]
+        ordered = sorted(totals.items(), key=lambda i: i[1][1], reverse=True)
+        for name, (count, duration) in ordered:
+            lines.append('%-40s %8d %10.3f' % (name, count, duration))
+        return "\n".join(lines) + "\n"
+
+    def write(self, folder, prefix):
+        """ Write the JSON trace and the text summary
+
+        Args:
+            folder (str): Folder in which to write the files. Created if
+                it does not exist.
+            prefix (str): Prefix of the file names
+        Returns:
+            list of str: The files written
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        trace_file = os.path.join(folder, prefix + '.trace.json')
+        summary_file = os.path.join(folder, prefix + '.summary.txt')
+        with open(trace_file, 'w') as f:
+            json.dump(self.trace(), f)
+        with open(summary_file, 'w') as f:
+            f.write(self.summary())
+        return [trace_file, summary_file]
+
+    def _add_event(self, name, category, start, duration, args):
+        self.events.append({
+            'name': name,
+            'category': category,
+            'start': start,
+            'duration': duration,
+            'args': args
+        })
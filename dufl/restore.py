@@ -0,0 +1,233 @@
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+
+from . import chunks
+from . import encryption
+from . import throttle
+from .app import get_file_system_path
+from .storage import get_chunk_root
+from .utils import GitError
+
+
+# Size of the blocks copied from the archive stream
+BLOCK_SIZE = 64 * 1024
+
+
+class RevisionNotFound(Exception):
+    """ Exception raised when a revision or date doesn't match any commit """
+    pass
+
+
+def resolve_commit(git, at):
+    """ Return the commit matching a revision or a date
+
+    Args:
+        git (Git): Git object for the dufl root
+        at (str): A revision (commit, tag, branch...) or a date, in
+            any format understood by git (eg. '2016-01-01 10:00' or
+            '3 days ago'). For dates, the last commit of the working
+            branch at that date is used.
+    Returns:
+        str: Hex sha of the commit
+    Raises:
+        RevisionNotFound
+    """
+    try:
+        return git.get_output(
+            'rev-parse', '--verify', '-q', '%s^{commit}' % at
+        ).strip()
+    except GitError:
+        pass
+    commit = git.get_output(
+        'rev-list', '-1', '--before=%s' % at, git.working_branch()
+    ).strip()
+    if not commit:
+        raise RevisionNotFound('No commit found at %s' % at)
+    return commit
+
+
+def iter_tree_files(git, commit, context):
+    """ Stream the files of a commit, mapped to the file system
+
+    This streams a single `git archive` of the home and slash subdirs,
+    so entries are available as soon as git produces them, and nothing
+    is staged in memory.
+
+    Args:
+        git (Git): Git object for the dufl root
+        commit (str): The commit
+        context (dict): The context
+    Yields:
+        tuple: (file system path, tarfile.TarInfo, file object), where
+            the file object is None for anything but regular files.
+            The file object is only valid until the next iteration.
+    """
+    subdirs = [
+        re.sub('^/|/$', '', context[s]) for s in ['home_subdir', 'slash_subdir']
+    ]
+    # git archive fails on paths that don't exist in the commit
+    present = git.get_output(
+        'ls-tree', '--name-only', commit, '--', *subdirs
+    ).split("\n")
+    subdirs = [s for s in subdirs if s in present]
+    if len(subdirs) == 0:
+        return
+    with git.stream('archive', '--format=tar', commit, '--', *subdirs) as out:
+        archive = tarfile.open(fileobj=out, mode='r|')
+        for member in archive:
+            if member.isdir():
+                continue
+            path = get_file_system_path(member.name, context)
+            if path is None:
+                continue
+            source = None
+            if member.isfile():
+                source = archive.extractfile(member)
+            yield path, member, source
+        # Read the end of archive padding, so git's exit code is checked
+        out.read()
+
+
+def _read_stored(source):
+    """ Read the beginning of an entry, to check whether it's a manifest
+
+    Returns:
+        tuple: (first bytes, parsed manifest or None)
+    """
+    head = source.read(len(chunks.MANIFEST_MAGIC))
+    if chunks.is_manifest(head):
+        return head, chunks.parse_manifest(head + source.read())
+    return head, None
+
+
+class _Prepended(object):
+    """ File object reading bytes already read from a file, then the rest of it """
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.f.read(size)
+        if size < 0:
+            data, self.head = self.head + self.f.read(), ''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.f.read(size - len(data))
+        return data
+
+
+def entry_mode(path, member, source):
+    """ Return the mode to restore an archive entry with
+
+    Encrypted entries get the mode given by
+    `encryption.decrypted_file_mode`, rather than that of the stored
+    encrypted file. This reads the beginning of the entry's content to
+    find out, so the entry must then be read from the returned file
+    object.
+
+    Args:
+        path (str): File system path of the entry
+        member (tarfile.TarInfo): The archive entry
+        source (file): The entry's content
+    Returns:
+        tuple: (mode, file object reading the entry's whole content)
+    """
+    head = source.read(len(encryption.ENCRYPTED_MAGIC))
+    if encryption.is_encrypted(head):
+        mode = encryption.decrypted_file_mode(path)
+    else:
+        mode = member.mode & 0o7777
+    return mode, _Prepended(head, source)
+
+
+def compare_entry(path, member, source, context=None):
+    """ Find what restoring an archive entry would do
+
+    This consumes the entry's file object.
+
+    Args:
+        path (str): File system path of the entry
+        member (tarfile.TarInfo): The archive entry
+        source (file): The entry's content
+        context (dict): The context. Only needed for encrypted entries.
+    Returns:
+        str: 'create', 'update' or 'unchanged'
+    """
+    if not os.path.lexists(path):
+        return 'create'
+    if not os.path.isfile(path):
+        return 'update'
+    head, manifest = _read_stored(source)
+    if encryption.is_encrypted(head):
+        cipher = encryption.get_cipher(context)
+        tag = encryption.header_tag(head + source.read(encryption.TAG_SIZE))
+        return 'unchanged' if cipher.content_tag(path) == tag else 'update'
+    if manifest is not None:
+        if (os.path.getsize(path) == manifest['size'] and
+                chunks.file_sha256(path) == manifest['sha256']):
+            return 'unchanged'
+        return 'update'
+    if os.path.getsize(path) != member.size:
+        return 'update'
+    with open(path, 'rb') as f:
+        if f.read(len(head)) != head:
+            return 'update'
+        while True:
+            block = source.read(BLOCK_SIZE)
+            if block != f.read(len(block)):
+                return 'update'
+            if not block:
+                return 'unchanged'
+
+
+def write_entry_content(source, out, context):
+    """ Write the original content of an archive entry
+
+    Args:
+        source (file): The entry's content
+        out (file): File object to write the content to
+        context (dict): The context
+    """
+    out = throttle.throttled(out, context)
+    head, manifest = _read_stored(source)
+    if manifest is not None:
+        chunks.assemble(manifest, get_chunk_root(context), out)
+    elif encryption.is_encrypted(head):
+        encryption.get_cipher(context).decrypt(source, out)
+    else:
+        out.write(head)
+        shutil.copyfileobj(source, out, BLOCK_SIZE)
+
+
+def restore_entry(path, member, source, context):
+    """ Write an archive entry to the file system
+
+    The content is copied block by block to a temporary file next
+    to the target, which is then renamed into place.
+
+    Args:
+        path (str): File system path of the entry
+        member (tarfile.TarInfo): The archive entry
+        source (file): The entry's content
+        context (dict): The context
+    """
+    mode, source = entry_mode(path, member, source)
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # The temporary file is only readable by its owner until renamed
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.dufl-restore-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write_entry_content(source, out, context)
+        os.chmod(temp_path, mode)
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
@@ -0,0 +1,182 @@
+import os
+import shutil
+import stat
+
+from . import chunks
+from . import encryption
+from . import throttle
+
+
+def get_chunk_root(context):
+    """ Return the folder of the chunk store
+
+    Args:
+        context (dict): The context. Expected keys are dufl_root
+            and chunks_subdir.
+    Returns:
+        str: The folder
+    """
+    return os.path.join(context['dufl_root'], context['chunks_subdir'])
+
+
+def is_stored_encrypted(dest):
+    """ Check whether a file is stored encrypted in the dufl root
+
+    Args:
+        dest (str): Path of the file in the dufl root
+    Returns:
+        bool: True if the file exists, and is encrypted
+    """
+    try:
+        with open(dest, 'rb') as f:
+            return encryption.is_encrypted(f.read(len(encryption.ENCRYPTED_MAGIC)))
+    except IOError:
+        return False
+
+
+def needs_chunks(source, context):
+    """ Check whether a file must be stored as chunks
+
+    Files larger than the chunk_threshold setting (if set) are. So are
+    files that start like a manifest or an encrypted file: stored as
+    they are, they would be mistaken for one when read back.
+
+    Args:
+        source (str): File system path of the file
+        context (dict): The context
+    Returns:
+        bool: True if the file must be stored as chunks
+    """
+    threshold = context.get('chunk_threshold') or 0
+    if threshold > 0 and os.path.getsize(source) > threshold:
+        return True
+    with open(source, 'rb') as f:
+        head = f.read(len(chunks.MANIFEST_MAGIC))
+    return chunks.is_manifest(head) or encryption.is_encrypted(head)
+
+
+def store_file(source, dest, context, encrypt=False):
+    """ Store a file in the dufl root
+
+    Files to encrypt, and files already stored encrypted, are stored
+    encrypted. Files for which `needs_chunks` is True are stored as a
+    manifest pointing to content defined chunks in the chunk store.
+    Other files are copied as they are, within the
+    io_limit setting. Encrypted and chunked files are accounted for
+    as a whole.
+
+    Args:
+        source (str): File system path of the file
+        dest (str): Path of the file in the dufl root
+        context (dict): The context
+        encrypt (bool): If True, store the file encrypted
+    Returns:
+        list of str: Files written in the dufl root, which should
+            be added to git.
+    Raises:
+        EncryptionKeyMissing: If the file must be encrypted, and the
+            key isn't available.
+    """
+    if not os.path.isdir(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest))
+    if encrypt or is_stored_encrypted(dest):
+        throttle.consume(context, os.path.getsize(source))
+        return encryption.store_encrypted(
+            source, dest, encryption.get_cipher(context)
+        )
+    if needs_chunks(source, context):
+        throttle.consume(context, os.path.getsize(source))
+        return chunks.store_chunked(source, dest, get_chunk_root(context))
+    if throttle.get_throttle(context) is None:
+        shutil.copyfile(source, dest)
+    else:
+        with open(source, 'rb') as f, open(dest, 'wb') as out:
+            shutil.copyfileobj(throttle.throttled(f, context), out)
+    return [dest]
+
+
+def write_file_content(dufl_file, out, context):
+    """ Write the original content of a file stored in the dufl root
+
+    Args:
+        dufl_file (str): Path of the file in the dufl root
+        out (file): File object to write the content to
+        context (dict): The context
+    Raises:
+        ManifestBroken: If the file is stored as chunks, and they
+            can't be assembled.
+        EncryptionKeyMissing, DecryptionFailed: If the file is stored
+            encrypted, and can't be decrypted.
+    """
+    out = throttle.throttled(out, context)
+    with open(dufl_file, 'rb') as f:
+        head = f.read(len(chunks.MANIFEST_MAGIC))
+        if chunks.is_manifest(head):
+            manifest = chunks.parse_manifest(head + f.read())
+            chunks.assemble(manifest, get_chunk_root(context), out)
+        elif encryption.is_encrypted(head):
+            encryption.get_cipher(context).decrypt(f, out)
+        else:
+            out.write(head)
+            shutil.copyfileobj(f, out)
+
+
+def checkout_mode(dufl_file, path):
+    """ Return the mode to give a file copied out of the dufl root
+
+    Args:
+        dufl_file (str): Path of the file in the dufl root
+        path (str): File system path of the file
+    Returns:
+        int: The mode of the file in the dufl root, or for encrypted
+            files that given by `encryption.decrypted_file_mode`.
+    """
+    if is_stored_encrypted(dufl_file):
+        return encryption.decrypted_file_mode(path)
+    return stat.S_IMODE(os.stat(dufl_file).st_mode)
+
+
+def copy_file_out(dufl_file, target, context, replaces=None):
+    """ Copy a file from the dufl root to the file system
+
+    The mode is set before the content is written, so decrypted
+    content is never readable by others.
+
+    Args:
+        dufl_file (str): Path of the file in the dufl root
+        target (str): File system path to write to
+        context (dict): The context
+        replaces (str): File system path of the file the target is
+            going to replace, when writing to a staging file. Defaults
+            to the target.
+    """
+    mode = checkout_mode(dufl_file, replaces or target)
+    with open(target, 'wb') as out:
+        os.fchmod(out.fileno(), mode)
+        write_file_content(dufl_file, out, context)
+
+
+def stored_content_matches(stored, path, context=None):
+    """ Check whether a file has the content of a stored version
+
+    Args:
+        stored (str): Content of the file as stored in the dufl root
+            (as a manifest, encrypted, or as a copy).
+        path (str): File system path of the file to compare
+        context (dict): The context. Only needed for encrypted files.
+    Returns:
+        bool: True if the file has the same content
+    Raises:
+        EncryptionKeyMissing
+    """
+    if encryption.is_encrypted(stored):
+        cipher = encryption.get_cipher(context)
+        return cipher.content_tag(path) == encryption.header_tag(stored)
+    if chunks.is_manifest(stored):
+        manifest = chunks.parse_manifest(stored)
+        return (
+            os.path.getsize(path) == manifest['size'] and
+            chunks.file_sha256(path) == manifest['sha256']
+        )
+    with open(path, 'rb') as f:
+        return f.read() == stored
@@ -67,7 +67,7 @@ def test_create_initial_context_creates_expected_settings(user_home):
     context = create_initial_context(None)
     assert set(defaults.settings.keys() + [
         'dufl_root', 'create_mode', 'home_subdir', 
-        'slash_subdir', 'settings_file']) == set(context.keys())
+        'slash_subdir', 'chunks_subdir', 'settings_file']) == set(context.keys())
 
 
 def test_create_initial_context_sets_default_root_in_homedir(user_home):
@@ -105,6 +105,7 @@ def test_create_initial_context_does_not_merge_unknown_keys_from_settings_file(u
             'create_mode': '$$$',
             'home_subdir': '$$$',
             'slash_subdir': '$$$',
+            'chunks_subdir': '$$$',
             'settings_file': '$$$',
             'other_stuff': '$$$'
         }.items())))
@@ -0,0 +1,105 @@
+import json
+import os
+
+from click.testing import CliRunner
+from tutils import cli_run, temp_folder, create_files_in_folder
+from .. import cli, utils
+
+
+def _batch(dufl_root, *requests):
+    """ Run dufl batch with the given requests, and return the results """
+    r = CliRunner().invoke(
+        cli.cli, ['-r', dufl_root, 'batch'],
+        input=''.join(json.dumps(q) + "\n" for q in requests)
+    )
+    assert r.exit_code == 0
+    return [json.loads(l) for l in r.output.splitlines() if l.startswith('{')]
+
+
+def test_dufl_batch_runs_requests_in_order(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'one', 'b': 'two'})
+
+    results = _batch(
+        dufl_root,
+        {'id': 1, 'command': 'add', 'path': files['a']},
+        {'id': 2, 'command': 'status', 'files': [files['a'], files['b']]}
+    )
+
+    assert [r['id'] for r in results] == [1, 2]
+    assert results[0]['ok']
+    assert 'Added 1 file' in results[0]['output']
+    assert results[1]['ok']
+    assert results[1]['changed'] == []
+    assert results[1]['untracked'] == [files['b']]
+
+
+def test_dufl_batch_diffs_modified_files(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': "one\n"})
+    cli_run('-r', dufl_root, 'add', files['a'])
+    with open(files['a'], 'w') as f:
+        f.write("two\n")
+
+    results = _batch(
+        dufl_root,
+        {'id': 1, 'command': 'status'},
+        {'id': 2, 'command': 'diff', 'file': files['a']},
+        {'id': 3, 'command': 'checkout', 'files': [files['a']]}
+    )
+
+    assert results[0]['changed'] == [files['a']]
+    assert results[1]['changed']
+    assert "-one\n+two\n" in results[1]['diff']
+    # Local modifications are not overwritten
+    assert not results[2]['ok']
+    assert 'local modifications' in results[2]['error']
+    with open(files['a']) as f:
+        assert f.read() == "two\n"
+
+
+def test_dufl_batch_reports_failed_requests_and_carries_on(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'one'})
+
+    results = _batch(
+        dufl_root,
+        {'id': 1, 'command': 'push'},
+        {'id': 2, 'command': 'diff', 'file': files['a']},
+        {'id': 3, 'command': 'add', 'path': os.path.join(temp_folder, 'nope')},
+        {'id': 4, 'command': 'add', 'path': files['a']}
+    )
+
+    assert len(results) == 4
+    assert not results[0]['ok']
+    assert 'Unknown command push' in results[0]['error']
+    assert not results[1]['ok']
+    assert 'is not tracked' in results[1]['error']
+    assert not results[2]['ok']
+    assert results[3]['ok']
+
+
+def test_dufl_batch_shares_git_processes_between_requests(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, dict(
+        ('f%d' % i, 'content %d' % i) for i in range(10)
+    ))
+    cli_run('-r', dufl_root, 'add', temp_folder)
+
+    before = dict(utils.Git.spawned)
+    results = _batch(dufl_root, *[
+        {'id': i, 'command': 'checkout', 'files': [path]}
+        for i, path in enumerate(sorted(files.values()))
+    ])
+
+    assert all(r['ok'] for r in results)
+    spawned = dict(
+        (name, count - before.get(name, 0))
+        for name, count in utils.Git.spawned.items()
+    )
+    # A single cat-file process answers all the requests
+    assert spawned.get('cat-file', 0) == 1
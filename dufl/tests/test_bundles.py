@@ -0,0 +1,113 @@
+import os
+
+from subprocess import check_output
+from tutils import cli_run, temp_folder, create_files_in_folder, dufl_path
+from ..bundles import load_watermarks
+
+
+def test_dufl_bundle_syncs_a_host_incrementally(cli_run, temp_folder):
+    source = os.path.join(temp_folder, 'source')
+    target = os.path.join(temp_folder, 'target')
+    cli_run('-r', source, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'b'})
+    cli_run('-r', source, 'add', files['a'])
+
+    full = os.path.join(temp_folder, 'full.bundle')
+    r = cli_run('-r', source, 'bundle', 'create', 'target', '-o', full)
+    assert r.exit_code == 0
+    assert 'full bundle' in r.output
+    assert 'with 2 commits' in r.output
+    r = cli_run('-r', target, 'init', full)
+    assert r.exit_code == 0
+    assert os.path.isfile(dufl_path(target, files['a']))
+    cli_run('-r', source, 'bundle', 'ack', 'target')
+
+    cli_run('-r', source, 'add', files['b'])
+    incremental = os.path.join(temp_folder, 'incremental.bundle')
+    r = cli_run('-r', source, 'bundle', 'create', 'target', '-o', incremental)
+    assert 'incremental bundle' in r.output
+    assert 'with 1 commit,' in r.output
+
+    r = cli_run('-r', target, 'bundle', 'apply', incremental)
+
+    assert r.exit_code == 0
+    head = check_output(['git', 'rev-parse', 'HEAD'], cwd=source).strip()
+    assert 'Updated to %s' % head in r.output
+    assert os.path.isfile(dufl_path(target, files['b']))
+    r = cli_run('-r', source, 'bundle', 'ack', 'target', head)
+    assert r.exit_code == 0
+    r = cli_run('-r', source, 'bundle', 'create', 'target', '-o', incremental)
+    assert 'target is up to date' in r.output
+
+
+def test_dufl_bundle_apply_of_an_older_bundle_changes_nothing(cli_run, temp_folder):
+    source = os.path.join(temp_folder, 'source')
+    target = os.path.join(temp_folder, 'target')
+    cli_run('-r', source, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'b'})
+    cli_run('-r', source, 'add', files['a'])
+    old = os.path.join(temp_folder, 'old.bundle')
+    cli_run('-r', source, 'bundle', 'create', 'target', '-o', old, '--full')
+    cli_run('-r', source, 'add', files['b'])
+    new = os.path.join(temp_folder, 'new.bundle')
+    cli_run('-r', source, 'bundle', 'create', 'target', '-o', new, '--full')
+    cli_run('-r', target, 'init', new)
+    head = check_output(['git', 'rev-parse', 'HEAD'], cwd=target).strip()
+
+    r = cli_run('-r', target, 'bundle', 'apply', old)
+
+    assert r.exit_code == 0
+    assert 'Already up to date.' in r.output
+    assert 'Updated to' not in r.output
+    assert check_output(['git', 'rev-parse', 'HEAD'], cwd=target).strip() == head
+
+
+def test_dufl_bundle_create_includes_unacknowledged_commits(cli_run, temp_folder):
+    source = os.path.join(temp_folder, 'source')
+    cli_run('-r', source, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'b'})
+    bundle_file = os.path.join(temp_folder, 'host.bundle')
+    cli_run('-r', source, 'bundle', 'create', 'host', '-o', bundle_file)
+    cli_run('-r', source, 'bundle', 'ack', 'host')
+    cli_run('-r', source, 'add', files['a'])
+    cli_run('-r', source, 'bundle', 'create', 'host', '-o', bundle_file)
+    # Not acknowledged: the next bundle includes these commits again
+    cli_run('-r', source, 'add', files['b'])
+
+    r = cli_run('-r', source, 'bundle', 'create', 'host', '-o', bundle_file)
+
+    assert 'incremental bundle' in r.output
+    assert 'with 2 commits' in r.output
+    watermarks = load_watermarks(os.path.join(source, '.git', 'dufl', 'bundles.json'))
+    assert watermarks['host']['pending'] == check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=source
+    ).strip()
+
+
+def test_dufl_bundle_apply_refuses_bundles_with_missing_commits(cli_run, temp_folder):
+    source = os.path.join(temp_folder, 'source')
+    other = os.path.join(temp_folder, 'other')
+    cli_run('-r', source, 'init')
+    cli_run('-r', other, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'b'})
+    cli_run('-r', source, 'add', files['a'])
+    bundle_file = os.path.join(temp_folder, 'host.bundle')
+    cli_run('-r', source, 'bundle', 'create', 'host', '-o', bundle_file)
+    cli_run('-r', source, 'bundle', 'ack', 'host')
+    cli_run('-r', source, 'add', files['b'])
+    cli_run('-r', source, 'bundle', 'create', 'host', '-o', bundle_file)
+
+    r = cli_run('-r', other, 'bundle', 'apply', bundle_file)
+
+    assert r.exit_code != 0
+    assert 'Create a full bundle with --full' in r.output
+
+
+def test_dufl_bundle_ack_requires_a_bundle(cli_run, temp_folder):
+    source = os.path.join(temp_folder, 'source')
+    cli_run('-r', source, 'init')
+
+    r = cli_run('-r', source, 'bundle', 'ack', 'host')
+
+    assert r.exit_code != 0
+    assert 'No bundle was created for host' in r.output
@@ -0,0 +1,137 @@
+import os
+import time
+import yaml
+
+from mock import patch
+from subprocess import check_output
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+from .. import changes
+from ..app import create_initial_context, get_dufl_file_path, get_tracked_index
+from ..changes import blob_sha, find_changed
+
+
+def test_blob_sha_matches_git_hash_object(temp_folder):
+    files = create_files_in_folder(temp_folder, {'a': "some\ncontent\n"})
+    expected = check_output(['git', 'hash-object', files['a']]).strip()
+    assert blob_sha(files['a'], os.path.getsize(files['a'])) == expected
+
+
+def _setup(cli_run, temp_folder, content):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, content)
+    for path in files.values():
+        cli_run('-r', dufl_root, 'add', path)
+    # Make sure the files are old enough to be recorded in the stat cache
+    past = time.time() - 10
+    for path in files.values():
+        os.utime(path, (past, past))
+    return dufl_root, files
+
+
+def _find_changed(dufl_root):
+    context = create_initial_context(dufl_root)
+    index = get_tracked_index(context)
+    try:
+        return find_changed(
+            context, index, os.path.join(dufl_root, '.git', 'dufl', 'stat.cache')
+        )
+    finally:
+        index.close()
+
+
+def test_find_changed_finds_modified_and_missing_files(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder, {
+        'same': 'same', 'longer': 'a', 'same-size': 'b', 'gone': 'c'
+    })
+    create_files_in_folder(temp_folder, {'longer': 'aaa', 'same-size': 'x'})
+    os.unlink(files['gone'])
+
+    changed, missing = _find_changed(dufl_root)
+
+    assert sorted(changed) == sorted([files['longer'], files['same-size']])
+    assert missing == [files['gone']]
+
+
+def test_find_changed_reads_stored_content_from_git_when_working_copy_is_missing(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'chunk_threshold': 1024})
+    })
+    files = create_files_in_folder(temp_folder, {
+        'small': 'a', 'large': 'b' * 4096, 'large-changed': 'c' * 4096
+    })
+    cli_run('-r', dufl_root, 'add', temp_folder)
+    create_files_in_folder(temp_folder, {'small': 'x', 'large-changed': 'd' * 4096})
+    context = create_initial_context(dufl_root)
+    for path in files.values():
+        os.unlink(get_dufl_file_path(path, context))
+
+    changed, missing = _find_changed(dufl_root)
+
+    assert sorted(changed) == sorted([files['small'], files['large-changed']])
+    assert missing == []
+
+
+def test_find_changed_only_hashes_files_whose_stat_data_changed(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder, {'a': 'a', 'b': 'b'})
+    _find_changed(dufl_root)
+    create_files_in_folder(temp_folder, {'b': 'c'})
+
+    with patch.object(changes, 'blob_sha', wraps=blob_sha) as hashed:
+        changed, missing = _find_changed(dufl_root)
+
+    assert changed == [files['b']]
+    assert [c[0][0] for c in hashed.call_args_list] == [files['b']]
+
+
+def test_dufl_add_update_commits_changed_files_at_once(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder, {'a': 'a', 'b': 'b', 'c': 'c'})
+    create_files_in_folder(temp_folder, {'a': 'new a', 'c': 'new c'})
+
+    r = cli_run('-r', dufl_root, 'add', '--update')
+
+    assert r.exit_code == 0
+    assert 'Added 2 files' in r.output
+    assert check_output(
+        ['git', 'diff-tree', '--no-commit-id', '--name-only', '-r', 'HEAD'],
+        cwd=dufl_root
+    ).split() == [
+        os.path.join('root', files[n].lstrip('/')) for n in ['a', 'c']
+    ]
+
+
+def test_dufl_add_update_does_nothing_when_nothing_changed(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder, {'a': 'a'})
+    head = check_output(['git', 'rev-parse', 'HEAD'], cwd=dufl_root)
+
+    r = cli_run('-r', dufl_root, 'add', '--update')
+
+    assert r.exit_code == 0
+    assert 'Nothing changed.' in r.output
+    assert check_output(['git', 'rev-parse', 'HEAD'], cwd=dufl_root) == head
+
+
+def test_dufl_add_update_does_not_revert_newer_versions_from_the_repository(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder, {'a': 'a', 'b': 'b'})
+    # Another host committed a new version of a, which was fetched but
+    # not checked out yet
+    context = create_initial_context(dufl_root)
+    with open(get_dufl_file_path(files['a'], context), 'w') as f:
+        f.write('a from another host')
+    check_output(['git', 'commit', '-q', '-a', '-m', 'Fetched'], cwd=dufl_root)
+    past = time.time() - 5
+    create_files_in_folder(temp_folder, {'b': 'new b'})
+    os.utime(files['b'], (past, past))
+
+    r = cli_run('-r', dufl_root, 'add', '--update')
+
+    assert r.exit_code == 0
+    assert 'Outdated: %s' % files['a'] in r.output
+    assert 'Added 1 file (5 bytes), skipped 1 (1 outdated)' in r.output
+    with open(get_dufl_file_path(files['a'], context)) as f:
+        assert f.read() == 'a from another host'
+    with open(get_dufl_file_path(files['b'], context)) as f:
+        assert f.read() == 'new b'
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import re
+import time
+import yaml
+
+from StringIO import StringIO
+from tutils import cli_run, temp_folder, create_files_in_folder, random_data
+from ..chunks import (
+    MANIFEST_MAGIC, MAX_CHUNK, ManifestBroken, assemble, chunk_path, is_manifest,
+    iter_chunks, parse_manifest, store_chunked
+)
+from .. import utils
+
+
+def test_iter_chunks_returns_original_content():
+    data = random_data(600 * 1024)
+    chunks = list(iter_chunks(StringIO(data)))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == data
+
+
+def test_iter_chunks_respects_maximum_chunk_size():
+    data = '\0' * (3 * MAX_CHUNK + 10)
+    chunks = list(iter_chunks(StringIO(data)))
+    assert [len(c) for c in chunks] == [MAX_CHUNK] * 3 + [10]
+
+
+def test_iter_chunks_returns_nothing_for_empty_file():
+    assert list(iter_chunks(StringIO(''))) == []
+
+
+def test_iter_chunks_boundaries_resynchronize_after_a_change():
+    data = random_data(600 * 1024)
+    changed = data[:1000] + 'a small insertion' + data[1000:]
+    original = set(iter_chunks(StringIO(data)))
+    new = list(iter_chunks(StringIO(changed)))
+    assert len([c for c in new if c not in original]) == 1
+
+
+def test_store_chunked_writes_manifest_and_chunks(temp_folder):
+    source = create_files_in_folder(temp_folder, {
+        'big': random_data(300 * 1024)
+    })['big']
+    manifest_file = os.path.join(temp_folder, 'manifest')
+    chunk_root = os.path.join(temp_folder, 'chunks')
+
+    written = store_chunked(source, manifest_file, chunk_root)
+
+    with open(manifest_file) as f:
+        manifest = parse_manifest(f.read())
+    assert written[0] == manifest_file
+    assert written[1:] == [chunk_path(chunk_root, c[0]) for c in manifest['chunks']]
+    assert manifest['size'] == 300 * 1024
+    with open(source) as f:
+        assert manifest['sha256'] == hashlib.sha256(f.read()).hexdigest()
+
+
+def _chunk_files(chunk_root):
+    return [
+        os.path.join(folder, name)
+        for folder, _, names in os.walk(chunk_root) for name in names
+    ]
+
+
+def test_store_chunked_only_writes_new_chunks(temp_folder):
+    data = random_data(600 * 1024)
+    files = create_files_in_folder(temp_folder, {
+        'v1': data,
+        'v2': data + 'appended'
+    })
+    chunk_root = os.path.join(temp_folder, 'chunks')
+    first = store_chunked(files['v1'], os.path.join(temp_folder, 'm1'), chunk_root)
+    mtimes = dict((path, os.path.getmtime(path)) for path in first[1:])
+
+    stored = store_chunked(files['v2'], os.path.join(temp_folder, 'm2'), chunk_root)
+
+    # All the chunks are returned, so any that isn't tracked gets added
+    with open(os.path.join(temp_folder, 'm2')) as f:
+        assert len(stored) == 1 + len(parse_manifest(f.read())['chunks'])
+    new = [path for path in stored[1:] if path not in mtimes]
+    assert len(new) == 1
+    assert len(_chunk_files(chunk_root)) == len(mtimes) + 1
+    for path in mtimes:
+        assert os.path.getmtime(path) == mtimes[path]
+
+
+def test_assemble_restores_content(temp_folder):
+    data = random_data(300 * 1024)
+    source = create_files_in_folder(temp_folder, {'big': data})['big']
+    chunk_root = os.path.join(temp_folder, 'chunks')
+    store_chunked(source, os.path.join(temp_folder, 'manifest'), chunk_root)
+    with open(os.path.join(temp_folder, 'manifest')) as f:
+        manifest = parse_manifest(f.read())
+
+    out = StringIO()
+    assemble(manifest, chunk_root, out)
+
+    assert out.getvalue() == data
+
+
+def test_assemble_raises_on_missing_chunk(temp_folder):
+    manifest = {'size': 1, 'sha256': '', 'chunks': [('ab' * 32, 1)]}
+    try:
+        assemble(manifest, temp_folder, StringIO())
+        assert False
+    except ManifestBroken:
+        assert True
+
+
+def test_parse_manifest_raises_on_other_content():
+    try:
+        parse_manifest('just a file')
+        assert False
+    except ManifestBroken:
+        assert True
+
+
+def _init_with_chunk_threshold(cli_run, dufl_root, remote=None):
+    cli_run('-r', dufl_root, 'init', *([remote] if remote else []))
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'chunk_threshold': 1024})
+    })
+
+
+def test_dufl_add_stores_large_files_as_chunks(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    _init_with_chunk_threshold(cli_run, dufl_root)
+    file_names = create_files_in_folder(temp_folder, {
+        'big/file': random_data(100 * 1024),
+        'small/file': 'hello'
+    })
+
+    cli_run('-r', dufl_root, 'add', file_names['big/file'])
+    cli_run('-r', dufl_root, 'add', file_names['small/file'])
+
+    big = os.path.join(dufl_root, 'root', re.sub('^/', '', file_names['big/file']))
+    small = os.path.join(dufl_root, 'root', re.sub('^/', '', file_names['small/file']))
+    with open(big) as f:
+        assert is_manifest(f.read())
+    with open(small) as f:
+        assert f.read() == 'hello'
+    git = utils.Git('/usr/bin/git', dufl_root)
+    files = git.get_output('ls-files')
+    assert 'chunks/' in files
+
+
+def test_dufl_checkout_assembles_chunked_files(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    _init_with_chunk_threshold(cli_run, dufl_root)
+    data = random_data(100 * 1024)
+    file_names = create_files_in_folder(temp_folder, {'big/file': data})
+    cli_run('-r', dufl_root, 'add', file_names['big/file'])
+    os.unlink(file_names['big/file'])
+
+    cli_run('-r', dufl_root, 'checkout', file_names['big/file'])
+
+    with open(file_names['big/file']) as f:
+        assert f.read() == data
+
+
+def test_dufl_checkout_compares_chunked_files_with_local_copy(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    _init_with_chunk_threshold(cli_run, dufl_root)
+    data = random_data(100 * 1024)
+    file_names = create_files_in_folder(temp_folder, {'big/file': data})
+    cli_run('-r', dufl_root, 'add', file_names['big/file'])
+
+    # Timestamps have 1 sec granularity, so wait a bit!
+    time.sleep(1)
+    with open(file_names['big/file'], 'a') as f:
+        f.write('local change')
+
+    r = cli_run('-r', dufl_root, 'checkout', file_names['big/file'])
+
+    assert 'It looks like you have local modifications' in r.output
+
+
+def test_dufl_checkout_overwrites_unchanged_chunked_files(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    _init_with_chunk_threshold(cli_run, dufl_root)
+    file_names = create_files_in_folder(temp_folder, {
+        'big/file': random_data(100 * 1024)
+    })
+    cli_run('-r', dufl_root, 'add', file_names['big/file'])
+
+    r = cli_run('-r', dufl_root, 'checkout', file_names['big/file'])
+
+    assert r.exit_code == 0
+    assert 'Copying' in r.output
+
+
+def test_dufl_add_tracks_chunks_left_by_a_failed_add(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    _init_with_chunk_threshold(cli_run, dufl_root)
+    file_names = create_files_in_folder(temp_folder, {
+        'big/file': random_data(600 * 1024)
+    })
+    # Chunks written to the chunk store, but never committed
+    left = store_chunked(
+        file_names['big/file'], os.path.join(temp_folder, 'manifest'),
+        os.path.join(dufl_root, 'chunks')
+    )[1:]
+
+    for command in ['add', 'import']:
+        r = cli_run('-r', dufl_root, command, file_names['big/file'])
+        assert r.exit_code == 0
+        tracked = utils.Git('/usr/bin/git', dufl_root).get_output('ls-files', 'chunks')
+        for path in left:
+            assert os.path.relpath(path, dufl_root) in tracked
+        utils.Git('/usr/bin/git', dufl_root).run('rm', '-q', '--cached', '-r', 'chunks')
+        utils.Git('/usr/bin/git', dufl_root).run('commit', '-q', '-m', 'Untrack chunks')
+
+
+def test_dufl_add_escapes_files_that_look_like_manifests(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    content = MANIFEST_MAGIC + 'size 3\nsha256 abc\n'
+    file_names = create_files_in_folder(temp_folder, {'notes': content})
+
+    r = cli_run('-r', dufl_root, 'add', file_names['notes'])
+    assert r.exit_code == 0
+    os.unlink(file_names['notes'])
+    r = cli_run('-r', dufl_root, 'checkout', file_names['notes'])
+
+    assert r.exit_code == 0
+    with open(file_names['notes']) as f:
+        assert f.read() == content
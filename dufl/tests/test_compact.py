@@ -0,0 +1,184 @@
+import os
+import time
+
+from mock import patch
+from subprocess import check_output
+from tutils import cli_run, temp_folder, create_files_in_folder
+from .. import utils
+from ..compact import BACKUP_REF, parse_policy
+
+
+DAY = 86400
+
+
+def _at(timestamp):
+    """ Patch the environment so git commits are made at the given time """
+    date = '%d +0000' % timestamp
+    return patch.dict(os.environ, {
+        'GIT_AUTHOR_DATE': date, 'GIT_COMMITTER_DATE': date
+    })
+
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _setup(cli_run, temp_folder):
+    """ Create a dufl root with 6 commits 10 and 9 days ago, and 1 today """
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    files = create_files_in_folder(temp_folder, {'a': 'v1', 'b': 'b', 'c': 'c'})
+    day_10 = (int(time.time()) // DAY - 10) * DAY + 3600
+    day_9 = day_10 + DAY
+    with _at(day_10):
+        cli_run('-r', dufl_root, 'init')
+        cli_run('-r', dufl_root, 'add', files['a'])
+    with _at(day_10 + 60):
+        _write(files['a'], 'v2')
+        cli_run('-r', dufl_root, 'add', files['a'])
+    with _at(day_10 + 120):
+        cli_run('-r', dufl_root, 'add', files['b'])
+    with _at(day_9):
+        _write(files['a'], 'v3')
+        cli_run('-r', dufl_root, 'add', files['a'])
+        cli_run('-r', dufl_root, 'add', files['c'])
+    _write(files['a'], 'v4')
+    cli_run('-r', dufl_root, 'add', files['a'])
+    return dufl_root, files
+
+
+def _log(dufl_root):
+    return check_output(
+        ['git', 'log', '--format=%s', 'master'], cwd=dufl_root
+    ).strip().split("\n")
+
+
+def test_parse_policy():
+    assert parse_policy('30d') == (30 * DAY, DAY)
+    assert parse_policy('12w:1w') == (12 * 7 * DAY, 7 * DAY)
+    assert parse_policy('6h:1h') == (6 * 3600, 3600)
+    for policy in ['30', '1m', '30d:0d', 'd']:
+        try:
+            parse_policy(policy)
+            assert False
+        except ValueError:
+            assert True
+
+
+def test_dufl_compact_squashes_old_commits_into_daily_snapshots(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    git = utils.Git('/usr/bin/git', dufl_root)
+    head = git.get_output('rev-parse', 'master').strip()
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '5d')
+
+    assert r.exit_code == 0
+    assert 'Compacted 7 commits into 3' in r.output
+    assert 'History probes took' in r.output
+    log = _log(dufl_root)
+    assert len(log) == 3
+    assert log[0] == 'Update.'
+    assert log[1].startswith('Snapshot of 2 commits')
+    assert log[2].startswith('Snapshot of 4 commits')
+    # Same files, and the previous history is kept
+    assert git.get_output('rev-parse', 'master^{tree}') == git.get_output('rev-parse', head + '^{tree}')
+    assert git.get_output('rev-parse', BACKUP_REF).strip() == head
+    # The snapshot of each day has the last version of each file that day
+    a_path = os.path.relpath(files['a'], '/')
+    assert git.get_output('show', 'master~2:root/%s' % a_path) == 'v2'
+    assert git.get_output('show', 'master~1:root/%s' % a_path) == 'v3'
+    assert git.test('cat-file', '-e', 'master~2:root/%s' % os.path.relpath(files['b'], '/'))
+    assert not git.test('cat-file', '-e', 'master~2:root/%s' % os.path.relpath(files['c'], '/'))
+
+
+def test_dufl_compact_keeps_recent_commits_and_dates(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    recent_date = check_output(['git', 'log', '-1', '--format=%ad %cd %an', 'master'], cwd=dufl_root)
+
+    cli_run('-r', dufl_root, 'compact', '--keep', '9d:1w')
+
+    assert check_output(['git', 'log', '-1', '--format=%ad %cd %an', 'master'], cwd=dufl_root) == recent_date
+    # Lookups by modification time still find the recent version
+    r = cli_run('-r', dufl_root, 'checkout', files['a'])
+    assert r.exit_code == 0
+
+
+def test_dufl_compact_does_nothing_without_old_history(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    cli_run('-r', dufl_root, 'add', files['a'])
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '1d')
+
+    assert r.exit_code == 0
+    assert 'Nothing to compact: 2 commits' in r.output
+    assert len(_log(dufl_root)) == 2
+
+
+def test_dufl_compact_refuses_invalid_policies(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', 'forever')
+
+    assert r.exit_code != 0
+    assert 'Invalid retention policy' in r.output
+
+
+def test_dufl_compact_does_not_replace_previous_backup_unless_forced(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    git = utils.Git('/usr/bin/git', dufl_root)
+    original = git.get_output('rev-parse', 'master').strip()
+    cli_run('-r', dufl_root, 'compact', '--keep', '5d')
+    compacted = git.get_output('rev-parse', 'master').strip()
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '1h:10000w')
+
+    assert r.exit_code != 0
+    assert 'use --force to replace it' in r.output
+    assert git.get_output('rev-parse', BACKUP_REF).strip() == original
+    assert git.get_output('rev-parse', 'master').strip() == compacted
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '1h:10000w', '--force')
+
+    assert r.exit_code == 0
+    assert 'Compacted 3 commits into 2' in r.output
+    assert git.get_output('rev-parse', BACKUP_REF).strip() == compacted
+
+
+def test_dufl_compact_refuses_to_rewrite_published_history(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    git = utils.Git('/usr/bin/git', dufl_root)
+    original = git.get_output('rev-parse', 'master').strip()
+    # As if the first commits had been pushed
+    git.run('update-ref', 'refs/remotes/origin/master', 'master~5')
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '5d')
+
+    assert r.exit_code != 0
+    assert 'already on origin/master' in r.output
+    assert git.get_output('rev-parse', 'master').strip() == original
+    assert not git.test('rev-parse', '--verify', '--quiet', BACKUP_REF)
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '5d', '--rewrite-published')
+
+    assert r.exit_code == 0
+    assert 'Compacted 7 commits into 3' in r.output
+    assert 'git push --force origin master' in r.output
+
+
+def test_dufl_compact_allows_history_that_is_not_published(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    git = utils.Git('/usr/bin/git', dufl_root)
+    # The remote has a history of its own
+    unrelated = git.get_output(
+        'commit-tree', '-m', 'Other history', 'master^{tree}'
+    ).strip()
+    git.run('update-ref', 'refs/remotes/origin/master', unrelated)
+
+    r = cli_run('-r', dufl_root, 'compact', '--keep', '5d')
+
+    assert r.exit_code == 0
+    assert 'Compacted 7 commits into 3' in r.output
+    assert 'git push --force' not in r.output
@@ -0,0 +1,104 @@
+import os
+import sys
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+from ..complete import complete, main
+from ..index import IndexEntry, TrackedIndex, write_index
+
+
+HOME = '/home/user'
+
+
+def _index(temp_folder, paths):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    write_index(file_name, None, [
+        IndexEntry(path, 'ab' * 20, 0o100644, 1) for path in paths
+    ])
+    return TrackedIndex(file_name)
+
+
+PATHS = [
+    'home/.config/fish/config.fish',
+    'home/.config/nvim/init.vim',
+    'home/.config/nvim/lua/plugins.lua',
+    'home/.vimrc',
+    'home/.zshrc',
+    'root/etc/hosts',
+    'root/etc/nginx.conf',
+    'root/etc/nginx/nginx.conf',
+    'settings.yaml'
+]
+
+
+def test_complete_lists_next_component_only(temp_folder):
+    index = _index(temp_folder, PATHS)
+    assert complete(index, '~/', home=HOME) == [
+        '~/.config/', '~/.vimrc', '~/.zshrc'
+    ]
+    assert complete(index, '~/.config/nv', home=HOME) == ['~/.config/nvim/']
+    assert complete(index, '~/.config/nvim/', home=HOME) == [
+        '~/.config/nvim/init.vim', '~/.config/nvim/lua/'
+    ]
+
+
+def test_complete_handles_absolute_and_relative_paths(temp_folder):
+    index = _index(temp_folder, PATHS)
+    assert complete(index, '/etc/ng', home=HOME) == [
+        '/etc/nginx.conf', '/etc/nginx/'
+    ]
+    assert complete(index, 'ng', home=HOME, cwd='/etc') == [
+        'nginx.conf', 'nginx/'
+    ]
+    assert complete(index, '.config/f', home=HOME, cwd=HOME) == ['.config/fish/']
+    assert complete(index, '', home=HOME, cwd='/etc') == [
+        'hosts', 'nginx.conf', 'nginx/'
+    ]
+
+
+def test_complete_returns_nothing_for_untracked_prefixes(temp_folder):
+    index = _index(temp_folder, PATHS)
+    assert complete(index, '/usr/', home=HOME) == []
+    assert complete(index, 'settings', home=HOME, cwd='/') == []
+
+
+def test_main_prints_completions_from_the_root_index(temp_folder, capsys):
+    files = create_files_in_folder(temp_folder, {'etc/hosts': 'x'})
+    write_index(
+        os.path.join(temp_folder, '.dufl', '.git', 'dufl', 'tracked.idx'), None,
+        [IndexEntry('root' + files['etc/hosts'], 'ab' * 20, 0o100644, 1)]
+    )
+
+    main(['--root', os.path.join(temp_folder, '.dufl'), '--', os.path.join(temp_folder, 'e')])
+
+    out, err = capsys.readouterr()
+    assert out == os.path.join(temp_folder, 'etc') + "/\n"
+
+
+def test_main_completes_files_added_since_the_index_was_built(cli_run, temp_folder, capsys):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'first': 'a', 'second': 'b'})
+    cli_run('-r', dufl_root, 'add', files['first'])
+    cli_run('-r', dufl_root, 'ls')
+    cli_run('-r', dufl_root, 'add', files['second'])
+    capsys.readouterr()
+
+    main(['--root', dufl_root, '--', os.path.join(temp_folder, 's')])
+
+    out, err = capsys.readouterr()
+    assert out == files['second'] + "\n"
+
+
+def test_main_prints_nothing_without_index(temp_folder, capsys):
+    main(['--root', temp_folder, 'anything'])
+    out, err = capsys.readouterr()
+    assert out == ''
+
+
+def test_dufl_completion_outputs_script_using_current_python(cli_run):
+    r = cli_run('completion', 'bash')
+
+    assert r.exit_code == 0
+    assert 'complete -F _dufl dufl' in r.output
+    assert '%s -m dufl.complete' % sys.executable in r.output
+    assert 'checkout|ls)' in r.output
@@ -0,0 +1,304 @@
+import hashlib
+import hmac
+import os
+import stat
+import struct
+import time
+import yaml
+
+from Crypto.Cipher import AES
+from StringIO import StringIO
+from binascii import hexlify, unhexlify
+from mock import patch
+from tutils import (
+    cli_run, temp_folder, create_files_in_folder, dufl_path, random_data
+)
+from ..encryption import (
+    ENCRYPTED_MAGIC, Cipher, DecryptionFailed, EncryptionKeyMissing,
+    derive_key, get_cipher, header_tag, is_encrypted, store_encrypted
+)
+from .. import utils
+
+
+KEY = 'k' * 32
+
+
+def _encrypt(cipher, source):
+    out = StringIO()
+    cipher.encrypt(source, out)
+    return out.getvalue()
+
+
+def _decrypt(cipher, content):
+    f = StringIO(content)
+    assert is_encrypted(f.read(len(ENCRYPTED_MAGIC)))
+    out = StringIO()
+    cipher.decrypt(f, out)
+    return out.getvalue()
+
+
+# Known answer for the encryption of TEST_VECTOR with KEY. This must
+# never change: files encrypted by earlier versions must still decrypt.
+TEST_VECTOR = 'dufl test vector\n'
+TEST_VECTOR_ENCRYPTED = (
+    '6475666c2d656e63727970742d76310a'
+    'e7c8fdd850f5fbb22cb226533e10ce41a6fc2098ba60e3eddfa49e90d4dc751b'
+    'b08b042b2c53b2b8bbc6bf09cc9ac3d4'
+    '00000011'
+    '538c90cc23ccf3ec9b9544a5ca208e9e16'
+)
+
+
+def test_derive_key_known_answers():
+    assert hexlify(derive_key(KEY, 'authentication')) == (
+        'b7b3ad86a234936ba9e6626e2e79feaabe2c11c56dc4a87dda6fc2c882373499'
+    )
+    assert hexlify(derive_key(KEY, 'encryption')) == (
+        '0bbeb2f5327eb0dfc320d622cb5e4e11fee926a87e717b95e8571a27f880e698'
+    )
+
+
+def test_encryption_known_answer(temp_folder):
+    source = create_files_in_folder(temp_folder, {'f': TEST_VECTOR})['f']
+    cipher = Cipher(KEY)
+
+    encrypted = _encrypt(cipher, source)
+
+    assert hexlify(encrypted) == TEST_VECTOR_ENCRYPTED
+    assert _decrypt(cipher, unhexlify(TEST_VECTOR_ENCRYPTED)) == TEST_VECTOR
+
+
+def test_encryption_follows_the_documented_construction(temp_folder):
+    data = random_data(200)
+    source = create_files_in_folder(temp_folder, {'f': data})['f']
+    mac_key = hmac.new(KEY, 'dufl authentication', hashlib.sha256).digest()
+    siv_key = (
+        hmac.new(KEY, 'dufl chunk authentication', hashlib.sha256).digest() +
+        hmac.new(KEY, 'dufl encryption', hashlib.sha256).digest()
+    )
+    tag = hmac.new(mac_key, data, hashlib.sha256).digest()
+    chunk, siv = AES.new(siv_key, AES.MODE_SIV).encrypt_and_digest(data)
+
+    encrypted = _encrypt(Cipher(KEY), source)
+
+    assert encrypted == (
+        ENCRYPTED_MAGIC + tag + siv + struct.pack('>I', len(data)) + chunk
+    )
+
+
+def test_encryption_is_deterministic_and_reversible(temp_folder):
+    data = random_data(200 * 1024)
+    source = create_files_in_folder(temp_folder, {'secret': data})['secret']
+    cipher = Cipher(KEY)
+
+    encrypted = _encrypt(cipher, source)
+
+    assert encrypted == _encrypt(Cipher(KEY), source)
+    assert encrypted != _encrypt(Cipher('x' * 32), source)
+    assert data not in encrypted
+    assert _decrypt(cipher, encrypted) == data
+    assert header_tag(encrypted) == cipher.content_tag(source)
+
+
+def test_encryption_of_empty_file(temp_folder):
+    source = create_files_in_folder(temp_folder, {'empty': ''})['empty']
+    cipher = Cipher(KEY)
+
+    assert _decrypt(cipher, _encrypt(cipher, source)) == ''
+
+
+def test_encrypted_chunks_survive_an_insertion(temp_folder):
+    data = random_data(600 * 1024)
+    files = create_files_in_folder(temp_folder, {
+        'v1': data,
+        'v2': data[:1000] + 'a small insertion' + data[1000:]
+    })
+    cipher = Cipher(KEY)
+
+    v1 = _encrypt(cipher, files['v1'])
+    v2 = _encrypt(cipher, files['v2'])
+
+    # Only the first chunk differs, so most of the encrypted content is shared
+    tail = v1[len(v1) - 300 * 1024:]
+    assert tail in v2
+
+
+def test_decrypt_detects_tampering_and_wrong_key(temp_folder):
+    source = create_files_in_folder(temp_folder, {'secret': 'password=1234'})['secret']
+    encrypted = _encrypt(Cipher(KEY), source)
+    tampered = encrypted[:-1] + chr(ord(encrypted[-1]) ^ 1)
+
+    for content, key in [(tampered, KEY), (encrypted, 'x' * 32), (encrypted[:-3], KEY)]:
+        try:
+            _decrypt(Cipher(key), content)
+            assert False
+        except DecryptionFailed:
+            assert True
+
+
+def test_store_encrypted_skips_unchanged_content(temp_folder):
+    files = create_files_in_folder(temp_folder, {'secret': 'password=1234'})
+    dest = os.path.join(temp_folder, 'stored', 'secret')
+    cipher = Cipher(KEY)
+    store_encrypted(files['secret'], dest, cipher)
+    mtime = int(os.path.getmtime(dest)) - 10
+    os.utime(dest, (mtime, mtime))
+
+    store_encrypted(files['secret'], dest, cipher)
+    assert os.path.getmtime(dest) == mtime
+
+    with open(files['secret'], 'w') as f:
+        f.write('password=5678')
+    store_encrypted(files['secret'], dest, cipher)
+    assert os.path.getmtime(dest) != mtime
+
+
+def test_get_cipher_requires_pycryptodome(temp_folder):
+    key_file = create_files_in_folder(temp_folder, {'key': KEY})['key']
+    with patch('dufl.encryption.AES', None):
+        try:
+            get_cipher({'encryption_key_file': key_file})
+            assert False
+        except EncryptionKeyMissing as e:
+            assert 'pycryptodome' in str(e)
+
+
+def test_get_cipher_requires_a_long_enough_key(temp_folder):
+    key_file = create_files_in_folder(temp_folder, {'key': 'short'})['key']
+    for context in [{}, {'encryption_key_file': key_file}]:
+        try:
+            get_cipher(context)
+            assert False
+        except EncryptionKeyMissing:
+            assert True
+
+
+def _init_with_key(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    key_file = create_files_in_folder(temp_folder, {'dufl.key': KEY})['dufl.key']
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'encryption_key_file': key_file})
+    })
+    return dufl_root
+
+
+def test_dufl_add_encrypts_suspicious_files(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {'.ssh/id_rsa': 'private key'})
+
+    r = cli_run('-r', dufl_root, 'add', files['.ssh/id_rsa'])
+
+    assert r.exit_code == 0
+    assert 'will be encrypted because this looks like a private key' in r.output
+    with open(dufl_path(dufl_root, files['.ssh/id_rsa'])) as f:
+        stored = f.read()
+    assert is_encrypted(stored)
+    assert 'private key' not in stored
+
+
+def test_dufl_add_encrypts_on_request_and_keeps_encrypting(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {'config': 'token=1'})
+    cli_run('-r', dufl_root, 'add', '--encrypt', files['config'])
+    git = utils.Git('/usr/bin/git', dufl_root)
+    first = git.get_output('rev-parse', 'HEAD:' + os.path.relpath(
+        dufl_path(dufl_root, files['config']), dufl_root
+    ))
+
+    r = cli_run('-r', dufl_root, 'add', files['config'])
+    assert 'Nothing changed' in r.output
+
+    time.sleep(1)
+    with open(files['config'], 'w') as f:
+        f.write('token=2')
+    r = cli_run('-r', dufl_root, 'add', '--update')
+
+    assert r.exit_code == 0
+    with open(dufl_path(dufl_root, files['config'])) as f:
+        assert is_encrypted(f.read())
+    assert git.get_output('rev-parse', 'HEAD~1:' + os.path.relpath(
+        dufl_path(dufl_root, files['config']), dufl_root
+    )) == first
+
+
+def test_dufl_checkout_decrypts_files(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {'.ssh/id_rsa': 'private key'})
+    cli_run('-r', dufl_root, 'add', files['.ssh/id_rsa'])
+
+    r = cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'])
+    assert r.exit_code == 0
+
+    os.unlink(files['.ssh/id_rsa'])
+    r = cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'])
+
+    assert r.exit_code == 0
+    with open(files['.ssh/id_rsa']) as f:
+        assert f.read() == 'private key'
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_dufl_checkout_keeps_decrypted_files_private(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {'.ssh/id_rsa': 'private key'})
+    os.chmod(files['.ssh/id_rsa'], 0o600)
+    cli_run('-r', dufl_root, 'add', files['.ssh/id_rsa'])
+
+    r = cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'])
+
+    assert r.exit_code == 0
+    assert _mode(files['.ssh/id_rsa']) == 0o600
+    # New files are only readable by their owner, as are those
+    # written in a transaction
+    for options in [[], ['--transaction']]:
+        os.unlink(files['.ssh/id_rsa'])
+        r = cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'], *options)
+        assert r.exit_code == 0
+        assert _mode(files['.ssh/id_rsa']) == 0o600
+    # Existing files keep their mode
+    os.chmod(files['.ssh/id_rsa'], 0o640)
+    cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'], '--transaction')
+    assert _mode(files['.ssh/id_rsa']) == 0o640
+
+
+def test_dufl_checkout_reports_missing_key(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {'.ssh/id_rsa': 'private key'})
+    cli_run('-r', dufl_root, 'add', files['.ssh/id_rsa'])
+    os.unlink(files['.ssh/id_rsa'])
+    os.unlink(os.path.join(temp_folder, 'dufl.key'))
+
+    r = cli_run('-r', dufl_root, 'checkout', files['.ssh/id_rsa'])
+
+    assert r.exit_code != 0
+    assert 'Could not read the encryption key' in r.output
+
+
+def test_dufl_import_and_restore_handle_encrypted_files(cli_run, temp_folder):
+    dufl_root = _init_with_key(cli_run, temp_folder)
+    files = create_files_in_folder(temp_folder, {
+        'keys/id_rsa': 'private key', 'keys/notes': 'notes'
+    })
+
+    r = cli_run('-r', dufl_root, 'import', os.path.join(temp_folder, 'keys'))
+
+    assert r.exit_code == 0
+    with open(dufl_path(dufl_root, files['keys/id_rsa'])) as f:
+        assert is_encrypted(f.read())
+    r = cli_run('-r', dufl_root, 'restore', '--at', 'HEAD', '--dry-run')
+    assert 'update' not in r.output
+    with open(files['keys/id_rsa'], 'w') as f:
+        f.write('changed')
+
+    r = cli_run('-r', dufl_root, 'restore', '--at', 'HEAD')
+
+    assert r.exit_code == 0
+    with open(files['keys/id_rsa']) as f:
+        assert f.read() == 'private key'
+    os.unlink(files['keys/id_rsa'])
+    cli_run('-r', dufl_root, 'restore', '--at', 'HEAD')
+    assert _mode(files['keys/id_rsa']) == 0o600
@@ -0,0 +1,113 @@
+import os
+
+from tutils import cli_run, cli_run_within_budget, git, temp_folder
+from tutils import create_files_in_folder
+from .. import utils
+
+
+# Number of files used by the budget tests. Commands that spawn git
+# processes per file exceed their budget at this size.
+FILES = 20
+
+
+def _setup(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, dict(
+        ('files/f%d' % i, 'content %d' % i) for i in range(FILES)
+    ))
+    return dufl_root, sorted(files.values())
+
+
+def test_git_spawned_counts_processes_per_subcommand(git):
+    before = dict(utils.Git.spawned)
+
+    git.get_output('rev-parse', 'HEAD')
+    git.test('-c', 'core.quotepath=off', 'rev-parse', 'HEAD')
+    list(git.iter_lines('log', '--format=%H'))
+
+    assert utils.Git.spawned['rev-parse'] - before.get('rev-parse', 0) == 2
+    assert utils.Git.spawned['log'] - before.get('log', 0) == 1
+
+
+def test_cli_run_within_budget_fails_over_budget(cli_run_within_budget, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    try:
+        cli_run_within_budget({'init': 0}, '-r', dufl_root, 'init')
+        assert False
+    except AssertionError as e:
+        assert 'exceeded its git process budget (init: 1 > 0)' in str(e)
+
+
+def test_dufl_add_folder_budget(cli_run, cli_run_within_budget, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+
+    r = cli_run_within_budget(
+        2, '-r', dufl_root, 'add', os.path.join(temp_folder, 'files')
+    )
+
+    assert r.exit_code == 0
+    assert r.git_processes == {'add': 1, 'commit': 1}
+
+
+def test_dufl_add_update_budget(cli_run, cli_run_within_budget, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'files'))
+    for path in files:
+        with open(path, 'a') as f:
+            f.write('changed')
+
+    # Includes building the index of tracked files, reading the time of
+    # HEAD to tell edits from outdated files, and refreshing the index
+    # after the commit
+    r = cli_run_within_budget(8, '-r', dufl_root, 'add', '--update')
+
+    assert r.exit_code == 0
+    assert 'Added %d files' % FILES in r.output
+
+
+def test_dufl_import_budget(cli_run, cli_run_within_budget, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+
+    r = cli_run_within_budget(
+        {'fast-import': 1, 'total': 5},
+        '-r', dufl_root, 'import', os.path.join(temp_folder, 'files')
+    )
+
+    assert r.exit_code == 0
+
+
+def test_dufl_checkout_budget(cli_run, cli_run_within_budget, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'files'))
+
+    # Missing files are copied without looking at the history
+    for path in files:
+        os.unlink(path)
+    r = cli_run_within_budget(0, '-r', dufl_root, 'checkout', *files)
+    assert r.exit_code == 0
+
+    # Existing files are compared with their version at their
+    # modification time: the commit at that time is found once, and
+    # the versions are read through a single cat-file process.
+    r = cli_run_within_budget(
+        {'rev-list': 1, 'branch': 1, 'cat-file': 1, 'total': 5},
+        '-r', dufl_root, 'checkout', '--all'
+    )
+    assert r.exit_code == 0
+
+
+def test_dufl_ls_restore_plan_and_apply_budgets(cli_run, cli_run_within_budget, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'files'))
+    for path in files:
+        os.unlink(path)
+    plan_file = os.path.join(temp_folder, 'plan.json')
+
+    assert cli_run_within_budget(3, '-r', dufl_root, 'ls').exit_code == 0
+    assert cli_run_within_budget(2, '-r', dufl_root, 'plan', '-o', plan_file).exit_code == 0
+    assert cli_run_within_budget(1, '-r', dufl_root, 'apply', plan_file).exit_code == 0
+    r = cli_run_within_budget(
+        {'archive': 1, 'total': 3}, '-r', dufl_root, 'restore', '--at', 'HEAD'
+    )
+    assert r.exit_code == 0
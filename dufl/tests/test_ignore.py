@@ -0,0 +1,165 @@
+import os
+
+from subprocess import check_output
+
+from tutils import cli_run, temp_folder, create_files_in_folder, dufl_path
+from ..ignore import IgnoreRules, walk
+
+
+def _rules(*lines):
+    return IgnoreRules().add_patterns('', lines)
+
+
+def test_patterns_without_slash_match_at_any_depth():
+    rules = _rules('*.swp')
+    assert rules.is_ignored('a.swp', False)
+    assert rules.is_ignored('sub/folder/a.swp', False)
+    assert not rules.is_ignored('a.swpx', False)
+
+
+def test_patterns_with_slash_are_anchored():
+    rules = _rules('/cache', 'sub/*.log')
+    assert rules.is_ignored('cache', True)
+    assert not rules.is_ignored('sub/cache', True)
+    assert rules.is_ignored('sub/a.log', False)
+    assert not rules.is_ignored('sub/deeper/a.log', False)
+    assert not rules.is_ignored('other/sub/a.log', False)
+
+
+def test_double_star_matches_any_number_of_folders():
+    rules = _rules('a/**/b', '**/plugged')
+    assert rules.is_ignored('a/b', False)
+    assert rules.is_ignored('a/x/y/b', False)
+    assert rules.is_ignored('x/y/plugged', True)
+
+
+def test_trailing_slash_only_matches_folders():
+    rules = _rules('build/')
+    assert rules.is_ignored('build', True)
+    assert not rules.is_ignored('build', False)
+
+
+def test_last_matching_pattern_wins():
+    rules = _rules('# comment', '', '*.json', '!settings.json')
+    assert rules.is_ignored('a.json', False)
+    assert not rules.is_ignored('settings.json', False)
+    assert not rules.is_ignored('# comment', False)
+
+
+def test_nested_patterns_are_relative_to_their_folder():
+    rules = _rules('*.tmp').add_patterns('sub', ['/local'])
+    assert rules.is_ignored('sub/local', False)
+    assert not rules.is_ignored('local', False)
+    assert rules.is_ignored('sub/a.tmp', False)
+
+
+def test_walk_honours_duflignore_files(temp_folder):
+    create_files_in_folder(temp_folder, {
+        'conf/.duflignore': "*.swp\ncache/\n",
+        'conf/init.vim': 'a',
+        'conf/init.vim.swp': 'b',
+        'conf/cache/x': 'c',
+        'conf/lua/.duflignore': "!keep.swp\n",
+        'conf/lua/plugins.lua': 'd',
+        'conf/lua/keep.swp': 'e'
+    })
+    folder = os.path.join(temp_folder, 'conf')
+
+    result = dict(walk(folder))
+
+    assert sorted(p for p, r in result.items() if r is None) == [
+        os.path.join(folder, '.duflignore'),
+        os.path.join(folder, 'init.vim'),
+        os.path.join(folder, 'lua/.duflignore'),
+        os.path.join(folder, 'lua/keep.swp'),
+        os.path.join(folder, 'lua/plugins.lua')
+    ]
+    assert result[os.path.join(folder, 'init.vim.swp')] == 'ignored'
+    assert os.path.join(folder, 'cache/x') not in result
+
+
+def test_walk_skips_duflignore_files_that_ignore_themselves(temp_folder):
+    files = create_files_in_folder(temp_folder, {
+        '.duflignore': ".duflignore\n*.bak\n",
+        'a': 'a'
+    })
+
+    result = dict(walk(temp_folder))
+
+    assert result[files['.duflignore']] == 'ignored'
+    assert result[files['a']] is None
+
+
+def test_walk_skips_special_and_large_files(temp_folder):
+    files = create_files_in_folder(temp_folder, {
+        'small': 'a',
+        'large': 'b' * 100
+    })
+    os.mkfifo(os.path.join(temp_folder, 'fifo'))
+    os.symlink(os.path.join(temp_folder, 'missing'), os.path.join(temp_folder, 'link'))
+
+    result = dict(walk(temp_folder, max_file_size=10))
+
+    assert result[files['small']] is None
+    assert result[files['large']] == 'larger than max_file_size'
+    assert result[os.path.join(temp_folder, 'fifo')] == 'not a regular file'
+    assert result[os.path.join(temp_folder, 'link')] == 'broken link'
+
+
+def test_walk_does_not_descend_into_excluded_folders(temp_folder):
+    create_files_in_folder(temp_folder, {'.dufl/a': 'a', 'b': 'b'})
+
+    result = dict(walk(temp_folder, exclude=[os.path.join(temp_folder, '.dufl')]))
+
+    assert list(result.keys()) == [os.path.join(temp_folder, 'b')]
+
+
+def test_dufl_add_adds_folder_in_a_single_commit(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {
+        'nginx/.duflignore': "*.bak\n",
+        'nginx/nginx.conf': 'a',
+        'nginx/nginx.conf.bak': 'b',
+        'nginx/sites/default': 'c'
+    })
+
+    r = cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'nginx'))
+
+    assert r.exit_code == 0
+    assert 'Added 3 files (8 bytes), skipped 1 (1 ignored).' in r.output
+    assert os.path.isfile(dufl_path(dufl_root, files['nginx/.duflignore']))
+    assert os.path.isfile(dufl_path(dufl_root, files['nginx/nginx.conf']))
+    assert os.path.isfile(dufl_path(dufl_root, files['nginx/sites/default']))
+    assert not os.path.exists(dufl_path(dufl_root, files['nginx/nginx.conf.bak']))
+    # The initial settings commit, and a single commit for the folder
+    assert check_output(
+        ['git', 'rev-list', '--count', 'HEAD'], cwd=dufl_root
+    ).strip() == '2'
+
+
+def test_dufl_add_folder_adds_nothing_if_a_file_is_suspicious(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {
+        'ssh/config': 'a',
+        'ssh/id_rsa': 'b'
+    })
+
+    r = cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'ssh'))
+
+    assert r.exit_code != 0
+    assert '%s won\'t be added because this looks like a private key' % files['ssh/id_rsa'] in r.output
+    assert not os.path.exists(dufl_path(dufl_root, files['ssh/config']))
+
+
+def test_dufl_add_does_not_commit_when_nothing_changed(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(temp_folder, {'conf/a': 'a'})
+    cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'conf'))
+
+    r = cli_run('-r', dufl_root, 'add', os.path.join(temp_folder, 'conf'))
+
+    assert r.exit_code == 0
+    assert 'Nothing changed.' in r.output
@@ -0,0 +1,110 @@
+import os
+import yaml
+
+from subprocess import check_output
+
+from tutils import (
+    cli_run, temp_folder, create_files_in_folder, dufl_path, read_file
+)
+from ..importer import quote_path
+
+
+def _git(dufl_root, *command):
+    return check_output(['git'] + list(command), cwd=dufl_root)
+
+
+def test_quote_path_only_quotes_when_needed():
+    assert quote_path('home/.vimrc') == 'home/.vimrc'
+    assert quote_path('home/with space') == 'home/with space'
+    assert quote_path('home/new\nline') == '"home/new\\nline"'
+    assert quote_path('"quoted"') == '"\\"quoted\\""'
+
+
+def test_dufl_import_commits_all_files_at_once(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {
+        'dotfiles/.duflignore': "*.bak\n",
+        'dotfiles/vimrc': 'vim',
+        'dotfiles/vimrc.bak': 'old vim',
+        'dotfiles/zsh/zshrc': 'zsh',
+        'single': 'single'
+    })
+
+    r = cli_run('-r', dufl_root, 'import', '-m', 'Migrate',
+                os.path.join(temp_folder, 'dotfiles'), files['single'])
+
+    assert r.exit_code == 0
+    assert 'Imported 4 files (18 bytes), skipped 1 (1 ignored) in 1 commit.' in r.output
+    assert _git(dufl_root, 'rev-list', '--count', 'HEAD').strip() == '2'
+    assert _git(dufl_root, 'log', '-1', '--format=%s').strip() == 'Migrate'
+    for name in ['dotfiles/.duflignore', 'dotfiles/vimrc', 'dotfiles/zsh/zshrc', 'single']:
+        assert read_file(dufl_path(dufl_root, files[name])) == read_file(files[name])
+    assert not os.path.exists(dufl_path(dufl_root, files['dotfiles/vimrc.bak']))
+    # The working tree and index match the new commit
+    assert _git(dufl_root, 'status', '--porcelain') == ''
+
+
+def test_dufl_import_makes_one_commit_per_batch(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(temp_folder, dict(
+        ('many/%d' % i, str(i)) for i in range(5)
+    ))
+
+    r = cli_run('-r', dufl_root, 'import', '--batch-size', '2',
+                os.path.join(temp_folder, 'many'))
+
+    assert r.exit_code == 0
+    assert 'in 3 commits.' in r.output
+    assert _git(dufl_root, 'log', '--format=%s').split("\n")[:3] == [
+        'Import. (3/3)', 'Import. (2/3)', 'Import. (1/3)'
+    ]
+
+
+def test_dufl_import_stores_large_files_as_chunks(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'chunk_threshold': 100})
+    })
+    content = ''.join(chr(i % 251) for i in range(300000))
+    files = create_files_in_folder(temp_folder, {'big': content})
+
+    r = cli_run('-r', dufl_root, 'import', files['big'])
+    assert r.exit_code == 0
+    os.unlink(files['big'])
+    r = cli_run('-r', dufl_root, 'checkout', files['big'])
+
+    assert r.exit_code == 0
+    assert read_file(files['big']) == content
+
+
+def test_dufl_import_imports_nothing_if_a_file_is_suspicious(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'id_rsa': 'key'})
+
+    r = cli_run('-r', dufl_root, 'import', files['a'], files['id_rsa'])
+
+    assert r.exit_code != 0
+    assert 'looks like a private key' in r.output
+    assert _git(dufl_root, 'rev-list', '--count', 'HEAD').strip() == '1'
+
+
+def test_dufl_import_leaves_branch_alone_if_working_tree_can_not_be_updated(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'dotfiles/a': 'a', 'dotfiles/b': 'b'})
+    head = _git(dufl_root, 'rev-parse', 'HEAD')
+    # An untracked file is in the way of an imported one
+    create_files_in_folder(dufl_root, {
+        os.path.relpath(dufl_path(dufl_root, files['dotfiles/b']), dufl_root): 'untracked'
+    })
+
+    r = cli_run('-r', dufl_root, 'import', os.path.join(temp_folder, 'dotfiles'))
+
+    assert r.exit_code != 0
+    assert 'Could not update the working tree of the dufl root' in r.output
+    assert _git(dufl_root, 'rev-parse', 'HEAD') == head
+    assert read_file(dufl_path(dufl_root, files['dotfiles/b'])) == 'untracked'
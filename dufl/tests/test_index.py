@@ -0,0 +1,148 @@
+import os
+import re
+
+from tutils import (
+    cli_run, temp_folder, git, user_home, create_files_in_folder
+)
+from ..index import (
+    IndexBroken, IndexEntry, TrackedIndex, head_commit, update_index,
+    write_index
+)
+from ..profiling import Profiler
+
+
+def _entry(path):
+    return IndexEntry(path, 'ab' * 20, 0o100644, len(path))
+
+
+def test_write_index_sorts_entries(temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    write_index(file_name, None, [_entry('b'), _entry('c/d'), _entry('a')])
+    index = TrackedIndex(file_name)
+    assert [e.path for e in index] == ['a', 'b', 'c/d']
+    assert index.head is None
+
+
+def test_tracked_index_reads_back_entries(temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    write_index(file_name, 'cd' * 20, [IndexEntry('home/.vimrc', 'ab' * 20, 0o100755, 42)])
+    index = TrackedIndex(file_name)
+    assert index.head == 'cd' * 20
+    assert index.get('home/.vimrc') == IndexEntry('home/.vimrc', 'ab' * 20, 0o100755, 42)
+
+
+def test_tracked_index_get_returns_none_for_unknown_path(temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    write_index(file_name, None, [_entry('a'), _entry('c')])
+    assert TrackedIndex(file_name).get('b') is None
+
+
+def test_tracked_index_lookup_returns_entries_with_prefix(temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    write_index(file_name, None, [
+        _entry('home/.config/a'), _entry('home/.config/b'),
+        _entry('home/.configure'), _entry('home/.bashrc'), _entry('root/etc/x')
+    ])
+    index = TrackedIndex(file_name)
+    assert [e.path for e in index.lookup('home/.config/')] == [
+        'home/.config/a', 'home/.config/b'
+    ]
+    assert len(list(index.lookup('home/'))) == 4
+    assert list(index.lookup('nowhere/')) == []
+
+
+def test_tracked_index_raises_on_invalid_file(temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    with open(file_name, 'w') as f:
+        f.write('this is not an index, but it is long enough to have a header')
+    try:
+        TrackedIndex(file_name)
+        assert False
+    except IndexBroken:
+        assert True
+
+
+def test_update_index_indexes_head_tree(git, temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    head = head_commit(git)
+    update_index(git, file_name, head)
+    index = TrackedIndex(file_name)
+    assert index.head == head
+    entry = index.get('readme.txt')
+    assert entry.size == len('hello world')
+    assert entry.sha == git.get_output('rev-parse', 'HEAD:readme.txt').strip()
+
+
+def test_update_index_applies_tree_diff_when_head_moves(git, temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    update_index(git, file_name, head_commit(git))
+    create_files_in_folder(git.root, {'sub/new.txt': 'new file'})
+    git.run('add', 'sub/new.txt')
+    git.run('rm', '-q', 'readme.txt')
+    git.run('commit', '-m', 'change')
+
+    head = head_commit(git)
+    git.profiler = Profiler(enabled=True)
+    update_index(git, file_name, head)
+
+    assert [e['name'] for e in git.profiler.events] == ['git diff-tree', 'git ls-tree']
+    index = TrackedIndex(file_name)
+    assert [e.path for e in index] == ['sub/new.txt']
+    assert index.get('sub/new.txt').size == len('new file')
+
+
+def test_update_index_does_nothing_when_head_is_unchanged(git, temp_folder):
+    file_name = os.path.join(temp_folder, 'tracked.idx')
+    head = head_commit(git)
+    update_index(git, file_name, head)
+    git.profiler = Profiler(enabled=True)
+    update_index(git, file_name, head)
+    assert git.profiler.events == []
+
+
+def test_dufl_ls_lists_tracked_files_by_file_system_path(cli_run, temp_folder, user_home):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    home_files = create_files_in_folder(user_home, {
+        '.vimrc': 'set et',
+        '.config/app/rc': 'hello'
+    })
+    other_files = create_files_in_folder(temp_folder, {
+        'etc/service.conf': 'hello'
+    })
+    for name in home_files.values() + other_files.values():
+        cli_run('-r', dufl_root, 'add', name)
+
+    r = cli_run('-r', dufl_root, 'ls')
+
+    assert r.output.split() == [
+        home_files['.config/app/rc'], home_files['.vimrc'],
+        other_files['etc/service.conf']
+    ]
+
+
+def test_dufl_ls_filters_by_prefix(cli_run, temp_folder, user_home):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    home_files = create_files_in_folder(user_home, {
+        '.vimrc': 'set et',
+        '.config/app/rc': 'hello',
+        '.configure': 'hello'
+    })
+    for name in home_files.values():
+        cli_run('-r', dufl_root, 'add', name)
+
+    r = cli_run('-r', dufl_root, 'ls', os.path.join(user_home, '.config'))
+
+    assert r.output.split() == [home_files['.config/app/rc']]
+
+
+def test_dufl_ls_long_shows_size(cli_run, temp_folder, user_home):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    home_files = create_files_in_folder(user_home, {'.vimrc': 'set et'})
+    cli_run('-r', dufl_root, 'add', home_files['.vimrc'])
+
+    r = cli_run('-r', dufl_root, 'ls', '-l')
+
+    assert re.search('^100644 +6 [0-9a-f]{40} %s$' % re.escape(home_files['.vimrc']), r.output.strip())
@@ -0,0 +1,236 @@
+import errno
+import os
+import pytest
+import threading
+import time
+import yaml
+
+from mock import patch
+from subprocess import check_output
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+from ..lock import (
+    LockTimeout, RootLock, claim_pending, enqueue, group_commit, take_result
+)
+
+
+def test_root_lock_is_exclusive(temp_folder):
+    lock_file = os.path.join(temp_folder, 'state', 'root.lock')
+    first = RootLock(lock_file, 1)
+    second = RootLock(lock_file, 1)
+
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    second.release()
+
+
+def test_root_lock_times_out_with_holder_pid(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    holder = RootLock(lock_file, 1)
+    holder.acquire()
+    try:
+        RootLock(lock_file, 0.2).acquire()
+        assert False
+    except LockTimeout as e:
+        assert 'Timed out after 0.2s' in str(e)
+        assert 'held by process %d' % os.getpid() in str(e)
+    finally:
+        holder.release()
+
+
+def test_group_commit_processes_queued_requests_at_once(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    calls = []
+
+    def process(claimed):
+        calls.append([request['n'] for _, request in claimed])
+        return dict((request_id, {'n': request['n']}) for request_id, request in claimed)
+
+    results = {}
+
+    def add(n):
+        results[n] = group_commit(RootLock(lock_file, 5), queue, {'n': n}, process)
+
+    holder = RootLock(lock_file, 1)
+    holder.acquire()
+    threads = [threading.Thread(target=add, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    while len([f for f in os.listdir(queue) if f.endswith('.request')]) < 3:
+        time.sleep(0.01)
+    holder.release()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(calls[0]) == [0, 1, 2]
+    assert results == {0: {'n': 0}, 1: {'n': 1}, 2: {'n': 2}}
+    assert os.listdir(queue) == []
+
+
+def test_group_commit_withdraws_request_on_timeout(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    holder = RootLock(lock_file, 1)
+    holder.acquire()
+    try:
+        group_commit(RootLock(lock_file, 0.2), queue, {}, lambda claimed: {})
+        assert False
+    except LockTimeout:
+        assert True
+    finally:
+        holder.release()
+    assert os.listdir(queue) == []
+
+
+def test_group_commit_records_errors_for_all_claimed_requests(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    waiting = enqueue(queue, {'n': 1})
+
+    def process(claimed):
+        raise KeyError('n')
+
+    result = group_commit(RootLock(lock_file, 1), queue, {'n': 2}, process)
+
+    assert result == {'ok': False, 'error': "KeyError: 'n'"}
+    assert take_result(queue, waiting) == result
+    assert os.listdir(queue) == []
+
+
+def test_group_commit_records_results_when_processing_is_interrupted(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    waiting = enqueue(queue, {'n': 1})
+
+    def process(claimed):
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        group_commit(RootLock(lock_file, 1), queue, {'n': 2}, process)
+
+    assert take_result(queue, waiting) == {
+        'ok': False, 'error': 'KeyboardInterrupt: '
+    }
+
+
+def test_group_commit_calls_after_once_results_are_recorded(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    waiting = enqueue(queue, {'n': 1})
+    seen = []
+
+    def after(results):
+        seen.append((results, sorted(os.listdir(queue))))
+
+    result = group_commit(
+        RootLock(lock_file, 1), queue, {'n': 2},
+        lambda claimed: dict((i, {'ok': True, 'n': r['n']}) for i, r in claimed),
+        after
+    )
+
+    assert result == {'ok': True, 'n': 2}
+    assert len(seen) == 1
+    assert seen[0][0][waiting] == {'ok': True, 'n': 1}
+    assert waiting + '.result' in seen[0][1]
+
+
+def test_group_commit_gives_up_on_claimed_requests_after_a_while(temp_folder):
+    lock_file = os.path.join(temp_folder, 'root.lock')
+    queue = os.path.join(temp_folder, 'queue')
+    holder = RootLock(lock_file, 1)
+    holder.acquire()
+    errors = []
+
+    def add():
+        try:
+            group_commit(RootLock(lock_file, 0.1), queue, {}, lambda claimed: {})
+        except LockTimeout as e:
+            errors.append(str(e))
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    try:
+        while not os.path.isdir(queue) or not os.listdir(queue):
+            time.sleep(0.01)
+        # The holder claims the request, but never completes it
+        claim_pending(queue)
+        thread.join(5)
+    finally:
+        holder.release()
+
+    assert not thread.is_alive()
+    assert errors == ['Timed out after 0.4s waiting for the queued add to be committed.']
+
+
+def test_claim_pending_reclaims_requests_of_dead_holders(temp_folder):
+    queue = os.path.join(temp_folder, 'queue')
+    orphan = enqueue(queue, {'n': 1})
+    assert [r for _, r in claim_pending(queue)] == [{'n': 1}]
+    waiting = enqueue(queue, {'n': 2})
+
+    claimed = claim_pending(queue)
+
+    assert claimed == [(orphan, {'n': 1}), (waiting, {'n': 2})]
+    assert take_result(queue, orphan) is None
+
+
+def test_dufl_add_commits_queued_adds_in_a_single_commit(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'bb'})
+    queue = os.path.join(dufl_root, '.git', 'dufl', 'add-queue')
+    # Simulate another dufl add waiting for the lock
+    other = enqueue(queue, {'sources': [files['b']], 'message': 'Add b'})
+
+    r = cli_run('-r', dufl_root, 'add', files['a'], '-m', 'Add a')
+
+    assert r.exit_code == 0
+    assert 'Added 1 file (1 bytes) in a group commit of 2 adds.' in r.output
+    assert take_result(queue, other) == {
+        'ok': True, 'size': 2, 'changed': True, 'group': 2
+    }
+    assert check_output(['git', 'rev-list', '--count', 'HEAD'], cwd=dufl_root).strip() == '2'
+    assert check_output(
+        ['git', 'log', '-1', '--format=%B'], cwd=dufl_root
+    ).strip() == "Add b; Add a\n\nGroup commit of 2 adds."
+
+
+def test_dufl_add_reports_lock_timeout(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'lock_timeout': 0.2})
+    })
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    holder = RootLock(os.path.join(dufl_root, '.git', 'dufl', 'root.lock'), 1)
+    holder.acquire()
+    try:
+        r = cli_run('-r', dufl_root, 'add', files['a'])
+    finally:
+        holder.release()
+
+    assert r.exit_code != 0
+    assert 'Timed out after 0.2s waiting for the lock' in r.output
+
+
+def test_claim_pending_removes_results_of_dead_processes(temp_folder):
+    queue = os.path.join(temp_folder, 'queue')
+    os.makedirs(queue)
+    alive = '%017.6f-%d' % (time.time(), os.getpid())
+    dead = '%017.6f-%d' % (time.time(), 4194305)
+    for request_id in (alive, dead):
+        with open(os.path.join(queue, request_id + '.result'), 'w') as f:
+            f.write('{"ok": true}')
+
+    def kill(pid, signal):
+        if pid != os.getpid():
+            raise OSError(errno.ESRCH, 'No such process')
+
+    with patch('os.kill', kill):
+        assert claim_pending(queue) == []
+
+    assert os.listdir(queue) == [alive + '.result']
@@ -0,0 +1,104 @@
+import os
+import yaml
+
+from mock import patch
+from subprocess import check_output
+
+from tutils import cli_run, temp_folder, git, create_files_in_folder
+from ..utils import GitError
+from ..maintenance import (
+    MAINTENANCE_FILE, load_state, maintain, needs_maintenance, record_commits
+)
+
+
+def _loose_objects(root):
+    for line in check_output(['git', 'count-objects', '-v'], cwd=root).split("\n"):
+        if line.startswith('count: '):
+            return int(line[len('count: '):])
+
+
+def test_maintain_packs_objects_and_writes_commit_graph(git, temp_folder):
+    state_file = os.path.join(temp_folder, 'state', MAINTENANCE_FILE)
+    assert _loose_objects(git.root) > 0
+
+    maintain(git, state_file)
+
+    assert _loose_objects(git.root) == 0
+    assert os.path.isdir(os.path.join(git.root, '.git', 'objects', 'info', 'commit-graphs'))
+    assert git.get_output('config', 'core.untrackedCache').strip() == 'true'
+    assert load_state(state_file)['commits'] == 0
+    assert load_state(state_file)['last_run'] is not None
+
+
+def test_needs_maintenance_checks_commit_threshold(temp_folder):
+    state_file = os.path.join(temp_folder, MAINTENANCE_FILE)
+    context = {
+        'dufl_root': temp_folder,
+        'maintain_commits': 3,
+        'maintain_loose_objects': 0
+    }
+
+    assert not needs_maintenance(context, record_commits(state_file, 2))
+    assert needs_maintenance(context, record_commits(state_file, 1))
+    context['maintain_commits'] = 0
+    assert not needs_maintenance(context, load_state(state_file))
+
+
+def test_needs_maintenance_estimates_loose_objects(temp_folder):
+    create_files_in_folder(temp_folder, {
+        '.git/objects/17/%038d' % i: '' for i in range(4)
+    })
+    context = {
+        'dufl_root': temp_folder,
+        'maintain_commits': 0,
+        'maintain_loose_objects': 1000
+    }
+
+    assert needs_maintenance(context, {'commits': 0, 'last_run': None})
+    context['maintain_loose_objects'] = 2000
+    assert not needs_maintenance(context, {'commits': 0, 'last_run': None})
+
+
+def test_dufl_maintain_reports_history_probe_timings(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    cli_run('-r', dufl_root, 'add', files['a'])
+
+    r = cli_run('-r', dufl_root, 'maintain')
+
+    assert r.exit_code == 0
+    assert 'History probes took' in r.output
+    assert _loose_objects(dufl_root) == 0
+
+
+def test_dufl_add_runs_maintenance_when_threshold_is_crossed(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'maintain_commits': 2})
+    })
+    files = create_files_in_folder(temp_folder, {'a': 'a', 'b': 'b'})
+
+    r = cli_run('-r', dufl_root, 'add', files['a'])
+    assert 'Running automatic maintenance' not in r.output
+    r = cli_run('-r', dufl_root, 'add', files['b'])
+
+    assert 'Running automatic maintenance' in r.output
+    assert _loose_objects(dufl_root) == 0
+
+
+def test_dufl_add_only_warns_when_maintenance_fails(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'maintain_commits': 1})
+    })
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+
+    with patch('dufl.cli.maintain', side_effect=GitError('gc failed')):
+        r = cli_run('-r', dufl_root, 'add', files['a'])
+
+    assert r.exit_code == 0
+    assert 'Added 1 file' in r.output
+    assert 'Warning: the commit was made, but maintenance failed: gc failed' in r.output
@@ -0,0 +1,167 @@
+import os
+import threading
+import yaml
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+from ..metrics import (
+    format_labels, format_textfile, parse_textfile, update_samples,
+    write_textfile
+)
+
+
+def test_format_labels_escapes_values():
+    assert format_labels([('rule', 'a"b\\c')]) == '{rule="a\\"b\\\\c"}'
+
+
+def test_format_labels_returns_empty_string_without_labels():
+    assert format_labels([]) == ''
+
+
+def test_parse_textfile_reads_back_formatted_samples():
+    samples = {
+        ('dufl_commands_total', '{command="add",result="success"}'): 3.0,
+        ('dufl_last_success_timestamp_seconds', '{command="add"}'): 1234.5
+    }
+    assert parse_textfile(format_textfile(samples)) == samples
+
+
+def test_format_textfile_includes_type_of_known_families():
+    content = format_textfile({('dufl_bytes_copied_total', ''): 1})
+    assert '# TYPE dufl_bytes_copied_total counter' in content
+
+
+def test_update_samples_fills_duration_histogram_buckets():
+    samples = {}
+    update_samples(samples, 'add', 0.3, True, {})
+    assert samples[(
+        'dufl_command_duration_seconds_bucket', '{command="add",le="0.25"}'
+    )] == 0
+    assert samples[(
+        'dufl_command_duration_seconds_bucket', '{command="add",le="0.5"}'
+    )] == 1
+    assert samples[(
+        'dufl_command_duration_seconds_bucket', '{command="add",le="+Inf"}'
+    )] == 1
+    assert samples[('dufl_command_duration_seconds_count', '{command="add"}')] == 1
+
+
+def test_update_samples_exports_profiler_counters():
+    samples = {}
+    update_samples(samples, 'add', 0.1, False, {
+        ('git_processes', ()): 2,
+        ('rejections', (('rule', 'id_rsa$'),)): 1,
+        ('not_exported', ()): 1
+    })
+    assert samples[('dufl_git_processes_total', '{command="add"}')] == 2
+    assert samples[(
+        'dufl_rejections_total', '{command="add",rule="id_rsa$"}'
+    )] == 1
+    assert len([k for k in samples if k[0] == 'not_exported']) == 0
+
+
+def test_update_samples_only_sets_last_success_on_success():
+    samples = {}
+    update_samples(samples, 'add', 0.1, False, {}, now=100)
+    assert ('dufl_last_success_timestamp_seconds', '{command="add"}') not in samples
+    update_samples(samples, 'add', 0.1, True, {}, now=200)
+    assert samples[('dufl_last_success_timestamp_seconds', '{command="add"}')] == 200
+
+
+def test_write_textfile_accumulates_across_runs(temp_folder):
+    path = os.path.join(temp_folder, 'dufl.prom')
+    write_textfile(path, 'push', 0.1, True, {('git_processes', ()): 2})
+    write_textfile(path, 'push', 0.1, True, {('git_processes', ()): 2})
+    with open(path) as f:
+        samples = parse_textfile(f.read())
+    assert samples[('dufl_git_processes_total', '{command="push"}')] == 4
+    assert samples[('dufl_command_duration_seconds_count', '{command="push"}')] == 2
+    assert sorted(os.listdir(temp_folder)) == ['dufl.prom', 'dufl.prom.lock']
+
+
+def test_write_textfile_does_not_lose_concurrent_updates(temp_folder):
+    path = os.path.join(temp_folder, 'dufl.prom')
+
+    def run():
+        for i in range(10):
+            write_textfile(path, 'add', 0.1, True, {})
+
+    threads = [threading.Thread(target=run) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path) as f:
+        samples = parse_textfile(f.read())
+    assert samples[('dufl_command_duration_seconds_count', '{command="add"}')] == 40
+
+
+def test_dufl_metrics_file_records_command_results(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    metrics_file = os.path.join(temp_folder, 'dufl.prom')
+    cli_run('-r', dufl_root, 'init')
+    file_names = create_files_in_folder(temp_folder, {
+        'the/path/file.txt': 'hello'
+    })
+
+    cli_run('-r', dufl_root, '--metrics-file', metrics_file,
+            'add', file_names['the/path/file.txt'])
+
+    with open(metrics_file) as f:
+        samples = parse_textfile(f.read())
+    assert samples[('dufl_commands_total', '{command="add",result="success"}')] == 1
+    assert samples[('dufl_bytes_copied_total', '{command="add"}')] == 5
+    assert samples[('dufl_files_scanned_total', '{command="add"}')] == 1
+    assert samples[('dufl_git_processes_total', '{command="add"}')] == 2
+
+
+def test_dufl_metrics_file_labels_nested_commands_with_their_full_path(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    metrics_file = os.path.join(temp_folder, 'dufl.prom')
+    cli_run('-r', dufl_root, 'init')
+
+    cli_run('-r', dufl_root, '--metrics-file', metrics_file, 'bundle', 'create',
+            'target', '-o', os.path.join(temp_folder, 'target.bundle'))
+    cli_run('-r', dufl_root, '--metrics-file', metrics_file, 'bundle', 'apply',
+            os.path.join(temp_folder, 'missing.bundle'))
+
+    with open(metrics_file) as f:
+        samples = parse_textfile(f.read())
+    assert samples[('dufl_commands_total', '{command="bundle_create",result="success"}')] == 1
+    assert samples[('dufl_commands_total', '{command="bundle_apply",result="failure"}')] == 1
+    assert not any('"bundle"' in labels for name, labels in samples)
+
+
+def test_dufl_metrics_file_failures_only_warn(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    metrics_file = os.path.join(temp_folder, 'missing', 'dufl.prom')
+
+    r = cli_run('-r', dufl_root, '--metrics-file', metrics_file, 'init')
+
+    assert r.exit_code == 0
+    assert 'Warning: could not update the metrics file %s' % metrics_file in r.output
+
+
+def test_dufl_metrics_file_records_rejections_by_rule(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    metrics_file = os.path.join(temp_folder, 'dufl.prom')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({
+            'suspicious_names': {'secret$': 'it looks secret'},
+            'metrics_file': metrics_file
+        })
+    })
+    file_names = create_files_in_folder(temp_folder, {
+        'the/path/secret': 'hello'
+    })
+
+    r = cli_run('-r', dufl_root, 'add', file_names['the/path/secret'])
+
+    assert r.exit_code != 0
+    with open(metrics_file) as f:
+        samples = parse_textfile(f.read())
+    assert samples[('dufl_commands_total', '{command="add",result="failure"}')] == 1
+    assert samples[(
+        'dufl_rejections_total', '{command="add",rule="secret$"}'
+    )] == 1
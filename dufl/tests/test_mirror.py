@@ -0,0 +1,111 @@
+import os
+import yaml
+
+from subprocess import check_output
+from tutils import cli_run, temp_folder, remote_git_path, create_files_in_folder
+from tutils import add_content_to_remote_git_repo
+from .. import utils
+from ..mirror import load_state
+
+
+def _head(path):
+    return check_output(['git', '-C', path, 'rev-parse', 'master']).strip()
+
+
+def test_dufl_mirror_serve_once_creates_and_refreshes_the_mirror(cli_run, temp_folder, remote_git_path):
+    mirror = os.path.join(temp_folder, 'mirror.git')
+
+    r = cli_run('mirror', 'serve', mirror, '--origin', remote_git_path, '--once')
+
+    assert r.exit_code == 0
+    assert _head(mirror) == _head(remote_git_path)
+    assert load_state(utils.Git('/usr/bin/git', mirror))['last_refresh'] is not None
+
+    add_content_to_remote_git_repo(remote_git_path, {'new.txt': 'new'})
+    r = cli_run('mirror', 'serve', mirror, '--once')
+    assert 'is up to date' in r.output
+    assert _head(mirror) != _head(remote_git_path)
+
+    r = cli_run('mirror', 'serve', mirror, '--once', '--interval', '0')
+    assert 'Refreshed' in r.output
+    assert _head(mirror) == _head(remote_git_path)
+
+
+def test_dufl_mirror_serve_requires_an_origin_the_first_time(cli_run, temp_folder):
+    r = cli_run('mirror', 'serve', os.path.join(temp_folder, 'mirror.git'), '--once')
+
+    assert r.exit_code != 0
+    assert 'Specify the repository to mirror' in r.output
+
+
+def test_dufl_mirror_serve_reports_unreachable_origin(cli_run, temp_folder, remote_git_path):
+    mirror = os.path.join(temp_folder, 'mirror.git')
+    cli_run('mirror', 'serve', mirror, '--origin', remote_git_path, '--once')
+
+    r = cli_run(
+        'mirror', 'serve', mirror, '--origin', os.path.join(temp_folder, 'gone'),
+        '--once', '--interval', '0'
+    )
+
+    assert r.exit_code != 0
+    assert 'Could not fetch' in r.output
+
+
+def test_dufl_init_pulls_through_the_first_mirror_that_answers(cli_run, temp_folder, remote_git_path):
+    add_content_to_remote_git_repo(remote_git_path, {'remote_file.txt': 'hello'})
+    mirror = os.path.join(temp_folder, 'mirror.git')
+    cli_run('mirror', 'serve', mirror, '--origin', remote_git_path, '--once')
+    dufl_root = os.path.join(temp_folder, '.dufl')
+
+    r = cli_run(
+        '-r', dufl_root, 'init', remote_git_path,
+        '--mirror', os.path.join(temp_folder, 'gone.git'), '--mirror', mirror
+    )
+
+    assert r.exit_code == 0
+    assert 'through mirror %s' % mirror in r.output
+    assert os.path.isfile(os.path.join(dufl_root, 'remote_file.txt'))
+    # The dufl root still pushes to the repository itself
+    git = utils.Git('/usr/bin/git', dufl_root)
+    assert git.get_output('config', 'remote.origin.url').strip() == remote_git_path
+
+
+def test_dufl_fetch_falls_back_to_origin_when_mirrors_are_behind(cli_run, temp_folder, remote_git_path):
+    mirror = os.path.join(temp_folder, 'mirror.git')
+    cli_run('mirror', 'serve', mirror, '--origin', remote_git_path, '--once')
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    add_content_to_remote_git_repo(remote_git_path, {
+        'settings.yaml': yaml.dump({'mirrors': [mirror]})
+    })
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+    add_content_to_remote_git_repo(remote_git_path, {'new.txt': 'new'})
+
+    # The mirror doesn't have the settings commit the dufl root pulled
+    r = cli_run('-r', dufl_root, 'fetch')
+
+    assert r.exit_code == 0
+    assert 'Fetched from origin. Updated to %s' % _head(remote_git_path) in r.output
+    assert os.path.isfile(os.path.join(dufl_root, 'new.txt'))
+
+    cli_run('mirror', 'serve', mirror, '--once', '--interval', '0')
+    add_content_to_remote_git_repo(remote_git_path, {'newer.txt': 'newer'})
+    cli_run('mirror', 'serve', mirror, '--once', '--interval', '0')
+    r = cli_run('-r', dufl_root, 'fetch')
+
+    assert 'Fetched from %s. Updated to %s' % (mirror, _head(remote_git_path)) in r.output
+    assert os.path.isfile(os.path.join(dufl_root, 'newer.txt'))
+
+
+def test_dufl_fetch_reports_head_when_ahead_of_origin(cli_run, temp_folder, remote_git_path):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    cli_run('-r', dufl_root, 'add', files['a'])
+    head = _head(dufl_root)
+
+    r = cli_run('-r', dufl_root, 'fetch')
+
+    assert r.exit_code == 0
+    assert 'Already up to date.' in r.output
+    assert 'Updated to' not in r.output
+    assert _head(dufl_root) == head
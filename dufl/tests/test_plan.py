@@ -0,0 +1,106 @@
+import json
+import os
+import time
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+
+
+def _setup(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {
+        'created': 'created', 'unchanged': 'unchanged',
+        'updated': 'v1', 'blocked': 'v1'
+    })
+    for name in ['created', 'unchanged', 'updated', 'blocked']:
+        cli_run('-r', dufl_root, 'add', files[name])
+    # A newer version of updated and blocked is committed, then blocked
+    # is modified locally
+    time.sleep(1)
+    between = int(time.time())
+    time.sleep(1)
+    for name in ['updated', 'blocked']:
+        with open(files[name], 'w') as f:
+            f.write('v2')
+        cli_run('-r', dufl_root, 'add', files[name])
+    for name in ['updated', 'blocked']:
+        with open(files[name], 'w') as f:
+            f.write('v1')
+        os.utime(files[name], (between, between))
+    with open(files['blocked'], 'w') as f:
+        f.write('local')
+    os.unlink(files['created'])
+    return dufl_root, files
+
+
+def _actions(plan_file):
+    with open(plan_file) as f:
+        plan = json.load(f)
+    return dict((os.path.basename(f['path']), f['action']) for f in plan['files'])
+
+
+def test_dufl_plan_records_the_action_for_each_file(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    plan_file = os.path.join(temp_folder, 'plan.json')
+
+    r = cli_run('-r', dufl_root, 'plan', '-o', plan_file)
+
+    assert r.exit_code == 0
+    assert _actions(plan_file) == {
+        'created': 'create', 'unchanged': 'unchanged',
+        'updated': 'update', 'blocked': 'blocked'
+    }
+    assert '1 blocked, 1 create, 1 unchanged, 1 update' in r.output
+
+
+def test_dufl_apply_writes_the_planned_files(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    plan_file = os.path.join(temp_folder, 'plan.json')
+    cli_run('-r', dufl_root, 'plan', '-o', plan_file)
+
+    r = cli_run('-r', dufl_root, 'apply', '-j', '2', plan_file)
+
+    assert r.exit_code == 0
+    assert 'Wrote 2 of 2 files, skipped 1 with local modifications' in r.output
+    for name, content in [('created', 'created'), ('updated', 'v2'), ('blocked', 'local')]:
+        with open(files[name]) as f:
+            assert f.read() == content
+
+
+def test_dufl_apply_refuses_files_changed_since_the_plan(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    plan_file = os.path.join(temp_folder, 'plan.json')
+    cli_run('-r', dufl_root, 'plan', '-o', plan_file)
+    create_files_in_folder(temp_folder, {'created': 'meanwhile'})
+
+    r = cli_run('-r', dufl_root, 'apply', plan_file)
+
+    assert r.exit_code != 0
+    assert 'Changed since the plan was made: %s' % files['created'] in r.output
+    with open(files['updated']) as f:
+        assert f.read() == 'v1'
+
+
+def test_dufl_apply_refuses_plans_made_at_another_commit(cli_run, temp_folder):
+    dufl_root, files = _setup(cli_run, temp_folder)
+    plan_file = os.path.join(temp_folder, 'plan.json')
+    cli_run('-r', dufl_root, 'plan', '-o', plan_file)
+    other = create_files_in_folder(temp_folder, {'other': 'other'})
+    cli_run('-r', dufl_root, 'add', other['other'])
+
+    r = cli_run('-r', dufl_root, 'apply', plan_file)
+
+    assert r.exit_code != 0
+    assert 'Make a new plan' in r.output
+    assert not os.path.exists(files['created'])
+
+
+def test_dufl_apply_reports_broken_plans(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    plan_file = create_files_in_folder(temp_folder, {'plan.json': 'not json'})['plan.json']
+
+    r = cli_run('-r', dufl_root, 'apply', plan_file)
+
+    assert r.exit_code != 0
+    assert 'Could not read plan' in r.output
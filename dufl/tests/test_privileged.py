@@ -0,0 +1,226 @@
+import os
+import pytest
+import stat
+import sys
+import yaml
+
+from mock import patch
+from tutils import (
+    cli_run, patch_cli, temp_folder, remote_git_path, create_files_in_folder,
+    add_content_to_remote_git_repo, read_file, content_writer
+)
+from ..app import create_initial_context
+from ..privileged import (
+    HelperUnsafe, PrivilegedWriter, PrivilegedWriteFailed, needs_privileges,
+    unsafe_paths
+)
+
+
+@pytest.fixture(autouse=True)
+def trusted_helper(request):
+    """ Let the helper run from a source checkout, as the fake sudo
+    doesn't run it as root anyway.
+    """
+    trusted = patch('dufl.privileged.unsafe_paths', return_value=[])
+    trusted.start()
+    request.addfinalizer(trusted.stop)
+
+
+def _fake_sudo(folder):
+    """ Create a sudo replacement that runs its command as the current
+    user, and logs each invocation.
+    """
+    path = os.path.join(folder, 'fake-sudo')
+    with open(path, 'w') as f:
+        f.write(
+            "#!/bin/sh\n"
+            "printf '%s\\n' \"$*\" >> \"$0.log\"\n"
+            "if [ \"$1\" = \"-n\" ]; then shift; fi\n"
+            "exec \"$@\"\n"
+        )
+    os.chmod(path, 0o755)
+    return path
+
+
+def _invocations(sudo):
+    with open(sudo + '.log') as f:
+        return [l for l in f.read().split("\n") if l]
+
+
+def test_unsafe_paths_finds_code_writable_by_non_root_users(temp_folder):
+    package = os.path.join(temp_folder, 'site', 'dufl')
+    files = create_files_in_folder(package, {'__init__.py': '', 'cli.py': ''})
+    os.chmod(files['cli.py'], 0o664)
+    os.chmod(temp_folder, 0o755)
+    os.chmod(os.path.join(temp_folder, 'site'), 0o777)
+    os.chmod(package, 0o755)
+
+    unsafe = unsafe_paths(package, sys.executable)
+
+    assert files['cli.py'] in unsafe
+    assert os.path.join(temp_folder, 'site') in unsafe
+    if os.getuid() == 0:
+        assert files['__init__.py'] not in unsafe
+        assert package not in unsafe
+        # /tmp is world writable, but sticky
+        assert os.path.dirname(temp_folder) not in unsafe
+
+
+def test_privileged_writer_refuses_to_run_unsafe_code(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    writer = PrivilegedWriter(sudo)
+
+    with patch('dufl.privileged.unsafe_paths', return_value=['/home/alice/dufl']):
+        try:
+            writer.write(os.path.join(temp_folder, 'a'), content_writer('a'))
+            assert False
+        except HelperUnsafe as e:
+            assert '/home/alice/dufl' in str(e)
+            assert isinstance(e, PrivilegedWriteFailed)
+
+    assert not os.path.exists(sudo + '.log')
+
+
+def test_needs_privileges_is_false_for_writable_files(temp_folder):
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    assert not needs_privileges(files['a'])
+    assert not needs_privileges(os.path.join(temp_folder, 'new/folder/b'))
+
+
+def test_privileged_writer_writes_all_files_with_a_single_helper(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    files = create_files_in_folder(temp_folder, {'a': 'old a'})
+    files['b'] = os.path.join(temp_folder, 'sub/b')
+    writer = PrivilegedWriter(sudo)
+
+    writer.write(files['a'], content_writer('new a'))
+    writer.write(files['b'], content_writer('x' * 200000), mode=0o600)
+    writer.close()
+
+    assert read_file(files['a']) == 'new a'
+    assert read_file(files['b']) == 'x' * 200000
+    assert stat.S_IMODE(os.stat(files['b']).st_mode) == 0o600
+    helpers = [i for i in _invocations(sudo) if 'true' not in i.split()]
+    assert len(helpers) == 1
+
+
+def test_privileged_writer_keeps_mode_of_existing_files(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    files = create_files_in_folder(temp_folder, {'a': 'old a'})
+    os.chmod(files['a'], 0o440)
+    writer = PrivilegedWriter(sudo)
+
+    writer.write(files['a'], content_writer('new a'))
+    writer.close()
+
+    assert read_file(files['a']) == 'new a'
+    assert stat.S_IMODE(os.stat(files['a']).st_mode) == 0o440
+
+
+def test_privileged_writer_does_not_prompt_when_credentials_are_cached(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    writer = PrivilegedWriter(sudo)
+
+    writer.write(os.path.join(temp_folder, 'a'), content_writer('a'))
+    writer.close()
+
+    assert _invocations(sudo)[1].startswith('-n ')
+
+
+def test_privileged_writer_does_not_start_helper_without_writes(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    writer = PrivilegedWriter(sudo)
+    writer.close()
+    assert not os.path.exists(sudo + '.log')
+
+
+def test_privileged_writer_reports_failures_and_writes_other_files(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    files = create_files_in_folder(temp_folder, {'not-a-folder': 'x'})
+    writer = PrivilegedWriter(sudo)
+
+    writer.write(os.path.join(files['not-a-folder'], 'a'), content_writer('a'))
+    writer.write(os.path.join(temp_folder, 'b'), content_writer('b'))
+    try:
+        writer.close()
+        assert False
+    except PrivilegedWriteFailed as e:
+        assert len(e.failures) == 1
+        assert e.failures[0]['path'] == os.path.join(files['not-a-folder'], 'a')
+    assert read_file(os.path.join(temp_folder, 'b')) == 'b'
+
+
+def test_privileged_writer_writes_nothing_when_aborted(temp_folder):
+    sudo = _fake_sudo(temp_folder)
+    files = create_files_in_folder(temp_folder, {'a': 'old a'})
+    writer = PrivilegedWriter(sudo)
+
+    writer.write(files['a'], content_writer('new a'))
+    writer.write(os.path.join(temp_folder, 'b'), content_writer('b'))
+    writer.abort()
+
+    assert read_file(files['a']) == 'old a'
+    assert sorted(os.listdir(temp_folder)) == ['a', 'fake-sudo', 'fake-sudo.log']
+
+
+def test_dufl_ignores_sudo_setting(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'sudo': '/tmp/evil'})
+    })
+
+    assert create_initial_context(dufl_root).get('sudo') is None
+    assert PrivilegedWriter().sudo == '/usr/bin/sudo'
+
+
+def test_dufl_checkout_writes_files_needing_privileges_with_one_sudo_helper(cli_run, temp_folder, remote_git_path):
+    names = ['a', 'b', 'c']
+    files = dict((n, os.path.join(temp_folder, 'files', n)) for n in names)
+    add_content_to_remote_git_repo(remote_git_path, {
+        'root': dict((path, 'repo ' + name) for name, path in files.items())
+    })
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+    sudo = _fake_sudo(temp_folder)
+
+    with patch_cli('needs_privileges') as needs, patch('dufl.privileged.SUDO', sudo):
+        needs.side_effect = lambda path: not path.endswith('a')
+        r = cli_run('-r', dufl_root, 'checkout', *files.values())
+
+    assert r.exit_code == 0
+    assert '(with sudo)' in r.output
+    for name, path in files.items():
+        assert read_file(path) == 'repo ' + name
+    helpers = [i for i in _invocations(sudo) if 'true' not in i.split()]
+    assert len(helpers) == 1
+
+
+def test_dufl_checkout_writes_no_privileged_file_if_one_fails(cli_run, temp_folder, remote_git_path):
+    files = dict((n, os.path.join(temp_folder, 'files', n)) for n in ['a', 'b'])
+    add_content_to_remote_git_repo(remote_git_path, {
+        'root': dict((path, 'repo ' + name) for name, path in files.items())
+    })
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+    sudo = _fake_sudo(temp_folder)
+
+    def write_content(dufl_file, out, context):
+        out.write('partial')
+        if dufl_file.endswith('b'):
+            raise IOError('read failed')
+
+    with patch_cli('needs_privileges', 'write_file_content') as (needs, write), \
+            patch('dufl.privileged.SUDO', sudo):
+        needs.return_value = True
+        write.side_effect = write_content
+        try:
+            cli_run('-r', dufl_root, 'checkout', files['a'], files['b'])
+            assert False
+        except IOError:
+            pass
+
+    assert not os.path.exists(files['a'])
+    assert not os.path.exists(files['b'])
+    folder = os.path.join(temp_folder, 'files')
+    assert not os.path.exists(folder) or os.listdir(folder) == []
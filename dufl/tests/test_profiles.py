@@ -0,0 +1,153 @@
+import os
+import yaml
+
+from tutils import (
+    cli_run, temp_folder, user_home, remote_git_path, create_files_in_folder,
+    add_content_to_remote_git_repo, dufl_path
+)
+from ..profiles import (
+    UnknownProfile, active_profiles, get_selector, profile_paths,
+    sparse_patterns
+)
+
+
+def _context(root, profiles, hosts):
+    return {
+        'dufl_root': root,
+        'home_subdir': 'home',
+        'slash_subdir': 'root',
+        'chunks_subdir': 'chunks',
+        'settings_file': 'settings.yaml',
+        'profiles': profiles,
+        'hosts': hosts
+    }
+
+
+def test_active_profiles_match_host_patterns():
+    context = _context('/dufl', {}, {
+        'db-*': ['base', 'postgres'],
+        '*': ['base'],
+        'laptop': ['desktop']
+    })
+
+    assert active_profiles(context, 'db-1') == ['base', 'postgres']
+    assert active_profiles(context, 'laptop') == ['base', 'desktop']
+    context['hosts'] = {}
+    assert active_profiles(context, 'laptop') == []
+
+
+def test_profile_paths_expand_home_and_keep_folders(user_home):
+    context = _context('/dufl', {
+        'base': ['~/.zshrc', '~/.config/nvim/', '/etc/hosts']
+    }, {})
+
+    assert profile_paths(context, ['base']) == [
+        os.path.join(user_home, '.zshrc'),
+        os.path.join(user_home, '.config/nvim') + '/',
+        '/etc/hosts'
+    ]
+
+
+def test_profile_paths_raises_on_unknown_profile():
+    try:
+        profile_paths(_context('/dufl', {}, {}), ['missing'])
+        assert False
+    except UnknownProfile:
+        assert True
+
+
+def test_selector_selects_profile_files_and_folders(user_home):
+    context = _context('/dufl', {
+        'base': ['~/.zshrc', '/etc/nginx/']
+    }, {'*': ['base']})
+    selected = get_selector(context, 'host')
+
+    assert selected(os.path.join(user_home, '.zshrc'))
+    assert selected('/etc/nginx/nginx.conf')
+    assert not selected('/etc/nginx.conf')
+    assert not selected(os.path.join(user_home, '.vimrc'))
+
+
+def test_selector_selects_everything_without_profiles():
+    assert get_selector(_context('/dufl', {}, {}), 'host')('/anything')
+
+
+def test_sparse_patterns_always_include_settings_and_chunks(user_home):
+    context = _context('/dufl', {}, {})
+    patterns = sparse_patterns(context, [
+        os.path.join(user_home, '.zshrc'), '/etc/nginx/', '/etc/we[ir]d'
+    ])
+
+    assert patterns == [
+        '/settings.yaml', '/chunks/', '/home/.zshrc', '/root/etc/nginx/',
+        '/root/etc/we\\[ir\\]d'
+    ]
+
+
+def _setup(cli_run, temp_folder, remote_git_path):
+    files = dict(
+        (name, os.path.join(temp_folder, name))
+        for name in ['nginx/nginx.conf', 'nginx/sites/default', 'vim/vimrc']
+    )
+    add_content_to_remote_git_repo(remote_git_path, {
+        'root': dict((path, 'repo ' + name) for name, path in files.items()),
+        'settings.yaml': yaml.dump({
+            'profiles': {'web': [os.path.join(temp_folder, 'nginx') + '/']},
+            'hosts': {'*': ['web']}
+        })
+    })
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    r = cli_run('-r', dufl_root, 'init', remote_git_path)
+    assert r.exit_code == 0
+    return dufl_root, files
+
+
+def test_dufl_init_materializes_only_profile_files(cli_run, temp_folder, remote_git_path):
+    dufl_root, files = _setup(cli_run, temp_folder, remote_git_path)
+
+    assert os.path.isfile(dufl_path(dufl_root, files['nginx/nginx.conf']))
+    assert os.path.isfile(dufl_path(dufl_root, files['nginx/sites/default']))
+    assert not os.path.exists(dufl_path(dufl_root, files['vim/vimrc']))
+    assert os.path.isfile(os.path.join(dufl_root, 'settings.yaml'))
+
+
+def test_dufl_checkout_all_only_checks_out_profile_files(cli_run, temp_folder, remote_git_path):
+    dufl_root, files = _setup(cli_run, temp_folder, remote_git_path)
+
+    r = cli_run('-r', dufl_root, 'checkout', '--all')
+
+    assert r.exit_code == 0
+    assert os.path.isfile(files['nginx/nginx.conf'])
+    assert os.path.isfile(files['nginx/sites/default'])
+    assert not os.path.exists(files['vim/vimrc'])
+
+
+def test_dufl_checkout_explains_files_outside_profiles(cli_run, temp_folder, remote_git_path):
+    dufl_root, files = _setup(cli_run, temp_folder, remote_git_path)
+
+    r = cli_run('-r', dufl_root, 'checkout', files['vim/vimrc'])
+
+    assert r.exit_code != 0
+    assert 'not in the active profiles (web)' in r.output
+
+
+def test_dufl_profiles_apply_disables_sparse_checkout_without_profiles(cli_run, temp_folder, remote_git_path):
+    dufl_root, files = _setup(cli_run, temp_folder, remote_git_path)
+    with open(os.path.join(dufl_root, 'settings.yaml'), 'w') as f:
+        f.write(yaml.dump({'hosts': {}}))
+
+    r = cli_run('-r', dufl_root, 'profiles', '--apply')
+
+    assert r.exit_code == 0
+    assert 'No active profiles' in r.output
+    assert os.path.isfile(dufl_path(dufl_root, files['vim/vimrc']))
+
+
+def test_dufl_add_adds_files_outside_profiles(cli_run, temp_folder, remote_git_path):
+    dufl_root, files = _setup(cli_run, temp_folder, remote_git_path)
+    new_files = create_files_in_folder(temp_folder, {'other/file': 'other'})
+
+    r = cli_run('-r', dufl_root, 'add', new_files['other/file'])
+
+    assert r.exit_code == 0
+    assert 'Added 1 file' in r.output
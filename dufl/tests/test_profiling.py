@@ -0,0 +1,89 @@
+import glob
+import json
+import os
+
+from tutils import cli_run, temp_folder, create_files_in_folder
+from ..profiling import Profiler
+
+
+def test_profiler_span_records_event_when_enabled():
+    profiler = Profiler(enabled=True)
+    with profiler.span('copy', file='/a/file'):
+        pass
+    assert len(profiler.events) == 1
+    assert profiler.events[0]['name'] == 'copy'
+    assert profiler.events[0]['args'] == {'file': '/a/file'}
+
+
+def test_profiler_span_does_not_record_event_when_disabled():
+    profiler = Profiler()
+    with profiler.span('copy'):
+        pass
+    assert profiler.events == []
+
+
+def test_profiler_record_git_names_event_after_subcommand():
+    profiler = Profiler(enabled=True)
+    profiler.record_git(
+        ['/usr/bin/git', '-C', '/dufl', 'rev-list', '-1'], 0, 0.5, 0, 41
+    )
+    event = profiler.events[0]
+    assert event['name'] == 'git rev-list'
+    assert event['args']['exit_code'] == 0
+    assert event['args']['output_bytes'] == 41
+
+
+def test_profiler_trace_is_in_chrome_trace_format():
+    profiler = Profiler(enabled=True)
+    profiler.record_git(
+        ['/usr/bin/git', '-C', '/dufl', 'show'], profiler.started + 1, 0.25, 0, 3
+    )
+    trace = profiler.trace()
+    event = trace['traceEvents'][0]
+    assert event['ph'] == 'X'
+    assert event['ts'] == 1000000
+    assert event['dur'] == 250000
+
+
+def test_profiler_summary_lists_events_by_name():
+    profiler = Profiler(enabled=True)
+    with profiler.span('scan'):
+        pass
+    with profiler.span('scan'):
+        pass
+    summary = profiler.summary()
+    assert 'Git processes: 0' in summary
+    assert [l for l in summary.split("\n") if l.startswith('scan ')][0].split()[1] == '2'
+
+
+def test_dufl_profile_writes_trace_and_summary(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    profile_folder = os.path.join(temp_folder, 'profile')
+    cli_run('-r', dufl_root, 'init')
+    file_names = create_files_in_folder(temp_folder, {
+        'the/path/file.txt': 'hello'
+    })
+
+    cli_run('-r', dufl_root, '--profile', profile_folder,
+            'add', file_names['the/path/file.txt'])
+
+    traces = glob.glob(os.path.join(profile_folder, 'dufl-add-*.trace.json'))
+    assert len(traces) == 1
+    with open(traces[0]) as f:
+        events = json.load(f)['traceEvents']
+    names = [e['name'] for e in events]
+    assert 'settings' in names
+    assert 'scan' in names
+    assert 'copy' in names
+    assert 'git commit' in names
+    assert len(glob.glob(os.path.join(profile_folder, 'dufl-add-*.summary.txt'))) == 1
+
+
+def test_dufl_profile_python_writes_cprofile_output(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    profile_folder = os.path.join(temp_folder, 'profile')
+
+    cli_run('-r', dufl_root, '--profile', profile_folder,
+            '--profile-python', 'init')
+
+    assert len(glob.glob(os.path.join(profile_folder, 'dufl-init-*.prof'))) == 1
@@ -0,0 +1,91 @@
+import os
+import time
+
+from tutils import (
+    cli_run, temp_folder, user_home, remote_git_path, git,
+    create_files_in_folder, add_content_to_remote_git_repo, read_file
+)
+from ..restore import RevisionNotFound, resolve_commit
+from .. import utils
+
+
+def test_resolve_commit_resolves_revisions(git):
+    head = git.get_output('rev-parse', 'HEAD').strip()
+    assert resolve_commit(git, 'master') == head
+    assert resolve_commit(git, head[:7]) == head
+
+
+def test_resolve_commit_resolves_dates(git):
+    head = git.get_output('rev-parse', 'HEAD').strip()
+    assert resolve_commit(git, 'now') == head
+
+
+def test_resolve_commit_raises_when_there_is_no_commit_at_date(git):
+    try:
+        resolve_commit(git, '1990-01-01')
+        assert False
+    except RevisionNotFound:
+        assert True
+
+
+def _setup_history(cli_run, temp_folder, user_home, remote_git_path):
+    in_home = os.path.join(user_home, 'the/home/file')
+    in_root = os.path.join(temp_folder, 'the/root/file')
+    add_content_to_remote_git_repo(remote_git_path, {
+        'home/the/home/file': 'home version 1',
+        'root': {in_root: 'root version 1'}
+    })
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+    git = utils.Git('/usr/bin/git', dufl_root)
+    first = git.get_output('rev-parse', 'HEAD').strip()
+    create_files_in_folder(user_home, {'the/home/file': 'home version 2'})
+    cli_run('-r', dufl_root, 'add', in_home)
+    return dufl_root, first, in_home, in_root
+
+
+def test_dufl_restore_writes_files_as_of_revision(cli_run, temp_folder, user_home, remote_git_path):
+    dufl_root, first, in_home, in_root = _setup_history(
+        cli_run, temp_folder, user_home, remote_git_path
+    )
+
+    r = cli_run('-r', dufl_root, 'restore', '--at', first)
+
+    assert r.exit_code == 0
+    assert read_file(in_home) == 'home version 1'
+    assert read_file(in_root) == 'root version 1'
+    assert 'Restored files as of commit %s: 1 create, 1 update' % first in r.output
+
+
+def test_dufl_restore_dry_run_lists_changes_without_writing(cli_run, temp_folder, user_home, remote_git_path):
+    dufl_root, first, in_home, in_root = _setup_history(
+        cli_run, temp_folder, user_home, remote_git_path
+    )
+
+    r = cli_run('-r', dufl_root, 'restore', '--at', first, '--dry-run')
+
+    assert 'update    %s' % in_home in r.output
+    assert 'create    %s' % in_root in r.output
+    assert read_file(in_home) == 'home version 2'
+    assert not os.path.exists(in_root)
+
+
+def test_dufl_restore_dry_run_does_not_list_unchanged_files(cli_run, temp_folder, user_home, remote_git_path):
+    dufl_root, first, in_home, in_root = _setup_history(
+        cli_run, temp_folder, user_home, remote_git_path
+    )
+
+    r = cli_run('-r', dufl_root, 'restore', '--at', 'master', '--dry-run')
+
+    assert in_home not in r.output
+    assert '1 unchanged' in r.output
+
+
+def test_dufl_restore_fails_on_unknown_revision(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+
+    r = cli_run('-r', dufl_root, 'restore', '--at', '1990-01-01')
+
+    assert r.exit_code != 0
+    assert 'No commit found at 1990-01-01' in r.output
@@ -0,0 +1,111 @@
+import os
+import time
+import yaml
+
+from StringIO import StringIO
+from mock import patch
+from tutils import cli_run, temp_folder, create_files_in_folder, patch_cli
+from ..throttle import (
+    TokenBucket, ThrottledFile, limit_jobs, lower_priority, throttled
+)
+
+
+def test_token_bucket_limits_throughput():
+    bucket = TokenBucket(100 * 1024)
+    start = time.time()
+    # The first second worth of tokens is available straight away
+    for i in range(30):
+        bucket.consume(10 * 1024)
+    elapsed = time.time() - start
+
+    assert 1.8 < elapsed < 3
+
+
+def test_token_bucket_allows_reads_larger_than_the_burst():
+    bucket = TokenBucket(1024 * 1024, burst=1024)
+    start = time.time()
+    bucket.consume(1024 * 1024)
+
+    assert time.time() - start < 2
+
+
+def test_throttled_file_keeps_content():
+    data = ''.join(chr(i % 256) for i in range(200 * 1024))
+    bucket = TokenBucket(100 * 1024 * 1024)
+
+    assert ThrottledFile(StringIO(data), bucket).read() == data
+    assert ThrottledFile(StringIO(data), bucket).read(10) == data[:10]
+    out = StringIO()
+    ThrottledFile(out, bucket).write(data)
+    assert out.getvalue() == data
+
+
+def test_throttled_returns_file_when_not_limited():
+    f = StringIO('')
+
+    assert throttled(f, {'io_limit': 0}) is f
+    assert isinstance(throttled(f, {'io_limit': 1024}), ThrottledFile)
+
+
+def test_limit_jobs():
+    assert limit_jobs({}, 4) == 4
+    assert limit_jobs({'max_jobs': 2}, 4) == 2
+    assert limit_jobs({'nice': True}, 4) == 1
+    assert limit_jobs({'nice': True, 'max_jobs': 3}, 4) == 3
+    assert limit_jobs({}, 0) == 1
+
+
+def test_dufl_nice_lowers_priority(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    with patch_cli('lower_priority') as lower_priority:
+        lower_priority.return_value = True
+        r = cli_run('-r', dufl_root, '--nice', 'add', files['a'])
+
+    assert r.exit_code == 0
+    assert lower_priority.called
+
+
+def test_lower_priority_falls_back_to_ionice_on_unknown_architectures():
+    with patch('platform.machine', return_value='vax'), \
+            patch('os.nice'), \
+            patch('subprocess.call', return_value=0) as call:
+        assert lower_priority()
+    assert call.call_args[0][0] == [
+        'ionice', '-c', '2', '-n', '7', '-p', str(os.getpid())
+    ]
+
+    with patch('platform.machine', return_value='vax'), \
+            patch('os.nice'), \
+            patch('subprocess.call', side_effect=OSError(2, 'No such file')):
+        assert not lower_priority()
+
+
+def test_dufl_nice_warns_when_io_priority_can_not_be_lowered(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    with patch_cli('lower_priority') as lower_priority:
+        lower_priority.return_value = False
+        r = cli_run('-r', dufl_root, '--nice', 'ls')
+
+    assert r.exit_code == 0
+    assert 'Warning: could not lower the I/O priority' in r.output
+
+
+def test_dufl_checkout_respects_io_limit(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    files = create_files_in_folder(temp_folder, {'big': 'x' * (600 * 1024)})
+    cli_run('-r', dufl_root, 'add', files['big'])
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'io_limit': 200 * 1024})
+    })
+    os.unlink(files['big'])
+
+    start = time.time()
+    r = cli_run('-r', dufl_root, 'checkout', files['big'])
+
+    assert r.exit_code == 0
+    assert time.time() - start > 1.5
+    assert os.path.getsize(files['big']) == 600 * 1024
@@ -0,0 +1,194 @@
+import json
+import os
+import time
+import yaml
+
+from mock import patch
+
+from tutils import (
+    cli_run, temp_folder, remote_git_path, create_files_in_folder,
+    add_content_to_remote_git_repo, read_file, path_writer
+)
+from ..lock import LOCK_FILE, RootLock
+from ..transaction import Transaction, flush, recover, staged_path
+
+
+def test_transaction_writes_all_files(temp_folder):
+    journal_file = os.path.join(temp_folder, 'state', 'journal')
+    targets = [os.path.join(temp_folder, 'a'), os.path.join(temp_folder, 'sub/b')]
+    transaction = Transaction(journal_file)
+    for target in targets:
+        transaction.add(target, path_writer('content of ' + target))
+
+    transaction.run()
+
+    for target in targets:
+        assert read_file(target) == 'content of ' + target
+        assert not os.path.exists(staged_path(target))
+    assert not os.path.exists(journal_file)
+
+
+def test_transaction_is_rolled_back_when_a_file_can_not_be_staged(temp_folder):
+    journal_file = os.path.join(temp_folder, 'journal')
+    targets = create_files_in_folder(temp_folder, {'a': 'old a', 'b': 'old b'})
+
+    def fail(path):
+        raise IOError('disk full')
+
+    transaction = Transaction(journal_file)
+    transaction.add(targets['a'], path_writer('new a'))
+    transaction.add(targets['b'], fail)
+    try:
+        transaction.run()
+        assert False
+    except IOError:
+        pass
+
+    assert read_file(targets['a']) == 'old a'
+    # Rolled back right away
+    assert not os.path.exists(staged_path(targets['a']))
+    assert not os.path.exists(journal_file)
+    assert recover(journal_file) is None
+
+
+def test_recover_rolls_committed_transaction_forward(temp_folder):
+    journal_file = os.path.join(temp_folder, 'journal')
+    targets = create_files_in_folder(temp_folder, {'a': 'old a', 'b': 'old b'})
+    # Simulate an interruption after 'a' was renamed into place
+    with open(targets['a'], 'w') as f:
+        f.write('new a')
+    with open(staged_path(targets['b']), 'w') as f:
+        f.write('new b')
+    with open(journal_file, 'w') as f:
+        json.dump({'state': 'committed', 'entries': [
+            {'target': t, 'staged': staged_path(t)} for t in targets.values()
+        ]}, f)
+
+    assert recover(journal_file) == 'rolled forward'
+    assert read_file(targets['a']) == 'new a'
+    assert read_file(targets['b']) == 'new b'
+    assert not os.path.exists(journal_file)
+
+
+def test_recover_does_nothing_without_journal(temp_folder):
+    assert recover(os.path.join(temp_folder, 'journal')) is None
+
+
+def test_flush_ignores_missing_files(temp_folder):
+    files = create_files_in_folder(temp_folder, {'a': 'a'})
+    flush([files['a'], os.path.join(temp_folder, 'missing')])
+
+
+def _remote_with_files(temp_folder, remote_git_path, names):
+    files = dict((n, os.path.join(temp_folder, n)) for n in names)
+    add_content_to_remote_git_repo(remote_git_path, {
+        'root': dict((path, 'repo ' + name) for name, path in files.items())
+    })
+    return files
+
+
+def test_dufl_checkout_checks_out_several_files(cli_run, temp_folder, remote_git_path):
+    files = _remote_with_files(temp_folder, remote_git_path, ['a', 'sub/b'])
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+
+    r = cli_run('-r', dufl_root, 'checkout', files['a'], files['sub/b'])
+
+    assert r.exit_code == 0
+    assert read_file(files['a']) == 'repo a'
+    assert read_file(files['sub/b']) == 'repo sub/b'
+
+
+def test_dufl_checkout_all_checks_out_all_tracked_files(cli_run, temp_folder, remote_git_path):
+    files = _remote_with_files(temp_folder, remote_git_path, ['a', 'sub/b'])
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+
+    cli_run('-r', dufl_root, 'checkout', '--all', '--transaction')
+
+    assert read_file(files['a']) == 'repo a'
+    assert read_file(files['sub/b']) == 'repo sub/b'
+
+
+def test_dufl_checkout_does_not_copy_any_file_if_one_has_local_changes(cli_run, temp_folder, remote_git_path):
+    files = _remote_with_files(temp_folder, remote_git_path, ['a', 'b'])
+    # Timestamps have 1 sec granularity, so wait a bit!
+    time.sleep(1)
+    create_files_in_folder(temp_folder, {'b': 'local changes'})
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+
+    r = cli_run('-r', dufl_root, 'checkout', '--transaction', files['a'], files['b'])
+
+    assert r.exit_code != 0
+    assert 'It looks like you have local modifications to %s' % files['b'] in r.output
+    assert not os.path.exists(files['a'])
+    assert read_file(files['b']) == 'local changes'
+
+
+def test_dufl_checkout_requires_files(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+
+    r = cli_run('-r', dufl_root, 'checkout')
+
+    assert r.exit_code != 0
+    assert 'Nothing to checkout' in r.output
+
+
+def test_dufl_recovers_interrupted_checkout_on_next_invocation(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    target = os.path.join(temp_folder, 'target')
+    with open(staged_path(target), 'w') as f:
+        f.write('new content')
+    os.makedirs(os.path.join(dufl_root, '.git', 'dufl'))
+    with open(os.path.join(dufl_root, '.git', 'dufl', 'checkout.journal'), 'w') as f:
+        json.dump({'state': 'committed', 'entries': [
+            {'target': target, 'staged': staged_path(target)}
+        ]}, f)
+
+    r = cli_run('-r', dufl_root, 'ls')
+
+    assert 'An interrupted checkout was rolled forward.' in r.output
+    assert read_file(target) == 'new content'
+
+
+def test_dufl_does_not_recover_a_checkout_that_holds_the_lock(cli_run, temp_folder):
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init')
+    create_files_in_folder(dufl_root, {
+        'settings.yaml': yaml.dump({'lock_timeout': 0.2})
+    })
+    target = os.path.join(temp_folder, 'target')
+    with open(staged_path(target), 'w') as f:
+        f.write('new content')
+    state_folder = os.path.join(dufl_root, '.git', 'dufl')
+    if not os.path.isdir(state_folder):
+        os.makedirs(state_folder)
+    with open(os.path.join(state_folder, 'checkout.journal'), 'w') as f:
+        json.dump({'state': 'prepared', 'entries': [
+            {'target': target, 'staged': staged_path(target)}
+        ]}, f)
+    holder = RootLock(os.path.join(state_folder, LOCK_FILE), 1)
+    holder.acquire()
+    try:
+        r = cli_run('-r', dufl_root, 'ls')
+    finally:
+        holder.release()
+
+    assert r.exit_code != 0
+    assert os.path.exists(staged_path(target))
+
+
+def test_dufl_checkout_transaction_refuses_files_needing_privileges(cli_run, temp_folder, remote_git_path):
+    files = _remote_with_files(temp_folder, remote_git_path, ['a', 'b'])
+    dufl_root = os.path.join(temp_folder, '.dufl')
+    cli_run('-r', dufl_root, 'init', remote_git_path)
+
+    with patch('dufl.cli.needs_privileges', side_effect=lambda path: path == files['b']):
+        r = cli_run('-r', dufl_root, 'checkout', '--transaction', files['a'], files['b'])
+
+    assert r.exit_code != 0
+    assert '--transaction can not cover files written with sudo: %s' % files['b'] in r.output
+    assert not os.path.exists(files['a'])
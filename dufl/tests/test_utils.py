@@ -1,7 +1,9 @@
+from mock import patch
 from subprocess import CalledProcessError
 
-from tutils import patch_utils, git, temp_folder
-from ..utils import Git, GitError
+from tutils import patch_utils, git, temp_folder, create_files_in_folder
+from ..profiling import Profiler
+from ..utils import CachedGit, Git, GitError
 
 #
 # These tests don't require the git binary - they only
@@ -105,3 +107,144 @@ def test_working_branch_returns_checkedout_branch(git):
     assert git.working_branch() == 'somebranch'
     git.run('checkout', 'master')
     assert git.working_branch() == 'master'
+
+
+def test_git_reports_calls_to_profiler():
+    with patch_utils('check_output') as check_output:
+        check_output.return_value = 'hello world'
+        profiler = Profiler(enabled=True)
+        git = Git('/usr/bin/git', '~/.dufl', profiler=profiler)
+        git.get_output('log')
+        assert profiler.events[0]['name'] == 'git log'
+        assert profiler.events[0]['args']['output_bytes'] == 11
+
+
+def test_git_reports_failed_calls_to_profiler():
+    with patch_utils('check_call') as check_call:
+        check_call.side_effect = CalledProcessError(128, 'git')
+        profiler = Profiler(enabled=True)
+        git = Git('/usr/bin/git', '~/.dufl', profiler=profiler)
+        assert not git.test('rev-parse', '--verify', 'nope')
+        assert profiler.events[0]['args']['exit_code'] == 128
+
+
+def test_git_test_discards_output(git, capfd):
+    assert git.test('rev-parse', '--verify', 'HEAD')
+    out, err = capfd.readouterr()
+    assert out == ''
+
+
+def test_git_stream_gives_access_to_output(git):
+    with git.stream('ls-files') as out:
+        assert out.read() == "readme.txt\n"
+
+
+def test_git_stream_does_not_fail_when_output_is_not_read(git):
+    for i in range(20):
+        create_files_in_folder(git.root, {'file%d.txt' % i: 'x' * 10000})
+    git.run('add', '.')
+    git.run('commit', '-m', 'more files')
+    with git.stream('log', '-p') as out:
+        out.readline()
+
+
+def test_git_stream_raises_on_failure(git):
+    try:
+        with git.stream('show', 'not-a-revision') as out:
+            out.read()
+        assert False
+    except GitError:
+        assert True
+
+
+def test_git_iter_records_splits_nul_delimited_output(git):
+    create_files_in_folder(git.root, {'with\nnewline.txt': 'x', 'other.txt': 'y'})
+    git.run('add', '.')
+
+    assert list(git.iter_records('ls-files', '-z', separator='\0')) == [
+        'other.txt', 'readme.txt', 'with\nnewline.txt'
+    ]
+    assert list(git.iter_lines('ls-files')) == [
+        'other.txt', 'readme.txt', '"with\\nnewline.txt"'
+    ]
+
+
+def test_git_iter_lines_terminates_git_when_closed_early(git):
+    for i in range(20):
+        create_files_in_folder(git.root, {'file%d.txt' % i: 'x\n' * 10000})
+    git.run('add', '.')
+    git.run('commit', '-m', 'more files')
+    profiler = Profiler(enabled=True)
+    git.profiler = profiler
+
+    lines = git.iter_lines('log', '-p')
+    assert next(lines).startswith('commit ')
+    lines.close()
+
+    assert profiler.events[0]['args']['exit_code'] < 0
+
+
+def test_git_iter_lines_raises_on_failure(git):
+    try:
+        list(git.iter_lines('show', 'not-a-revision'))
+        assert False
+    except GitError:
+        assert True
+
+
+def test_cached_git_answers_repeated_queries_from_cache(git):
+    profiler = Profiler()
+    cached = CachedGit('/usr/bin/git', git.root, profiler=profiler)
+    head = cached.get_output('rev-parse', 'HEAD').strip()
+
+    for i in range(3):
+        assert cached.working_branch() == 'master'
+        assert cached.test('rev-parse', '--verify', '%s:readme.txt' % head)
+        assert not cached.test('rev-parse', '--verify', '%s:missing' % head)
+
+    assert (cached.hits, cached.misses) == (6, 4)
+    assert profiler.counters[('git_processes', ())] == 4
+    assert profiler.total('git_cache_hits') == 6
+
+
+def test_cached_git_drops_ref_dependent_results_on_writes(git):
+    cached = CachedGit('/usr/bin/git', git.root)
+    first = cached.get_output('rev-parse', 'HEAD').strip()
+    blob = cached.get_output('show', '%s:readme.txt' % first)
+    create_files_in_folder(git.root, {'other.txt': 'other'})
+    cached.run('add', 'other.txt')
+    cached.run('commit', '-m', 'other')
+
+    assert cached.get_output('rev-parse', 'HEAD').strip() != first
+    misses = cached.misses
+    assert cached.get_output('show', '%s:readme.txt' % first) == blob
+    assert cached.misses == misses
+
+
+def test_cached_git_does_not_cache_working_tree_queries(git):
+    cached = CachedGit('/usr/bin/git', git.root)
+    assert cached.get_output('ls-files') == "readme.txt\n"
+    create_files_in_folder(git.root, {'other.txt': 'other'})
+    git.run('add', 'other.txt')
+    assert cached.get_output('ls-files') == "other.txt\nreadme.txt\n"
+    assert cached.hits == 0
+
+
+def test_cached_git_drops_least_recently_used_immutable_results(git):
+    create_files_in_folder(git.root, {'other.txt': 'other'})
+    git.run('add', 'other.txt')
+    git.run('commit', '-q', '-m', 'other')
+    cached = CachedGit('/usr/bin/git', git.root)
+    head = cached.get_output('rev-parse', 'HEAD').strip()
+    queries = [('show', '%s:%s' % (head, name)) for name in ['readme.txt', 'other.txt']]
+    size = max(cached._cached_size(('output',) + q, 'x' * 16) for q in queries)
+
+    with patch('dufl.utils.MAX_IMMUTABLE_CACHE', size + 16):
+        cached.get_output(*queries[0])
+        cached.get_output(*queries[1])
+        assert cached.immutable_size <= size + 16
+        misses = cached.misses
+        cached.get_output(*queries[1])
+        assert cached.misses == misses
+        cached.get_output(*queries[0])
+        assert cached.misses == misses + 1
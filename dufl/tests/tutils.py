@@ -1,5 +1,6 @@
 import os
 import pytest
+import random
 import tempfile
 import re
 import shutil
@@ -153,6 +154,52 @@ def create_files_in_folder(root, content):
     return result
 
 
+def dufl_path(dufl_root, path):
+    """ Return where a file outside of the home folder is kept in a dufl root
+
+    Args:
+        dufl_root (str): The dufl root
+        path (str): Absolute path of the file
+    Returns:
+        str: Path of the file within the dufl root
+    """
+    return os.path.join(dufl_root, 'root', re.sub('^/', '', path))
+
+
+def read_file(path):
+    """ Return the content of a file """
+    with open(path) as f:
+        return f.read()
+
+
+def random_data(size, seed=0):
+    """ Return reproducible random binary data
+
+    Args:
+        size (int): Number of bytes
+        seed (int): Seed of the random generator
+    Returns:
+        str: The data
+    """
+    rng = random.Random(seed)
+    return ''.join(chr(rng.getrandbits(8)) for i in range(size))
+
+
+def content_writer(content):
+    """ Return a function writing the given content to a file object """
+    def write(out):
+        out.write(content)
+    return write
+
+
+def path_writer(content):
+    """ Return a function writing the given content to a file path """
+    def write(path):
+        with open(path, 'w') as f:
+            f.write(content)
+    return write
+
+
 def add_content_to_remote_git_repo(remote, content):
     """ Add content to remote git repository
 
@@ -231,6 +278,49 @@ def cli_run():
     return _run
 
 
+@pytest.fixture
+def cli_run_within_budget(cli_run):
+    """ Fixture to invoke cli commands, failing if they spawn too many git processes
+
+    This returns a function which takes the maximum number of git
+    processes the command may spawn, followed by the command arguments
+    as for `cli_run`. The budget is either a number of processes, or a
+    dictionary of git subcommand to number of processes, in which case
+    the key 'total' may limit the overall number.
+
+    The result is that of `cli_run`, with an additional git_processes
+    property: a dictionary of git subcommand to number of processes
+    spawned by the command.
+
+    Returns:
+        function: The function invoking the command
+    Raises:
+        AssertionError: If the budget was exceeded
+    """
+    def _run(budget, *args):
+        before = dict(utils.Git.spawned)
+        r = cli_run(*args)
+        r.git_processes = dict(
+            (name, count - before.get(name, 0))
+            for name, count in utils.Git.spawned.items()
+            if count > before.get(name, 0)
+        )
+        if not isinstance(budget, dict):
+            budget = {'total': budget}
+        spent = dict(r.git_processes, total=sum(r.git_processes.values()))
+        over = [
+            '%s: %d > %d' % (name, spent.get(name, 0), limit)
+            for name, limit in sorted(budget.items())
+            if spent.get(name, 0) > limit
+        ]
+        assert not over, 'dufl %s exceeded its git process budget (%s). Spawned: %s' % (
+            ' '.join(args), ', '.join(over), r.git_processes
+        )
+        return r
+
+    return _run
+
+
 @pytest.fixture
 def temp_folder(request):
     """ Fixture to create a temporary folder, and set the cwd to it.
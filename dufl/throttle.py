@@ -0,0 +1,225 @@
+""" Keep dufl from competing with other work on busy hosts
+
+Two mechanisms are used:
+
+- In low priority mode, the dufl process gets a lower CPU priority
+  and the lowest best-effort I/O priority. git processes started by
+  dufl inherit both. The I/O priority is set with the ioprio_set
+  syscall on architectures whose syscall number is known, and with
+  the ionice command elsewhere. The idle I/O class is not used, as it
+  can starve dufl indefinitely on a busy disk;
+- The io_limit setting caps the throughput of file copies and scans
+  with a token bucket, shared by all the threads of the process.
+
+Neither stops dufl from making progress, so commands still finish
+in bounded time.
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+import subprocess
+import threading
+import time
+
+
+# Niceness added in low priority mode
+NICE_INCREMENT = 10
+
+# ioprio_set syscall number, per architecture
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv6l': 314,
+    'armv7l': 314,
+    'ppc64': 273,
+    'ppc64le': 273,
+    'riscv64': 30,
+    's390x': 282
+}
+
+# Best-effort I/O class, at its lowest level (see ioprio_set(2))
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_LOWEST = (2 << 13) | 7
+
+# ionice command setting the same priority, used when the syscall
+# number isn't known
+IONICE = ['ionice', '-c', '2', '-n', '7', '-p']
+
+# Size of the blocks copied when throttling
+BLOCK_SIZE = 64 * 1024
+
+
+def lower_priority():
+    """ Lower the CPU and I/O priority of this process and its children
+
+    Returns:
+        bool: True if the I/O priority could be lowered. The CPU
+            priority is always lowered.
+    """
+    os.nice(NICE_INCREMENT)
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        return _ionice()
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, IOPRIO_LOWEST) == 0
+    except (OSError, AttributeError):
+        return _ionice()
+
+
+def _ionice():
+    """ Lower the I/O priority of this process with the ionice command
+
+    Returns:
+        bool: True if the I/O priority could be lowered
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                IONICE + [str(os.getpid())], stdout=devnull, stderr=devnull
+            ) == 0
+    except OSError:
+        return False
+
+
+def limit_jobs(context, jobs):
+    """ Return the number of workers a pool may use
+
+    Args:
+        context (dict): The context
+        jobs (int): Number of workers requested
+    Returns:
+        int: jobs, capped by the max_jobs setting. In low priority
+            mode, this is 1 unless max_jobs is set.
+    """
+    max_jobs = job_limit(context)
+    if max_jobs > 0:
+        return max(min(jobs, max_jobs), 1)
+    return max(jobs, 1)
+
+
+def job_limit(context):
+    """ Return the maximum number of workers of a pool
+
+    Args:
+        context (dict): The context
+    Returns:
+        int: The max_jobs setting. In low priority mode, this defaults
+            to 1. 0 means there is no limit.
+    """
+    return context.get('max_jobs') or (1 if context.get('nice') else 0)
+
+
+class TokenBucket(object):
+    """ Token bucket limiting a throughput, safe to share between threads
+
+    Consuming more tokens than are available is allowed, and the
+    caller sleeps until the debt is paid back. Large reads are thus
+    delayed, but never refused.
+
+    Args:
+        rate (int): Tokens (bytes) added per second
+        burst (int): Maximum number of tokens saved up while idle.
+            Defaults to a second worth of tokens.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """ Take tokens from the bucket, sleeping if there aren't enough
+
+        Args:
+            amount (int): Number of tokens to take
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate
+            )
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    """ File object wrapper counting reads and writes against a bucket
+
+    Args:
+        f (file): The wrapped file object
+        bucket (TokenBucket): The bucket to consume from
+    """
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.f.read(size if size >= 0 else BLOCK_SIZE)
+        if size < 0:
+            blocks = [data]
+            while data:
+                self.bucket.consume(len(data))
+                data = self.f.read(BLOCK_SIZE)
+                blocks.append(data)
+            return ''.join(blocks)
+        self.bucket.consume(len(data))
+        return data
+
+    def write(self, data):
+        for start in xrange(0, len(data), BLOCK_SIZE):
+            block = data[start:start + BLOCK_SIZE]
+            self.bucket.consume(len(block))
+            self.f.write(block)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def get_throttle(context):
+    """ Return the token bucket of the io_limit setting
+
+    Args:
+        context (dict): The context
+    Returns:
+        TokenBucket: The bucket, or None if throughput isn't limited
+    """
+    if not context.get('io_limit'):
+        return None
+    if 'throttle' not in context:
+        context['throttle'] = TokenBucket(context['io_limit'])
+    return context['throttle']
+
+
+def throttled(f, context):
+    """ Wrap a file object, if the io_limit setting is set
+
+    Args:
+        f (file): The file object
+        context (dict): The context
+    Returns:
+        file: A ThrottledFile, or f itself if throughput isn't limited
+    """
+    bucket = get_throttle(context)
+    if bucket is None:
+        return f
+    return ThrottledFile(f, bucket)
+
+
+def consume(context, amount):
+    """ Account for I/O that can't be throttled as it happens
+
+    Args:
+        context (dict): The context
+        amount (int): Number of bytes read or written
+    """
+    bucket = get_throttle(context)
+    if bucket is not None:
+        bucket.consume(amount)
@@ -0,0 +1,194 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import tempfile
+
+
+# Name of the journal file, within the dufl state folder
+JOURNAL_FILE = 'checkout.journal'
+
+
+def _libc_syncfs():
+    """ Return libc's syncfs function, or None if it is not available """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError):
+        return None
+
+_syncfs = _libc_syncfs()
+
+
+def flush(paths):
+    """ Flush the given files, and the folders containing them, to disk
+
+    Where syncfs is available this is a single call per file system,
+    however many files there are. Otherwise each file is synced with
+    fdatasync, and each folder with fsync.
+
+    Args:
+        paths (list of str): Files to flush. Missing files are ignored.
+    """
+    paths = [p for p in paths if os.path.exists(p)]
+    folders = sorted(set(os.path.dirname(p) for p in paths))
+    if _syncfs is not None:
+        devices = {}
+        for folder in folders:
+            devices.setdefault(os.stat(folder).st_dev, folder)
+        failed = False
+        for folder in devices.values():
+            fd = os.open(folder, os.O_RDONLY)
+            try:
+                failed = _syncfs(fd) != 0 or failed
+            finally:
+                os.close(fd)
+        if not failed:
+            return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            getattr(os, 'fdatasync', os.fsync)(fd)
+        finally:
+            os.close(fd)
+    for folder in folders:
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def staged_path(target):
+    """ Return the path a file is staged at before being renamed into place
+
+    Args:
+        target (str): Path of the file
+    Returns:
+        str: The staging path, in the same folder
+    """
+    return os.path.join(
+        os.path.dirname(target),
+        '.%s.dufl-%d' % (os.path.basename(target), os.getpid())
+    )
+
+
+class Transaction(object):
+    """ Write several files so that either all or none of them are updated
+
+    Files are first written next to their target, then flushed to disk
+    at once, and finally renamed into place. A journal records the
+    progress, so an interrupted transaction can be rolled back (if
+    it was interrupted before all files were staged and flushed) or
+    forward (if it was interrupted while renaming) by `recover`. A
+    transaction that fails before all its files are staged is rolled
+    back right away.
+
+    There is a single journal per dufl root, so callers must hold the
+    root lock while running a transaction or recovering one.
+
+    Args:
+        journal_file (str): Path of the journal
+    """
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.entries = []
+
+    def add(self, target, write):
+        """ Add a file to the transaction
+
+        Args:
+            target (str): Path of the file to write
+            write (function): Function invoked with the path of the
+                staged file, that must write the new content there.
+        """
+        self.entries.append({
+            'target': target,
+            'staged': staged_path(target),
+            'write': write
+        })
+
+    def run(self):
+        """ Stage all the files, then rename them into place """
+        _write_journal(self.journal_file, 'prepared', self.entries)
+        try:
+            for entry in self.entries:
+                if not os.path.isdir(os.path.dirname(entry['target'])):
+                    os.makedirs(os.path.dirname(entry['target']))
+                entry['write'](entry['staged'])
+            flush([e['staged'] for e in self.entries])
+            _write_journal(self.journal_file, 'committed', self.entries)
+        except BaseException:
+            _roll_back(self.journal_file, self.entries)
+            raise
+        _complete(self.journal_file, self.entries)
+
+
+def recover(journal_file):
+    """ Finish or undo an interrupted transaction
+
+    The root lock must be held, so this doesn't interfere with a
+    transaction that is still running.
+
+    Args:
+        journal_file (str): Path of the journal
+    Returns:
+        str: 'rolled back', 'rolled forward', or None if there was no
+            interrupted transaction.
+    """
+    if not os.path.exists(journal_file):
+        return None
+    try:
+        with open(journal_file) as f:
+            journal = json.load(f)
+    except ValueError:
+        # The journal is written atomically, so a broken journal can
+        # only be left by another program. Staged files are left alone.
+        os.unlink(journal_file)
+        return 'rolled back'
+    if journal['state'] == 'committed':
+        _complete(journal_file, journal['entries'])
+        return 'rolled forward'
+    _roll_back(journal_file, journal['entries'])
+    return 'rolled back'
+
+
+def _roll_back(journal_file, entries):
+    """ Remove staged files, and the journal """
+    for entry in entries:
+        if os.path.exists(entry['staged']):
+            os.unlink(entry['staged'])
+    if os.path.exists(journal_file):
+        os.unlink(journal_file)
+
+
+def _complete(journal_file, entries):
+    """ Rename staged files into place, and remove the journal """
+    for entry in entries:
+        if os.path.exists(entry['staged']):
+            os.rename(entry['staged'], entry['target'])
+    flush([e['target'] for e in entries])
+    os.unlink(journal_file)
+
+
+def _write_journal(journal_file, state, entries):
+    """ Atomically write the journal, and flush it to disk """
+    folder = os.path.dirname(journal_file)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.journal-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({
+            'state': state,
+            'entries': [
+                {'target': e['target'], 'staged': e['staged']} for e in entries
+            ]
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, journal_file)
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
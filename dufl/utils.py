@@ -1,6 +1,11 @@
+import os
 import re
+import time
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from subprocess import check_call, check_output, CalledProcessError
+from subprocess import Popen, PIPE
 
 
 class GitError(Exception):
@@ -8,16 +13,89 @@ class GitError(Exception):
     pass
 
 
+# Size of the blocks read from git by iter_records
+RECORD_BLOCK_SIZE = 64 * 1024
+
+
+def git_subcommand(argv):
+    """ Return the git subcommand from a git argv
+
+    Args:
+        argv (list of str): git argv, including the executable
+            and global options such as -C <folder>
+    Returns:
+        str: The subcommand, or '' if none was found
+    """
+    args = list(argv[1:])
+    while args:
+        arg = args.pop(0)
+        if arg in ('-C', '-c'):
+            if args:
+                args.pop(0)
+        elif not arg.startswith('-'):
+            return arg
+    return ''
+
+
+class GitOutput(object):
+    """ Read-only file wrapper over the output of a git process
+
+    This records whether the end of the output was reached.
+
+    Args:
+        f (file): The process output
+    """
+    def __init__(self, f):
+        self.f = f
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if not data and size != 0:
+            self.eof = True
+        return data
+
+    def read_available(self, size):
+        """ Read up to size bytes, returning as soon as some are available
+
+        Unlike read, this doesn't wait for size bytes to be produced.
+        It must not be mixed with the other read methods, which are
+        buffered.
+        """
+        data = os.read(self.f.fileno(), size)
+        if not data:
+            self.eof = True
+        return data
+
+    def readline(self):
+        line = self.f.readline()
+        if not line:
+            self.eof = True
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
 class Git(object):
     """ Class used to run git commands
 
     Args:
         git (str): Path to git executable
         root (str): Git root folder to work from
+        profiler (Profiler): Optional profiler used to record
+            the git subprocesses
     """
-    def __init__(self, git, root):
+    # Number of git processes spawned by all Git objects, per
+    # subcommand. Tests use this to enforce budgets on the number of
+    # processes each command spawns.
+    spawned = {}
+
+    def __init__(self, git, root, profiler=None):
         self.git = git
         self.root = root
+        self.profiler = profiler
+        self.cat_file = None
 
     def run(self, *command):
         """ Run a git command transparently
@@ -29,10 +107,7 @@ class Git(object):
             GitError
         """
         try:
-            out = check_call([
-                self.git,
-                '-C', self.root
-            ] + list(command))
+            out = self._call(check_call, command)
             if out != 0:
                 raise GitError()
         except CalledProcessError:
@@ -50,10 +125,7 @@ class Git(object):
             GitError
         """
         try:
-            out = check_output([
-                self.git,
-                '-C', self.root
-            ] + list(command))
+            out = self._call(check_output, command)
         except CalledProcessError:
             raise GitError()
         return out
@@ -61,6 +133,8 @@ class Git(object):
     def test(self, *command):
         """ Run a git command return True if it successed, False if it failed
 
+        The output of the command is discarded.
+
         Args:
             *command (array of str): List of parameters to pass to git
                 executable
@@ -68,14 +142,190 @@ class Git(object):
             bool: True if the command successed, False otherwise
         """
         try:
-            out = check_call([
-                self.git,
-                '-C', self.root
-            ] + list(command))
+            with open(os.devnull, 'w') as devnull:
+                out = self._call(check_call, command, stdout=devnull)
         except CalledProcessError:
             return False
         return out == 0
 
+    @contextmanager
+    def stream(self, *command):
+        """ Run a git command, giving access to its output as it is produced
+
+        If the block exits before the end of the output was reached, the
+        git process is terminated, and this is not considered a failure.
+
+        Args:
+            *command (array of str): List of parameters to pass to git
+                executable.
+        Yields:
+            GitOutput: The output of the git command
+        Raises:
+            GitError
+        """
+        argv = [self.git, '-C', self.root] + list(command)
+        start = time.time()
+        self._count_spawn(argv)
+        process = Popen(argv, stdout=PIPE)
+        out = GitOutput(process.stdout)
+        terminated = False
+        try:
+            yield out
+        finally:
+            process.stdout.close()
+            if not out.eof and process.poll() is None:
+                try:
+                    process.terminate()
+                    terminated = True
+                except OSError:
+                    pass
+            exit_code = process.wait()
+            if self.profiler is not None:
+                self.profiler.record_git(
+                    argv, start, time.time() - start, exit_code, None
+                )
+        # A negative exit code means git was killed by a signal, typically
+        # SIGPIPE when the output was closed before being read entirely.
+        if exit_code > 0 and not terminated:
+            raise GitError()
+
+    @contextmanager
+    def feed(self, *command):
+        """ Run a git command, writing its input as it is produced
+
+        The input is closed when the block exits, and the git process
+        is waited for.
+
+        Args:
+            *command (array of str): List of parameters to pass to git
+                executable.
+        Yields:
+            file: The input of the git command
+        Raises:
+            GitError
+        """
+        argv = [self.git, '-C', self.root] + list(command)
+        start = time.time()
+        self._count_spawn(argv)
+        process = Popen(argv, stdin=PIPE)
+        try:
+            yield process.stdin
+        finally:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+            exit_code = process.wait()
+            if self.profiler is not None:
+                self.profiler.record_git(
+                    argv, start, time.time() - start, exit_code, None
+                )
+        if exit_code != 0:
+            raise GitError()
+
+    def iter_records(self, *command, **options):
+        """ Run a git command, yielding its output records as they arrive
+
+        The output is never held in memory as a whole. If iteration
+        stops early (the generator is closed, or garbage collected), the
+        git process is terminated, and this is not considered a failure.
+
+        Args:
+            *command (array of str): List of parameters to pass to git
+                executable.
+            separator (str): Record separator. Defaults to a new line.
+                Use "\0" for commands run with -z.
+        Yields:
+            str: The records, without their separator
+        Raises:
+            GitError
+        """
+        separator = options.pop('separator', "\n")
+        if options:
+            raise TypeError('Unexpected options %s' % ', '.join(options))
+        with self.stream(*command) as out:
+            pending = ''
+            while True:
+                block = out.read_available(RECORD_BLOCK_SIZE)
+                if not block:
+                    break
+                records = (pending + block).split(separator)
+                pending = records.pop()
+                for record in records:
+                    yield record
+            if pending:
+                yield pending
+
+    def iter_lines(self, *command):
+        """ Run a git command, yielding its output lines as they arrive
+
+        See `iter_records`.
+
+        Args:
+            *command (array of str): List of parameters to pass to git
+                executable.
+        Yields:
+            str: The lines, without their line feed
+        Raises:
+            GitError
+        """
+        return self.iter_records(*command)
+
+    def read_object(self, revision):
+        """ Return the content of an object, eg. '<commit>:<path>'
+
+        Objects are read through a single `git cat-file --batch`
+        process, started on first use and kept until `close`, so
+        reading many objects doesn't cost a process each.
+
+        Args:
+            revision (str): The object
+        Returns:
+            str: The content of the object, or None if it doesn't exist
+        Raises:
+            GitError
+        """
+        if "\n" in revision:
+            # Can't be sent to cat-file --batch
+            try:
+                return self.get_output('cat-file', '-p', revision)
+            except GitError:
+                return None
+        if self.cat_file is None:
+            argv = [self.git, '-C', self.root, 'cat-file', '--batch']
+            self._count_spawn(argv)
+            self.cat_file = (
+                Popen(argv, stdin=PIPE, stdout=PIPE), argv, time.time()
+            )
+        process = self.cat_file[0]
+        try:
+            process.stdin.write(revision + "\n")
+            process.stdin.flush()
+            header = process.stdout.readline()
+            if header.endswith(' missing\n') or header.endswith(' ambiguous\n'):
+                return None
+            size = int(header.split()[2])
+            content = process.stdout.read(size)
+            process.stdout.read(1)
+        except (IOError, IndexError, ValueError):
+            self.close()
+            raise GitError()
+        return content
+
+    def close(self):
+        """ Stop the processes kept by this object """
+        if self.cat_file is None:
+            return
+        process, argv, start = self.cat_file
+        self.cat_file = None
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        exit_code = process.wait()
+        if self.profiler is not None:
+            self.profiler.record_git(argv, start, time.time() - start, exit_code, None)
+
     def working_branch(self):
         """ Return the working branch
 
@@ -86,9 +336,245 @@ class Git(object):
         Raises:
             GitError
         """
-        branches = self.get_output('branch', '--list', '--no-color')
-        for branch in branches.split("\n"):
-            current = re.search('^\* (?P<branch_name>[^\s]+)$', branch.strip())
-            if current:
-                return current.groupdict()['branch_name']
+        lines = self.iter_lines('branch', '--list', '--no-color')
+        try:
+            for branch in lines:
+                current = re.search('^\* (?P<branch_name>[^\s]+)$', branch.strip())
+                if current:
+                    return current.groupdict()['branch_name']
+        finally:
+            lines.close()
         raise GitError()
+
+    @staticmethod
+    def _count_spawn(argv):
+        """ Count a git process about to be spawned, in Git.spawned """
+        subcommand = git_subcommand(argv)
+        Git.spawned[subcommand] = Git.spawned.get(subcommand, 0) + 1
+
+    def _call(self, runner, command, **options):
+        """ Invoke git through the given subprocess function
+
+        This is where git processes are recorded by the profiler.
+
+        Args:
+            runner (function): check_call or check_output
+            command (list of str): Parameters to pass to git
+            **options: Options to pass to the subprocess function
+        Returns:
+            The return value of runner
+        Raises:
+            CalledProcessError
+        """
+        argv = [self.git, '-C', self.root] + list(command)
+        self._count_spawn(argv)
+        if self.profiler is None:
+            return runner(argv, **options)
+        start = time.time()
+        exit_code = 0
+        out = None
+        try:
+            out = runner(argv, **options)
+            if runner is check_call:
+                exit_code = out
+            return out
+        except CalledProcessError as e:
+            exit_code = e.returncode
+            raise
+        finally:
+            output_bytes = None
+            if isinstance(out, (bytes, str)):
+                output_bytes = len(out)
+            self.profiler.record_git(
+                argv, start, time.time() - start, exit_code, output_bytes
+            )
+
+
+# Read-only git commands. Running any other command through a CachedGit
+# may change refs, so it drops the cached results that depend on them.
+READ_ONLY_COMMANDS = set([
+    'archive', 'branch', 'cat-file', 'diff', 'diff-tree', 'grep', 'log',
+    'ls-files', 'ls-remote', 'ls-tree', 'merge-base', 'rev-list',
+    'rev-parse', 'show', 'status', 'var'
+])
+
+# Read-only commands whose result only depends on the commits they are
+# given (and on refs), not on the index or working tree.
+CACHED_COMMANDS = set([
+    'branch', 'cat-file', 'diff-tree', 'log', 'ls-tree', 'merge-base',
+    'rev-list', 'rev-parse', 'show'
+])
+
+# Revision naming a commit by its full sha, optionally with a path or suffix
+SHA_REVISION = re.compile('^[0-9a-f]{40}([:^~@].*)?$')
+
+# Largest output kept in the cache, in bytes
+MAX_CACHED_OUTPUT = 1024 * 1024
+
+# Total size of the results kept in the cache of immutable queries, in
+# bytes. The least recently used results are dropped beyond this.
+MAX_IMMUTABLE_CACHE = 16 * 1024 * 1024
+
+
+class CachedGit(Git):
+    """ Git object remembering the results of read-only queries
+
+    Within a command, dufl asks git the same questions repeatedly (the
+    working branch, whether a file exists at a commit, its content...).
+    Queries whose revisions are all full shas can never change, so
+    their results are kept for the lifetime of the object, up to
+    MAX_IMMUTABLE_CACHE bytes (least recently used first out). Other
+    queries depend on refs such as HEAD or the working branch, so their
+    results are dropped whenever a command that may change refs (commit,
+    pull, merge...) is run through this object.
+
+    Changes made to the repository by other processes are not noticed:
+    this is meant to live for the duration of a single dufl command,
+    or `forget_refs` must be called between commands.
+
+    Args:
+        git (str): Path to git executable
+        root (str): Git root folder to work from
+        profiler (Profiler): Optional profiler used to record the git
+            subprocesses, and the cache hits and misses.
+    """
+    def __init__(self, git, root, profiler=None):
+        Git.__init__(self, git, root, profiler=profiler)
+        self.immutable = OrderedDict()
+        self.immutable_size = 0
+        self.ref_dependent = {}
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, *command):
+        self._invalidate(command)
+        Git.run(self, *command)
+
+    def get_output(self, *command):
+        return self._cached('output', command, Git.get_output)
+
+    def working_branch(self):
+        key = ('working_branch',)
+        if key in self.ref_dependent:
+            self.hits += 1
+            self._count('git_cache_hits', ('branch',))
+            return self.ref_dependent[key]
+        self.misses += 1
+        self._count('git_cache_misses', ('branch',))
+        branch = Git.working_branch(self)
+        self.ref_dependent[key] = branch
+        return branch
+
+    def test(self, *command):
+        return self._cached('test', command, Git.test)
+
+    def forget_refs(self):
+        """ Drop the cached results that depend on refs
+
+        Objects living longer than a command (see `dufl batch`) call
+        this between commands, as other processes may change refs.
+        """
+        self.ref_dependent = {}
+
+    @contextmanager
+    def stream(self, *command):
+        self._invalidate(command)
+        with Git.stream(self, *command) as out:
+            yield out
+
+    @contextmanager
+    def feed(self, *command):
+        self._invalidate(command)
+        with Git.feed(self, *command) as f:
+            yield f
+
+    def _cached(self, kind, command, method):
+        """ Return the cached result of a query, or run it
+
+        Args:
+            kind (str): 'output' or 'test'
+            command (tuple of str): Parameters to pass to git
+            method (function): Unbound Git method running the query
+        Returns:
+            The result of the query
+        """
+        if not self._cacheable(command):
+            self._invalidate(command)
+            return method(self, *command)
+        immutable = self._immutable(command)
+        cache = self.immutable if immutable else self.ref_dependent
+        key = (kind,) + tuple(command)
+        if key in cache:
+            self.hits += 1
+            self._count('git_cache_hits', command)
+            if immutable:
+                # Mark as most recently used
+                cache[key] = cache.pop(key)
+            return cache[key]
+        self.misses += 1
+        self._count('git_cache_misses', command)
+        result = method(self, *command)
+        if not isinstance(result, str) or len(result) <= MAX_CACHED_OUTPUT:
+            if immutable:
+                self._store_immutable(key, result)
+            else:
+                cache[key] = result
+        return result
+
+    def _store_immutable(self, key, result):
+        """ Cache the result of an immutable query, within the size limit
+
+        Args:
+            key (tuple): The cache key
+            result: The result of the query
+        """
+        self.immutable[key] = result
+        self.immutable_size += self._cached_size(key, result)
+        while self.immutable_size > MAX_IMMUTABLE_CACHE:
+            old_key, old_result = self.immutable.popitem(last=False)
+            self.immutable_size -= self._cached_size(old_key, old_result)
+
+    @staticmethod
+    def _cached_size(key, result):
+        """ Return the size accounted for a cached result, in bytes """
+        size = sum(len(k) for k in key)
+        if isinstance(result, str):
+            size += len(result)
+        return size
+
+    def _count(self, name, command):
+        if self.profiler is not None:
+            self.profiler.count(name, git_command=command[0])
+
+    def _invalidate(self, command):
+        """ Drop the results depending on refs, if command may change them """
+        if len(command) > 0 and command[0] in READ_ONLY_COMMANDS:
+            if command[0] != 'branch' or '--list' in command:
+                return
+        self.ref_dependent = {}
+
+    @staticmethod
+    def _cacheable(command):
+        """ Check whether the result of a command can be cached """
+        if len(command) == 0 or command[0] not in CACHED_COMMANDS:
+            return False
+        # branch modifies branches unless listing them
+        return command[0] != 'branch' or '--list' in command
+
+    @staticmethod
+    def _immutable(command):
+        """ Check whether all the revisions of a command are full shas
+
+        Positional parameters before '--' are taken to be revisions.
+        Anything that isn't a full sha could be a ref.
+        """
+        revisions = []
+        for arg in command[1:]:
+            if arg == '--':
+                break
+            if not arg.startswith('-'):
+                revisions.append(arg)
+        return len(revisions) > 0 and all(
+            SHA_REVISION.match(r) for r in revisions
+        )
+
@@ -9,6 +9,9 @@ setup(
         'Click',
         'pyyaml'
     ],
+    extras_require={
+        'encryption': ['pycryptodome']
+    },
     entry_points='''
         [console_scripts]
         dufl=dufl.cli:cli